@@ -1,8 +1,16 @@
 """app.py
 应用程序入口文件
 """
+import json
+import os
+import sys
+
+import click
+
+from rmon.analysis.rdb import RdbError, analyze_rdb as analyze_rdb_file
 from rmon.app import create_app
 from rmon.extensions import db
+from rmon.metrics.supervisor import CollectorSupervisor
 
 app = create_app()
 
@@ -11,4 +19,38 @@ def init_db():
 	"""初始化数据库
 	"""
 	print("sqllite3 database file is %s" % app.config['SQLALCHEMY_DATABASE_URI'])
-	db.create_all()
\ No newline at end of file
+	db.create_all()
+
+@app.cli.command()
+@click.option('--workers', '-w', type=int, default=None, help='采集进程数量，默认为CPU核心数')
+def collect(workers):
+	"""启动多进程监控信息采集
+
+	服务器通过一致性哈希分配给各个采集进程，采样写入 METRICS_STORE_PATH 和 METRICS_SNAPSHOT_PATH。
+	生产环境中只运行一个 collect 命令作为监控信息的唯一发布者，web 进程不开启 METRICS_COLLECTOR_ENABLED
+	"""
+	if not app.config['METRICS_STORE_PATH']:
+		print("METRICS_STORE_PATH is required to share metrics with web processes")
+	CollectorSupervisor(workers).run()
+
+@app.cli.command()
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--db', type=int, default=None, help='只分析指定的数据库，默认分析所有数据库')
+@click.option('--delimiter', default=':', help='键名前缀的分隔符')
+@click.option('--depth', type=int, default=3, help='前缀树的最大层数')
+@click.option('--top', type=int, default=50, help='输出最大的键的数量')
+def analyze_rdb(path, db, delimiter, depth, top):
+	"""离线分析 RDB 文件，输出与键空间分析API相同格式的json结果
+
+	文件通过mmap按顺序读取，内存占用与文件大小无关
+	"""
+	with click.progressbar(length=os.path.getsize(path), file=sys.stderr,
+	                       label='analyzing %s' % path) as bar:
+		def progress(position, size):
+			bar.update(position - bar.pos)
+
+		try:
+			result = analyze_rdb_file(path, db, delimiter, depth, top, progress)
+		except RdbError as e:
+			raise click.ClickException(str(e))
+	click.echo(json.dumps(result, indent=2, ensure_ascii=False))
@@ -0,0 +1,76 @@
+"""benchmarks.bench_dispatch
+
+RestView 请求分发开销的微基准测试
+
+对比每次请求都重新包装装饰器、通过 make_response 生成响应的旧实现，
+与预先包装装饰器、直接构造响应的新实现，运行方式：
+
+    python -m benchmarks.bench_dispatch
+"""
+import timeit
+from functools import wraps
+
+from flask import Flask, request, make_response
+from flask.json import dumps
+
+from rmon.common.rest import RestView
+
+
+def passthrough(func):
+    """模拟 ObjectMustBeExist、TokenAuthenticate 等装饰器
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        return func(*args, **kwargs)
+    return wrapper
+
+
+class LegacyRestView(RestView):
+    """旧的分发实现
+    """
+
+    def dispatch_request(self, *args, **kwargs):
+        method = getattr(self, request.method.lower(), None)
+        for decorator in self.method_decorators:
+            method = decorator(method)
+        resp = method(*args, **kwargs)
+        data, code, headers = RestView.unpack(resp)
+        response = make_response(dumps(data) + '\n', code)
+        response.headers.extend(headers)
+        response.headers['Content-Type'] = self.content_type
+        return response
+
+
+class Mixin:
+    method_decorators = (passthrough, passthrough)
+
+    def get(self, object_id):
+        return {'id': object_id, 'name': 'redis', 'host': '127.0.0.1', 'port': 6379}
+
+
+class LegacyView(Mixin, LegacyRestView):
+    pass
+
+
+class FastView(Mixin, RestView):
+    pass
+
+
+def bench(view_class, number):
+    app = Flask(__name__)
+    view = view_class.as_view(view_class.__name__)
+    with app.test_request_context('/servers/1'):
+        view(object_id=1)
+        return timeit.timeit(lambda: view(object_id=1), number=number) / number
+
+
+def main(number=20000):
+    legacy = bench(LegacyView, number)
+    fast = bench(FastView, number)
+    print('legacy dispatch: %.2f us/request' % (legacy * 1e6))
+    print('fast dispatch:   %.2f us/request' % (fast * 1e6))
+    print('speedup:         %.2fx' % (legacy / fast))
+
+
+if __name__ == '__main__':
+    main()
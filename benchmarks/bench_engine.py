@@ -0,0 +1,96 @@
+"""benchmarks.bench_engine
+
+asyncio采集引擎的吞吐量测试
+
+在子进程中启动一个模拟Redis服务器，对每个INFO指令返回固定的监控信息，
+引擎以1秒的周期采集大量服务器(都指向该模拟服务器的不同连接)，统计每秒保存的采样数，
+运行方式：
+
+    python -m benchmarks.bench_engine [服务器数量] [运行秒数]
+"""
+import asyncio
+import multiprocessing
+import sys
+import time
+
+from rmon.metrics.collector import MetricsCollector
+from rmon.metrics.engine import AsyncEngine
+from rmon.models.server import Server
+
+
+PORT = 16399
+
+
+def info_payload():
+    lines = ['# Server', 'redis_version:3.2.8', 'run_id:a8e4bc6ba1cbb2e7f1c2d9e0d1b04f5a1c0e4d33',
+             'uptime_in_seconds:864000', '# Clients', 'connected_clients:120', '# Memory',
+             'used_memory:104857600', 'mem_fragmentation_ratio:1.12', '# Stats',
+             'total_connections_received:10293', 'total_commands_processed:928374923',
+             'total_net_input_bytes:83745982734', 'total_net_output_bytes:293847293847',
+             'keyspace_hits:82734923', 'keyspace_misses:1293847', '# CPU',
+             'used_cpu_sys:1203.45', 'used_cpu_user:3492.12', '# Keyspace']
+    lines += ['db%d:keys=%d,expires=%d,avg_ttl=3600000' % (i, 100000 + i, 1000 + i)
+              for i in range(16)]
+    body = ('\r\n'.join(lines) + '\r\n').encode('utf-8')
+    return b'$%d\r\n%s\r\n' % (len(body), body)
+
+
+def serve():
+    """模拟Redis服务器，只支持INFO指令
+    """
+    reply = info_payload()
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                # 每个指令为 *1 $4 INFO 三行
+                await reader.readline()
+                await reader.readline()
+                writer.write(reply)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(asyncio.start_server(handle, '127.0.0.1', PORT, backlog=4096))
+    loop.run_forever()
+
+
+async def poll(engine, servers, duration):
+    engine._semaphore = asyncio.Semaphore(engine.concurrency)
+    engine._sync(servers)
+    await asyncio.sleep(duration)
+    engine._sync([])
+    await asyncio.sleep(0.1)
+
+
+def main(count=5000, duration=10):
+    server = multiprocessing.Process(target=serve, daemon=True)
+    server.start()
+    time.sleep(0.5)
+
+    collector = MetricsCollector()
+    collector.history_size = 60
+    engine = AsyncEngine(collector, interval=1, timeout=2, concurrency=500)
+    servers = [Server(id=i, name='redis-%d' % i, host='127.0.0.1', port=PORT)
+               for i in range(count)]
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    started = time.monotonic()
+    loop.run_until_complete(poll(engine, servers, duration))
+    elapsed = time.monotonic() - started
+    server.terminate()
+
+    collected = len([i for i in range(count) if collector.latest(i) is not None])
+    print('servers:          %d' % count)
+    print('samples/second:   %.0f (target %d)' % (collector.version / elapsed, count))
+    print('servers sampled:  %d' % collected)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
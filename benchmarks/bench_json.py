@@ -0,0 +1,76 @@
+"""benchmarks.bench_json
+
+API响应json序列化的微基准测试
+
+使用与实际响应相近的数据：单个服务器的INFO、服务器列表和集群监控快照，
+对比 flask.json.dumps 与已安装的各个序列化库，运行方式：
+
+    python -m benchmarks.bench_json
+"""
+import timeit
+from datetime import datetime
+
+from flask import Flask
+from flask.json import dumps
+
+from rmon.common import encoder
+
+
+def info_payload():
+    """模拟 INFO 指令返回的监控信息
+    """
+    info = {
+        'redis_version': '3.2.8', 'redis_mode': 'standalone', 'os': 'Linux 4.4.0 x86_64',
+        'run_id': 'a8e4bc6ba1cbb2e7f1c2d9e0d1b04f5a1c0e4d33', 'tcp_port': 6379,
+        'uptime_in_seconds': 864000, 'connected_clients': 120, 'blocked_clients': 0,
+        'used_memory': 104857600, 'used_memory_human': '100.00M', 'mem_fragmentation_ratio': 1.12,
+        'total_connections_received': 10293, 'total_commands_processed': 928374923,
+        'instantaneous_ops_per_sec': 12034, 'total_net_input_bytes': 83745982734,
+        'total_net_output_bytes': 293847293847, 'keyspace_hits': 82734923, 'keyspace_misses': 1293847,
+        'used_cpu_sys': 1203.45, 'used_cpu_user': 3492.12, 'role': 'master', 'connected_slaves': 1,
+    }
+    for i in range(16):
+        info['db%d' % i] = {'keys': 100000 + i, 'expires': 1000 + i, 'avg_ttl': 3600000}
+    return info
+
+
+def server_list_payload(count=1000):
+    """模拟服务器列表
+    """
+    now = datetime(2017, 5, 1, 12, 0, 0).isoformat()
+    return [{'id': i, 'name': 'redis-%04d' % i, 'description': 'cache server %d' % i,
+             'host': '10.0.%d.%d' % (i // 256, i % 256), 'port': 6379,
+             'created_at': now, 'updated_at': now} for i in range(count)]
+
+
+def fleet_payload(count=200):
+    """模拟集群监控快照
+    """
+    info = info_payload()
+    derived = {'ops_per_sec': 12034.5, 'hit_ratio': 0.9846, 'cpu_percent': 23.4}
+    return [{'id': i, 'name': 'redis-%04d' % i, 'ok': True,
+             'metrics': dict(info, derived=derived)} for i in range(count)]
+
+
+def main(number=200):
+    app = Flask(__name__)
+    payloads = (('info', info_payload()),
+                ('server list', server_list_payload()),
+                ('fleet snapshot', fleet_payload()))
+    names = [name for name in ('orjson', 'ujson', 'json')
+             if name == 'json' or getattr(encoder, name) is not None]
+
+    with app.app_context():
+        for title, payload in payloads:
+            baseline = timeit.timeit(lambda: (dumps(payload) + '\n').encode('utf-8'),
+                                     number=number) / number
+            print('%s (%d bytes)' % (title, len(encoder.get_dumps('json')[1](payload))))
+            print('  flask.json: %10.2f us' % (baseline * 1e6))
+            for name in names:
+                func = encoder.get_dumps(name)[1]
+                elapsed = timeit.timeit(lambda: func(payload), number=number) / number
+                print('  %-10s  %10.2f us  %.2fx' % (name + ':', elapsed * 1e6, baseline / elapsed))
+
+
+if __name__ == '__main__':
+    main()
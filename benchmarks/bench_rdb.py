@@ -0,0 +1,73 @@
+"""benchmarks.bench_rdb
+
+RDB 文件离线分析的吞吐量和内存占用测试
+
+生成包含大量键的 RDB 文件，其中一部分为 ziplist 等整体保存的编码，一部分为逐个元素保存的编码，
+统计每秒分析的键数量、每秒读取的字节数和进程的最大内存占用，运行方式：
+
+    python -m benchmarks.bench_rdb [键数量]
+"""
+import os
+import resource
+import struct
+import sys
+import tempfile
+import time
+
+from rmon.analysis.rdb import analyze_rdb
+
+
+def encode_length(length):
+    if length < 64:
+        return bytes([length])
+    if length < 16384:
+        return bytes([0x40 | length >> 8, length & 0xff])
+    return b'\x80' + struct.pack('>I', length)
+
+
+def encode_string(value):
+    return encode_length(len(value)) + value
+
+
+def generate(path, count):
+    """生成测试文件: 字符串、ziplist 编码的哈希、逐个元素保存的集合，每10个键有1个设置了过期时间
+    """
+    blob = encode_string(os.urandom(200))
+    members = b''.join(encode_string(b'member:%d' % i) for i in range(20))
+    with open(path, 'wb') as f:
+        f.write(b'REDIS0009\xfe\x00')
+        for i in range(count):
+            if i % 10 == 0:
+                f.write(b'\xfc' + struct.pack('<Q', int(time.time() * 1000) + 3600000))
+            key = encode_string(b'user:%d:%s' % (i % 1000, b'profile' if i % 3 else b'session'))
+            kind = i % 3
+            if kind == 0:
+                f.write(b'\x00' + key + encode_string(b'value:%d' % i))
+            elif kind == 1:
+                f.write(b'\x0d' + key + blob)
+            else:
+                f.write(b'\x02' + key + encode_length(20) + members)
+        f.write(b'\xff' + b'\x00' * 8)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    fd, path = tempfile.mkstemp(suffix='.rdb')
+    os.close(fd)
+    try:
+        generate(path, count)
+        size = os.path.getsize(path)
+        started = time.monotonic()
+        result = analyze_rdb(path)
+        elapsed = time.monotonic() - started
+    finally:
+        os.remove(path)
+
+    assert result['keys'] == count
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print('%d keys, %.1fMB in %.2fs: %.0f keys/s, %.1fMB/s, max rss %.1fMB' % (
+        count, size / 1e6, elapsed, count / elapsed, size / 1e6 / elapsed, rss / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,327 @@
+"""rmon.analysis.jobs
+
+后台分析任务
+
+任务在启动它的进程的后台线程中运行。多进程部署时配置 ANALYSIS_JOB_PATH 共享任务状态：
+运行任务的进程定期把状态和结果写入该目录下的状态文件，其他进程读取状态文件返回进度和结果，
+停止任务时写入停止标记文件，由运行任务的进程停止任务；任务结束时保存断点，
+任意进程都可以从断点继续分析
+"""
+import fcntl
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from functools import partial
+
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+CANCELLED = 'cancelled'
+FAILED = 'failed'
+
+
+class Job:
+    """在后台线程中运行的任务
+
+    task 需要实现 run(stop)、progress() 和 result()，run 在 stop 被设置后应尽快返回；
+    可以继续运行的任务还需要实现 checkpoint()，返回json兼容的断点
+    """
+
+    def __init__(self, task, on_update=None, interval=1):
+        """
+        Args:
+                task(object): 任务
+                on_update(callable): 任务运行期间每 interval 秒以及结束时以任务为参数调用
+                interval(float): 调用 on_update 的间隔(秒)
+        """
+        self.task = task
+        self.state = PENDING
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+        self.on_update = on_update
+        self.interval = interval
+        self._stop = threading.Event()
+        self._finished = threading.Event()
+        # 定期发布和结束时的发布互斥，结束时的状态最后写入
+        self._update_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def active(self):
+        return self.state in (PENDING, RUNNING)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='rmon-job', daemon=True)
+        self._thread.start()
+        if self.on_update is not None:
+            threading.Thread(target=self._publish, name='rmon-job-publish', daemon=True).start()
+
+    def _run(self):
+        self.state = RUNNING
+        self.started_at = time.time()
+        try:
+            self.task.run(self._stop)
+        except Exception as e:
+            logger.exception('analysis job failed')
+            self.error = str(e)
+            self.state = FAILED
+        else:
+            self.state = CANCELLED if self._stop.is_set() else DONE
+        self.finished_at = time.time()
+        with self._update_lock:
+            self._update()
+            self._finished.set()
+
+    def _publish(self):
+        while not self._finished.wait(self.interval):
+            with self._update_lock:
+                if self._finished.is_set():
+                    return
+                self._update()
+
+    def _update(self):
+        if self.on_update is None:
+            return
+        try:
+            self.on_update(self)
+        except Exception:
+            logger.exception('publish analysis job failed')
+
+    def cancel(self):
+        """停止任务，任务会在当前批次结束后退出
+        """
+        self._stop.set()
+
+    def join(self, timeout=None):
+        """等待任务结束，包括结束时的状态发布
+        """
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def to_dict(self):
+        return {
+            'state': self.state,
+            'error': self.error,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'progress': self.task.progress(),
+            'result': self.task.result(),
+        }
+
+
+class JobRegistry:
+    """分析任务登记，每个服务器的每种分析同时只有一个任务
+
+    没有配置 ANALYSIS_JOB_PATH 时任务只在当前进程内可见，
+    多进程部署时需要把分析API的请求都转发到同一个进程
+    """
+
+    def __init__(self, app=None):
+        self.config = {}
+        self.path = None
+        self.interval = 1
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._owner = '%s:%d' % (socket.gethostname(), os.getpid())
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """保存app配置，分析任务从中读取参数
+        """
+        self.config = app.config
+        self.path = app.config.get('ANALYSIS_JOB_PATH')
+        self.interval = app.config.get('ANALYSIS_JOB_PUBLISH_INTERVAL', self.interval)
+        app.extensions['analysis_jobs'] = self
+
+        if self.path:
+            os.makedirs(self.path, exist_ok=True)
+
+    @property
+    def shared(self):
+        return bool(self.path)
+
+    def _file(self, key, suffix='.json'):
+        return os.path.join(self.path, '%s-%s%s' % (key[0], key[1], suffix))
+
+    def start(self, key, task):
+        """启动任务
+
+        Args:
+                key(tuple): (服务器id, 分析种类)
+                task(object): 任务
+
+        Returns:
+                Job: 新任务，已有任务正在运行(包括其他进程中的任务)时返回None
+        """
+        if not self.shared:
+            with self._lock:
+                job = self._jobs.get(key)
+                if job is not None and job.active:
+                    return None
+                job = self._jobs[key] = Job(task)
+            job.start()
+            return job
+
+        on_update = partial(self._save, key)
+        # 文件锁保证多个进程不会同时启动同一个任务
+        with self._lock, self._file_lock():
+            job = self._jobs.get(key)
+            if job is not None and job.active:
+                return None
+            status = self.load(key)
+            if status is not None and status['state'] in (PENDING, RUNNING):
+                return None
+            try:
+                os.remove(self._file(key, '.cancel'))
+            except FileNotFoundError:
+                pass
+            job = self._jobs[key] = Job(task, on_update, self.interval)
+            self._save(key, job)
+        job.start()
+        return job
+
+    def _file_lock(self):
+        return _FileLock(os.path.join(self.path, '.lock'))
+
+    def _save(self, key, job):
+        """写入任务状态，收到停止标记时停止任务
+        """
+        if job.active and os.path.exists(self._file(key, '.cancel')):
+            job.cancel()
+        data = job.to_dict()
+        data['owner'] = self._owner
+        data['updated_at'] = time.time()
+        if not job.active and hasattr(job.task, 'checkpoint'):
+            data['checkpoint'] = job.task.checkpoint()
+        path = self._file(key)
+        tmp = '%s.%s.tmp' % (path, self._owner)
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    def load(self, key):
+        """读取共享的任务状态
+
+        运行任务的进程超过 5 个发布周期没有更新状态时，认为该进程已经退出，任务失败
+
+        Returns:
+                dict: 任务状态，没有任务时返回None
+        """
+        if not self.shared:
+            return None
+        try:
+            with open(self._file(key)) as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        stale = time.time() - data['updated_at'] > max(5 * self.interval, 10)
+        if data['state'] in (PENDING, RUNNING) and stale:
+            data['state'] = FAILED
+            data['error'] = 'analysis worker %s stopped' % data['owner']
+        return data
+
+    def get(self, key):
+        """当前进程中最近一次任务，没有任务时返回None
+        """
+        return self._jobs.get(key)
+
+    def status(self, key):
+        """最近一次任务的状态和结果，任务可能在其他进程中运行
+
+        Returns:
+                dict: 与 Job.to_dict 一致，没有任务时返回None
+        """
+        job = self._jobs.get(key)
+        if job is not None and (job.active or not self.shared):
+            return job.to_dict()
+        # 当前进程的任务已经结束时，其他进程可能启动了新的任务
+        data = self.load(key)
+        if data is None:
+            return job.to_dict() if job is not None else None
+        for name in ('owner', 'updated_at', 'checkpoint'):
+            data.pop(name, None)
+        return data
+
+    def checkpoint(self, key):
+        """最近一次已经结束的任务保存的断点，没有断点时返回None
+        """
+        data = self.load(key)
+        if data is None or data['state'] in (PENDING, RUNNING):
+            return None
+        return data.get('checkpoint')
+
+    def cancel(self, key):
+        """停止任务，任务在其他进程中运行时写入停止标记
+
+        Returns:
+                bool: 是否存在该任务
+        """
+        job = self._jobs.get(key)
+        if job is not None and (job.active or not self.shared):
+            job.cancel()
+            return True
+        data = self.load(key)
+        if data is None:
+            return job is not None
+        if data['state'] in (PENDING, RUNNING):
+            open(self._file(key, '.cancel'), 'a').close()
+        return True
+
+    def forget(self, server_id):
+        """停止并删除服务器的所有任务
+        """
+        with self._lock:
+            keys = [key for key in self._jobs if key[0] == server_id]
+            jobs = [self._jobs.pop(key) for key in keys]
+        for job in jobs:
+            job.on_update = None
+            job.cancel()
+        if self.shared:
+            prefix = '%s-' % server_id
+            for name in os.listdir(self.path):
+                if not name.startswith(prefix):
+                    continue
+                path = os.path.join(self.path, name)
+                if name.endswith('.json'):
+                    # 其他进程中运行的任务
+                    open(path[:-len('.json')] + '.cancel', 'a').close()
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def clear(self):
+        """停止并删除当前进程的所有任务
+        """
+        with self._lock:
+            jobs, self._jobs = list(self._jobs.values()), {}
+        for job in jobs:
+            job.on_update = None
+            job.cancel()
+
+
+class _FileLock:
+    """多进程之间的互斥锁
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def __enter__(self):
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        os.close(self._fd)
+        self._fd = None
@@ -0,0 +1,159 @@
+"""rmon.analysis.keyspace
+
+基于 SCAN 的键空间分析
+
+每批次执行一次 SCAN，然后在同一个管道中对这一批键执行 TYPE、MEMORY USAGE 和 TTL。
+每批次之后根据速率上限和占空比休眠，限制分析对Redis服务器的影响；
+游标保存在分析器中，停止后可以从中断的位置继续，
+断点(游标和已分析部分的结果)可以保存后在其他进程中继续
+"""
+import threading
+import time
+
+from redis import ResponseError
+
+from rmon.analysis.report import KeyspaceReport
+
+
+class KeyspaceAnalyzer:
+    """键空间分析器
+
+    Redis 4.0 以下不支持 MEMORY USAGE，此时只统计键数量，字节数为0
+    """
+
+    def __init__(self, redis, count=100, rate=1000, duty=0.1,
+                 delimiter=':', depth=3, top=50):
+        """
+        Args:
+                redis(StrictRedis): Redis服务器连接
+                count(int): 每次 SCAN 的 COUNT 参数
+                rate(float): 每秒最多分析的键数量
+                duty(float): Redis服务器处理分析请求的时间占总时间的最大比例
+                delimiter(str): 键名前缀的分隔符
+                depth(int): 前缀树的最大层数
+                top(int): 保留最大的键的数量
+        """
+        self.redis = redis
+        self.count = count
+        self.rate = rate
+        self.duty = duty
+        self.report = KeyspaceReport(delimiter, depth, top)
+        self.cursor = 0
+        self.scanned = 0
+        self.total = None
+        self.finished = False
+        self.memory_usage = True
+        # 分析线程写入结果时，请求线程可能正在读取
+        self._lock = threading.Lock()
+
+    def step(self):
+        """分析一批键
+
+        Returns:
+                int: 本批次分析的键数量
+        """
+        if self.total is None:
+            self.total = self.redis.dbsize()
+
+        cursor, keys = self.redis.scan(self.cursor, count=self.count)
+        if keys:
+            self._analyze(keys)
+        self.cursor = cursor
+        self.scanned += len(keys)
+        if cursor == 0:
+            self.finished = True
+        return len(keys)
+
+    def _analyze(self, keys):
+        pipe = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.type(key)
+            pipe.ttl(key)
+            if self.memory_usage:
+                pipe.execute_command('MEMORY', 'USAGE', key)
+        results = pipe.execute(raise_on_error=False)
+
+        with self._lock:
+            self._add(keys, results)
+
+    def _add(self, keys, results):
+        width = 3 if self.memory_usage else 2
+        for i, key in enumerate(keys):
+            type, ttl = results[i * width:i * width + 2]
+            size = results[i * width + 2] if self.memory_usage else 0
+            if isinstance(size, ResponseError):
+                # 不支持 MEMORY USAGE，之后的批次不再执行
+                self.memory_usage = False
+                size = 0
+            if isinstance(type, Exception) or type == b'none':
+                # 键在 SCAN 之后被删除
+                continue
+            self.report.add(key.decode('utf-8', 'backslashreplace'), type.decode('utf-8'),
+                            size or 0, ttl if isinstance(ttl, int) and ttl >= 0 else None)
+
+    def throttle(self, keys, elapsed):
+        """本批次之后需要休眠的时间
+
+        Args:
+                keys(int): 本批次的键数量
+                elapsed(float): 本批次的耗时(秒)
+        """
+        delay = elapsed * (1 / self.duty - 1) if self.duty < 1 else 0
+        if self.rate:
+            delay = max(delay, keys / self.rate - elapsed)
+        return max(delay, 0)
+
+    def run(self, stop):
+        """分析直到结束或者stop被设置
+
+        Args:
+                stop(threading.Event): 停止信号
+        """
+        while not self.finished and not stop.is_set():
+            started = time.monotonic()
+            keys = self.step()
+            stop.wait(self.throttle(keys, time.monotonic() - started))
+
+    def checkpoint(self):
+        """json兼容的断点，分析已经完成时返回None
+        """
+        if self.finished:
+            return None
+        with self._lock:
+            return {
+                'cursor': self.cursor,
+                'scanned': self.scanned,
+                'total': self.total,
+                'memory_usage': self.memory_usage,
+                'report': self.report.state(),
+            }
+
+    @classmethod
+    def restore(cls, redis, checkpoint, **kwargs):
+        """从断点继续分析
+
+        Args:
+                redis(StrictRedis): Redis服务器连接
+                checkpoint(dict): checkpoint 的结果
+                kwargs: 速率等参数，键名分隔符、前缀树层数和最大键数量沿用断点中的设置
+        """
+        analyzer = cls(redis, **kwargs)
+        analyzer.cursor = checkpoint['cursor']
+        analyzer.scanned = checkpoint['scanned']
+        analyzer.total = checkpoint['total']
+        analyzer.memory_usage = checkpoint['memory_usage']
+        analyzer.report = KeyspaceReport.from_state(checkpoint['report'])
+        return analyzer
+
+    def progress(self):
+        progress = {'scanned': self.scanned, 'total': self.total, 'cursor': self.cursor,
+                    'memory_usage': self.memory_usage}
+        if self.finished:
+            progress['percent'] = 100
+        elif self.total:
+            progress['percent'] = min(self.scanned / self.total * 100, 99.9)
+        return progress
+
+    def result(self):
+        with self._lock:
+            return self.report.to_dict()
@@ -0,0 +1,196 @@
+"""rmon.analysis.monitor
+
+MONITOR 采样分析
+
+MONITOR 会把服务器执行的每条指令发送给客户端，繁忙的服务器上开销很大，
+因此采样有最长时间和最大字节数，任意一个用完时立即断开连接。
+指令流按行增量解析，每条指令的键名和指令名称分别计入 Count-Min 草图和 Space-Saving 统计，
+内存占用与指令数量无关
+"""
+import re
+import socket
+import threading
+import time
+
+from rmon.analysis.sketch import CountMinSketch, SpaceSaving
+from rmon.analysis.slowlog import split_command
+from rmon.metrics.engine import RespError, encode_command
+
+
+# 形如 +1339518083.107412 [0 127.0.0.1:60866] "keys" "*"
+LINE = re.compile(rb'^\+(\d+\.\d+) \[(\d+) ([^\]]*)\] (.*)$', re.S)
+ARG = re.compile(rb'"((?:[^"\\]|\\.)*)"', re.S)
+ESCAPE = re.compile(rb'\\(x[0-9a-fA-F]{2}|.)', re.S)
+ESCAPES = {b'n': b'\n', b'r': b'\r', b't': b'\t', b'a': b'\a', b'b': b'\b',
+           b'"': b'"', b'\\': b'\\'}
+
+
+def _unescape(match):
+    code = match.group(1)
+    if code[:1] == b'x' and len(code) == 3:
+        return bytes([int(code[1:], 16)])
+    return ESCAPES.get(code, code)
+
+
+def parse_monitor_line(line):
+    """解析 MONITOR 输出的一行
+
+    Returns:
+            tuple: (时间戳, 数据库, 客户端, 参数列表)，不是指令的行返回None
+    """
+    match = LINE.match(line)
+    if match is None:
+        return None
+    timestamp, db, client, rest = match.groups()
+    args = [ESCAPE.sub(_unescape, arg) if b'\\' in arg else arg for arg in ARG.findall(rest)]
+    if not args:
+        return None
+    return float(timestamp), int(db), client.decode('utf-8', 'replace'), args
+
+
+class MonitorSampler:
+    """MONITOR 采样任务，作为 rmon.analysis.jobs.Job 的任务运行
+    """
+
+    def __init__(self, server, duration=10, max_bytes=64 * 1024 * 1024, width=4096, depth=4,
+                 top=50, timeout=2):
+        """
+        Args:
+                server(Server): Redis服务器
+                duration(float): 最长采样时间(秒)
+                max_bytes(int): 最多读取的字节数
+                width(int): Count-Min 草图的宽度
+                depth(int): Count-Min 草图的行数
+                top(int): 保留的高频键和指令数量
+                timeout(float): 建立连接的超时时间(秒)
+        """
+        self.host = server.host
+        self.port = server.port
+        self.password = server.password
+        self.duration = duration
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.top = top
+        self.key_sketch = CountMinSketch(width, depth)
+        self.command_sketch = CountMinSketch(width, depth)
+        self.hot_keys = SpaceSaving(top)
+        self.hot_commands = SpaceSaving(top)
+        self.lines = 0
+        self.bytes = 0
+        self.elapsed = 0
+        self.stopped_by = None
+        self._lock = threading.Lock()
+
+    def run(self, stop):
+        """采样直到时间或字节数用完，或者stop被设置
+
+        Args:
+                stop(threading.Event): 停止信号
+        """
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        try:
+            if self.password:
+                sock.sendall(encode_command('AUTH', self.password))
+                reply = self._readline(sock)
+                if reply.startswith(b'-'):
+                    raise RespError(reply[1:].decode('utf-8', 'replace'))
+            sock.sendall(encode_command('MONITOR'))
+            self._sample(sock, stop)
+        finally:
+            sock.close()
+
+    @staticmethod
+    def _readline(sock):
+        data = b''
+        while not data.endswith(b'\r\n'):
+            chunk = sock.recv(1)
+            if not chunk:
+                raise ConnectionError('connection closed')
+            data += chunk
+        return data[:-2]
+
+    def _sample(self, sock, stop):
+        started = time.monotonic()
+        deadline = started + self.duration
+        buffer = b''
+        while True:
+            now = time.monotonic()
+            self.elapsed = now - started
+            if stop.is_set():
+                self.stopped_by = 'cancelled'
+                return
+            if now >= deadline:
+                self.stopped_by = 'duration'
+                return
+            if self.bytes >= self.max_bytes:
+                self.stopped_by = 'bytes'
+                return
+
+            # 超时时间较短，以便及时响应停止信号
+            sock.settimeout(min(deadline - now, 0.5))
+            try:
+                chunk = sock.recv(min(65536, self.max_bytes - self.bytes))
+            except socket.timeout:
+                continue
+            if not chunk:
+                raise ConnectionError('connection closed')
+            self.bytes += len(chunk)
+            lines = (buffer + chunk).split(b'\r\n')
+            buffer = lines.pop()
+            self.feed(lines)
+
+    def feed(self, lines):
+        """计入 MONITOR 输出的多行
+        """
+        with self._lock:
+            for line in lines:
+                if line.startswith(b'-'):
+                    raise RespError(line[1:].decode('utf-8', 'replace'))
+                parsed = parse_monitor_line(line)
+                if parsed is None:
+                    continue
+                self.lines += 1
+                parts, key = split_command(parsed[3])
+                command = ' '.join(parts)
+                self.command_sketch.add(command)
+                self.hot_commands.add(command)
+                if key is not None:
+                    self.key_sketch.add(key)
+                    self.hot_keys.add(key)
+
+    def estimate(self, keys):
+        """键的出现次数估计值，包括不在高频键中的键
+        """
+        with self._lock:
+            return {key: self.key_sketch.estimate(key) for key in keys}
+
+    def progress(self):
+        percent = max(self.elapsed / self.duration, self.bytes / self.max_bytes) * 100
+        return {
+            'lines': self.lines,
+            'bytes': self.bytes,
+            'elapsed': round(self.elapsed, 3),
+            'percent': 100 if self.stopped_by else round(min(percent, 99.9), 1),
+            'stopped_by': self.stopped_by,
+        }
+
+    def _items(self, space_saving, sketch, name):
+        elapsed = self.elapsed or None
+        return [{
+            name: item,
+            'count': count,
+            'error': error,
+            'estimate': sketch.estimate(item),
+            'rate': round(count / elapsed, 1) if elapsed else None,
+        } for item, count, error in space_saving.items()]
+
+    def result(self):
+        """高频键和指令，count 和 error 来自 Space-Saving，真实次数在 count-error 和 count 之间，
+        estimate 来自 Count-Min 草图，rate 为每秒次数
+        """
+        with self._lock:
+            return {
+                'commands': self._items(self.hot_commands, self.command_sketch, 'command'),
+                'keys': self._items(self.hot_keys, self.key_sketch, 'key'),
+                'keyed_commands': self.key_sketch.total,
+            }
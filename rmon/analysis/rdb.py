@@ -0,0 +1,478 @@
+"""rmon.analysis.rdb
+
+RDB 文件离线分析
+
+通过mmap按顺序读取RDB文件，每次只映射文件中固定大小的一段，读取位置超出该段时重新映射，
+每次只解析一个键，不在内存中保存值，内存占用与文件大小无关。
+值只需要跳过，ziplist、listpack、intset 等编码的值整体作为一个字符串保存，
+LZF 压缩的值不需要解压，只有压缩的键名需要解压。
+
+RDB 文件中没有内存占用信息，键的字节数为该键在文件中序列化后的大小，
+即 MEMORY USAGE 的近似值，可以用于比较键和前缀之间的相对大小
+"""
+import mmap
+import os
+import struct
+import time
+
+from rmon.analysis.report import KeyspaceReport
+
+
+class RdbError(Exception):
+    """RDB 文件格式错误或包含不支持的数据
+    """
+
+
+# 操作码
+OPCODE_SLOT_INFO = 0xF4
+OPCODE_FUNCTION2 = 0xF5
+OPCODE_MODULE_AUX = 0xF7
+OPCODE_IDLE = 0xF8
+OPCODE_FREQ = 0xF9
+OPCODE_AUX = 0xFA
+OPCODE_RESIZEDB = 0xFB
+OPCODE_EXPIRETIME_MS = 0xFC
+OPCODE_EXPIRETIME = 0xFD
+OPCODE_SELECTDB = 0xFE
+OPCODE_EOF = 0xFF
+
+# 值类型与 TYPE 指令返回的数据类型
+TYPES = {
+    0: 'string',
+    1: 'list',
+    2: 'set',
+    3: 'zset',
+    4: 'hash',
+    5: 'zset',
+    7: 'module',
+    9: 'hash',      # zipmap
+    10: 'list',     # ziplist
+    11: 'set',      # intset
+    12: 'zset',     # ziplist
+    13: 'hash',     # ziplist
+    14: 'list',     # quicklist
+    15: 'stream',
+    16: 'hash',     # listpack
+    17: 'zset',     # listpack
+    18: 'list',     # quicklist(listpack)
+    19: 'stream',
+    20: 'set',      # listpack
+    21: 'stream',
+}
+
+# 整个值为一个字符串的编码
+BLOB_TYPES = {0, 9, 10, 11, 12, 13, 16, 17, 20}
+
+# 特殊编码的字符串
+ENCODING_INT8 = 0
+ENCODING_INT16 = 1
+ENCODING_INT32 = 2
+ENCODING_LZF = 3
+
+# 模块数据的操作码
+MODULE_OPCODE_EOF = 0
+MODULE_OPCODE_SINT = 1
+MODULE_OPCODE_UINT = 2
+MODULE_OPCODE_FLOAT = 3
+MODULE_OPCODE_DOUBLE = 4
+MODULE_OPCODE_STRING = 5
+
+UINT32_BE = struct.Struct('>I')
+UINT64_BE = struct.Struct('>Q')
+INT_ENCODINGS = {
+    ENCODING_INT8: struct.Struct('<b'),
+    ENCODING_INT16: struct.Struct('<h'),
+    ENCODING_INT32: struct.Struct('<i'),
+}
+UINT32 = struct.Struct('<I')
+UINT64 = struct.Struct('<Q')
+
+# 每次映射的文件大小
+WINDOW_SIZE = 64 * 1024 * 1024
+
+
+def lzf_decompress(data, length):
+    """解压 LZF 压缩的数据
+
+    Args:
+            data(bytes): 压缩的数据
+            length(int): 解压后的长度
+    """
+    out = bytearray()
+    i = 0
+    while i < len(data):
+        ctrl = data[i]
+        i += 1
+        if ctrl < 32:
+            # 字面量
+            out += data[i:i + ctrl + 1]
+            i += ctrl + 1
+            continue
+        # 向前引用，引用的区域可能与输出重叠，需要逐字节复制
+        size = ctrl >> 5
+        if size == 7:
+            size += data[i]
+            i += 1
+        ref = len(out) - ((ctrl & 0x1f) << 8) - data[i] - 1
+        i += 1
+        if ref < 0:
+            raise RdbError('invalid lzf data')
+        for _ in range(size + 2):
+            out.append(out[ref])
+            ref += 1
+    if len(out) != length:
+        raise RdbError('invalid lzf data')
+    return bytes(out)
+
+
+class Entry:
+    """RDB 文件中的一个键
+    """
+    __slots__ = ('db', 'key', 'type', 'size', 'expire')
+
+    def __init__(self, db, key, type, size, expire):
+        self.db = db
+        self.key = key
+        self.type = type
+        self.size = size
+        self.expire = expire
+
+
+class RdbParser:
+    """流式 RDB 文件解析器
+
+    支持 RDB 版本 1 到 12 中 Redis 内置的数据类型以及 module 2 格式的模块数据
+    """
+
+    def __init__(self, path, window_size=WINDOW_SIZE):
+        self.path = path
+        self.window_size = window_size
+        self.version = None
+        self.aux = {}
+        self.position = 0
+        self.size = 0
+        self._file = None
+        self._mmap = None
+        # 当前映射的范围
+        self._start = 0
+        self._end = 0
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def open(self):
+        self._file = open(self.path, 'rb')
+        self.size = os.fstat(self._file.fileno()).st_size
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _view(self, length):
+        """保证从当前位置开始的length个字节已经映射，超出文件大小的部分不映射
+
+        Returns:
+                tuple: (映射, 当前位置在映射中的偏移)
+        """
+        position = self.position
+        if self._start <= position and position + length <= self._end:
+            return self._mmap, position - self._start
+        if position >= self.size:
+            raise RdbError('unexpected end of file at %d' % position)
+
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        start = position - position % mmap.ALLOCATIONGRANULARITY
+        end = min(max(start + self.window_size, position + length), self.size)
+        self._mmap = mmap.mmap(self._file.fileno(), end - start,
+                               access=mmap.ACCESS_READ, offset=start)
+        self._start, self._end = start, end
+        return self._mmap, position - start
+
+    def _read(self, length):
+        mm, offset = self._view(length)
+        self.position += length
+        return mm[offset:offset + length]
+
+    def entries(self):
+        """按顺序生成文件中的每个键
+
+        Yields:
+                Entry: 键，expire 为过期时间的毫秒时间戳，没有设置过期时间时为None
+        """
+        self.position = 0
+        header = self._read(9) if self.size >= 9 else b''
+        if header[:5] != b'REDIS':
+            raise RdbError('not a rdb file')
+        try:
+            self.version = int(header[5:9])
+        except ValueError:
+            raise RdbError('invalid rdb version')
+
+        try:
+            yield from self._entries()
+        except (IndexError, struct.error):
+            raise RdbError('unexpected end of file at %d' % self.position)
+
+    def _entries(self):
+        db = 0
+        expire = None
+        while True:
+            start = self.position
+            mm, offset = self._view(1)
+            opcode = mm[offset]
+            self.position += 1
+
+            if opcode == OPCODE_EOF:
+                return
+            elif opcode == OPCODE_SELECTDB:
+                db = self._length()
+            elif opcode == OPCODE_RESIZEDB:
+                self._length()
+                self._length()
+            elif opcode == OPCODE_AUX:
+                name = self._string()
+                self.aux[name.decode('utf-8', 'replace')] = self._string()
+            elif opcode == OPCODE_EXPIRETIME_MS:
+                expire, = UINT64.unpack(self._read(8))
+            elif opcode == OPCODE_EXPIRETIME:
+                expire = UINT32.unpack(self._read(4))[0] * 1000
+            elif opcode == OPCODE_FREQ:
+                self.position += 1
+            elif opcode == OPCODE_IDLE:
+                self._length()
+            elif opcode == OPCODE_MODULE_AUX:
+                self._length()
+                self._length()
+                self._length()
+                self._skip_module()
+            elif opcode == OPCODE_FUNCTION2:
+                self._skip_string()
+            elif opcode == OPCODE_SLOT_INFO:
+                self._length()
+                self._length()
+                self._length()
+            elif opcode in TYPES:
+                key = self._string()
+                self._skip_value(opcode)
+                yield Entry(db, key, TYPES[opcode], self.position - start, expire)
+                expire = None
+            else:
+                raise RdbError('unsupported rdb opcode %d at %d' % (opcode, start))
+
+    def _length(self):
+        """读取长度，特殊编码的字符串由 _string 处理
+        """
+        pos = self.position
+        offset = pos - self._start
+        if offset < 0 or pos + 9 > self._end:
+            offset = self._view(9)[1]
+        mm = self._mmap
+        byte = mm[offset]
+        kind = byte >> 6
+        if kind == 0:
+            self.position = pos + 1
+            return byte & 0x3f
+        if kind == 1:
+            self.position = pos + 2
+            return (byte & 0x3f) << 8 | mm[offset + 1]
+        if byte == 0x80:
+            self.position = pos + 5
+            return UINT32_BE.unpack_from(mm, offset + 1)[0]
+        if byte == 0x81:
+            self.position = pos + 9
+            return UINT64_BE.unpack_from(mm, offset + 1)[0]
+        raise RdbError('invalid length encoding at %d' % pos)
+
+    def _string(self):
+        """读取字符串，整数编码的字符串转换为十进制表示
+        """
+        mm, offset = self._view(1)
+        byte = mm[offset]
+        if byte >> 6 != 3:
+            length = self._length()
+            return self._read(length)
+
+        encoding = byte & 0x3f
+        self.position += 1
+        if encoding in INT_ENCODINGS:
+            codec = INT_ENCODINGS[encoding]
+            value, = codec.unpack(self._read(codec.size))
+            return str(value).encode('ascii')
+        if encoding == ENCODING_LZF:
+            compressed = self._length()
+            length = self._length()
+            return lzf_decompress(self._read(compressed), length)
+        raise RdbError('invalid string encoding %d' % encoding)
+
+    def _skip_string(self):
+        """跳过字符串，不复制也不映射数据
+        """
+        position = self.position
+        offset = position - self._start
+        if offset < 0 or position >= self._end:
+            offset = self._view(1)[1]
+        byte = self._mmap[offset]
+        if byte < 0x40:
+            self.position = position + 1 + byte
+            return
+        if byte >> 6 != 3:
+            # 先读取长度，长度本身会移动读取位置
+            length = self._length()
+            self.position += length
+            return
+
+        encoding = byte & 0x3f
+        self.position += 1
+        if encoding in INT_ENCODINGS:
+            self.position += INT_ENCODINGS[encoding].size
+        elif encoding == ENCODING_LZF:
+            compressed = self._length()
+            self._length()
+            self.position += compressed
+        else:
+            raise RdbError('invalid string encoding %d' % encoding)
+
+    def _skip_strings(self, count):
+        """跳过多个字符串，长度小于64的字符串不调用 _skip_string
+        """
+        for _ in range(count):
+            position = self.position
+            offset = position - self._start
+            if 0 <= offset and position < self._end:
+                byte = self._mmap[offset]
+                if byte < 0x40:
+                    self.position = position + 1 + byte
+                    continue
+            self._skip_string()
+
+    def _skip_double(self):
+        """跳过字符串形式的浮点数，253、254、255 分别表示 NaN、+inf、-inf
+        """
+        mm, offset = self._view(1)
+        length = mm[offset]
+        self.position += 1
+        if length < 253:
+            self.position += length
+
+    def _skip_value(self, type):
+        if type in BLOB_TYPES:
+            self._skip_string()
+        elif type in (1, 2, 14):
+            self._skip_strings(self._length())
+        elif type == 3:
+            for _ in range(self._length()):
+                self._skip_string()
+                self._skip_double()
+        elif type == 4:
+            self._skip_strings(self._length() * 2)
+        elif type == 5:
+            for _ in range(self._length()):
+                self._skip_string()
+                self.position += 8
+        elif type == 18:
+            for _ in range(self._length()):
+                # 节点容器类型: 1 为单个元素，2 为 listpack
+                self._length()
+                self._skip_string()
+        elif type in (15, 19, 21):
+            self._skip_stream(type)
+        elif type == 7:
+            self._length()
+            self._skip_module()
+        else:
+            raise RdbError('unsupported rdb type %d' % type)
+
+    def _skip_stream(self, type):
+        for _ in range(self._length()):
+            # 节点的起始id和 listpack
+            self._skip_string()
+            self._skip_string()
+        # 元素数量和最后一个id
+        for _ in range(3):
+            self._length()
+        if type >= 19:
+            # 第一个id、删除的最大id和添加过的元素数量
+            for _ in range(5):
+                self._length()
+
+        for _ in range(self._length()):
+            # 消费者组名称和最后一个id
+            self._skip_string()
+            self._length()
+            self._length()
+            if type >= 19:
+                self._length()
+            # 待确认列表: id(16字节)、投递时间(8字节)和投递次数
+            for _ in range(self._length()):
+                self.position += 24
+                self._length()
+            for _ in range(self._length()):
+                # 消费者名称、最后活动时间和待确认的id
+                self._skip_string()
+                self.position += 16 if type >= 21 else 8
+                pending = self._length()
+                self.position += pending * 16
+
+    def _skip_module(self):
+        while True:
+            opcode = self._length()
+            if opcode == MODULE_OPCODE_EOF:
+                return
+            if opcode in (MODULE_OPCODE_SINT, MODULE_OPCODE_UINT):
+                self._length()
+            elif opcode == MODULE_OPCODE_FLOAT:
+                self.position += 4
+            elif opcode == MODULE_OPCODE_DOUBLE:
+                self.position += 8
+            elif opcode == MODULE_OPCODE_STRING:
+                self._skip_string()
+            else:
+                raise RdbError('invalid module opcode %d' % opcode)
+
+
+def analyze_rdb(path, db=None, delimiter=':', depth=3, top=50, progress=None):
+    """分析 RDB 文件，生成与在线分析相同格式的结果
+
+    Args:
+            path(str): RDB 文件路径
+            db(int): 只分析指定的数据库，为None时分析所有数据库
+            delimiter(str): 键名前缀的分隔符
+            depth(int): 前缀树的最大层数
+            top(int): 保留最大的键的数量
+            progress(callable): 每分析10000个键调用一次，参数为已读取的字节数和文件大小
+
+    Returns:
+            dict: 分析结果
+    """
+    report = KeyspaceReport(delimiter, depth, top)
+    with RdbParser(path) as parser:
+        # 剩余过期时间相对于 RDB 文件的生成时间计算
+        now = None
+        for i, entry in enumerate(parser.entries(), 1):
+            if now is None:
+                ctime = parser.aux.get('ctime')
+                now = int(ctime) if ctime else time.time()
+            if db is not None and entry.db != db:
+                continue
+            ttl = None
+            if entry.expire is not None:
+                ttl = max(int(entry.expire / 1000 - now), 0)
+            report.add(entry.key.decode('utf-8', 'backslashreplace'), entry.type, entry.size, ttl)
+            if progress is not None and i % 10000 == 0:
+                progress(parser.position, parser.size)
+        if progress is not None:
+            progress(parser.position, parser.size)
+
+    result = report.to_dict()
+    result['version'] = parser.version
+    return result
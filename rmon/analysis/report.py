@@ -0,0 +1,185 @@
+"""rmon.analysis.report
+
+键空间分析结果的汇总，SCAN 分析和 RDB 文件分析共用
+"""
+import heapq
+
+
+OTHER = '<other>'
+
+
+class PrefixNode:
+    """前缀树的节点，保存该前缀下的键数量和字节数
+    """
+    __slots__ = ('keys', 'bytes', 'children')
+
+    def __init__(self):
+        self.keys = 0
+        self.bytes = 0
+        self.children = {}
+
+
+class PrefixTree:
+    """按分隔符切分键名的前缀树
+
+    键名 user:1000:name 依次计入 user、user:1000 两级前缀(depth=2)，
+    每个节点的子节点数量有上限，超过上限的前缀合并为 <other>，内存占用与键数量无关
+    """
+
+    def __init__(self, delimiter=':', depth=3, max_children=100):
+        self.delimiter = delimiter
+        self.depth = depth
+        self.max_children = max_children
+        self.root = PrefixNode()
+
+    def add(self, key, size):
+        node = self.root
+        node.keys += 1
+        node.bytes += size
+        parts = key.split(self.delimiter, self.depth)
+        # 最后一部分是键名剩余的部分，不作为前缀
+        for part in parts[:min(len(parts) - 1, self.depth)]:
+            child = node.children.get(part)
+            if child is None:
+                if len(node.children) >= self.max_children:
+                    part = OTHER
+                child = node.children.get(part)
+                if child is None:
+                    child = node.children[part] = PrefixNode()
+            child.keys += 1
+            child.bytes += size
+            node = child
+
+    def to_dict(self, node=None, prefix='', limit=20):
+        """按字节数从大到小输出每一级前缀，每级最多 limit 个
+        """
+        if node is None:
+            node = self.root
+        children = sorted(node.children.items(), key=lambda item: item[1].bytes, reverse=True)
+        result = []
+        for part, child in children[:limit]:
+            name = prefix + part
+            item = {'prefix': name, 'keys': child.keys, 'bytes': child.bytes}
+            if child.children:
+                item['children'] = self.to_dict(child, name + self.delimiter, limit)
+            result.append(item)
+        return result
+
+    def state(self, node=None):
+        """json兼容的完整状态，用于保存分析断点
+        """
+        if node is None:
+            node = self.root
+        return [node.keys, node.bytes,
+                {part: self.state(child) for part, child in node.children.items()}]
+
+    def restore(self, state, node=None):
+        """从 state 的结果恢复
+        """
+        if node is None:
+            node = self.root
+        node.keys, node.bytes, children = state
+        for part, child_state in children.items():
+            child = node.children[part] = PrefixNode()
+            self.restore(child_state, child)
+
+
+class TopK:
+    """流式保留最大的k个键
+    """
+
+    def __init__(self, k=50):
+        self.k = k
+        self._heap = []
+
+    def add(self, size, key, *extra):
+        item = (size, key) + extra
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, item)
+        elif size > self._heap[0][0]:
+            heapq.heapreplace(self._heap, item)
+
+    def items(self):
+        """从大到小排序的结果
+        """
+        return sorted(self._heap, reverse=True)
+
+    def state(self):
+        return [list(item) for item in self._heap]
+
+    def restore(self, state):
+        self._heap = [tuple(item) for item in state]
+        heapq.heapify(self._heap)
+
+
+class KeyspaceReport:
+    """键空间分析结果
+
+    汇总每种类型的键数量和字节数、设置了过期时间的键数量、键名前缀树以及最大的键
+    """
+
+    def __init__(self, delimiter=':', depth=3, top=50):
+        self.keys = 0
+        self.bytes = 0
+        self.expires = 0
+        self.types = {}
+        self.prefixes = PrefixTree(delimiter, depth)
+        self.largest = TopK(top)
+
+    def add(self, key, type, size, ttl=None):
+        """计入一个键
+
+        Args:
+                key(str): 键名
+                type(str): 数据类型
+                size(int): 占用的字节数，无法获取时为0
+                ttl(float): 剩余过期时间(秒)，没有设置过期时间时为None
+        """
+        self.keys += 1
+        self.bytes += size
+        if ttl is not None:
+            self.expires += 1
+        stats = self.types.get(type)
+        if stats is None:
+            stats = self.types[type] = {'keys': 0, 'bytes': 0}
+        stats['keys'] += 1
+        stats['bytes'] += size
+        self.prefixes.add(key, size)
+        self.largest.add(size, key, type, ttl)
+
+    def state(self):
+        """json兼容的完整状态，用于保存分析断点
+        """
+        return {
+            'keys': self.keys,
+            'bytes': self.bytes,
+            'expires': self.expires,
+            'types': self.types,
+            'delimiter': self.prefixes.delimiter,
+            'depth': self.prefixes.depth,
+            'top': self.largest.k,
+            'prefixes': self.prefixes.state(),
+            'largest': self.largest.state(),
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        report = cls(state['delimiter'], state['depth'], state['top'])
+        report.keys = state['keys']
+        report.bytes = state['bytes']
+        report.expires = state['expires']
+        report.types = state['types']
+        report.prefixes.restore(state['prefixes'])
+        report.largest.restore(state['largest'])
+        return report
+
+    def to_dict(self):
+        return {
+            'keys': self.keys,
+            'bytes': self.bytes,
+            'expires': self.expires,
+            'types': self.types,
+            'prefixes': self.prefixes.to_dict(),
+            'largest': [{'key': key, 'type': type, 'bytes': size, 'ttl': ttl}
+                        for size, key, type, ttl in self.largest.items()],
+        }
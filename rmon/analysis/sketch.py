@@ -0,0 +1,144 @@
+"""rmon.analysis.sketch
+
+流式频率统计
+
+CountMinSketch 以固定内存估计任意元素的出现次数，估计值不小于真实值，
+误差不超过 总数 x e / width 的概率为 1 - e^-depth；
+SpaceSaving 以固定内存保留出现次数最多的k个元素，每个元素的计数不小于真实值，
+超出部分不大于记录的误差
+"""
+import random
+
+
+class CountMinSketch:
+    """Count-Min 草图
+    """
+
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.total = 0
+        self._rows = [[0] * width for _ in range(depth)]
+        # 每一行使用不同的种子计算哈希
+        self._seeds = [random.getrandbits(32) for _ in range(depth)]
+
+    def _indexes(self, item):
+        width = self.width
+        return [hash((seed, item)) % width for seed in self._seeds]
+
+    def add(self, item, count=1):
+        self.total += count
+        for row, index in zip(self._rows, self._indexes(item)):
+            row[index] += count
+
+    def estimate(self, item):
+        """元素出现次数的估计值，不小于真实值
+        """
+        return min(row[index] for row, index in zip(self._rows, self._indexes(item)))
+
+
+class _Bucket:
+    """Stream-Summary 中计数相同的元素
+    """
+    __slots__ = ('count', 'items', 'prev', 'next')
+
+    def __init__(self, count):
+        self.count = count
+        self.items = set()
+        self.prev = None
+        self.next = None
+
+
+class SpaceSaving:
+    """Space-Saving 高频元素统计
+
+    最多保存k个元素，新元素在已满时替换计数最小的元素，并继承其计数作为误差。
+    元素按计数分组保存在按计数递增排列的双向链表(Stream-Summary)中，
+    链表头部即计数最小的元素，每次计数加1和替换最小元素的时间与k无关
+    """
+
+    def __init__(self, k=100):
+        self.k = k
+        self._head = None
+        self._buckets = {}
+        self._errors = {}
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def add(self, item, count=1):
+        bucket = self._buckets.get(item)
+        if bucket is not None:
+            self._move(item, bucket, bucket.count + count)
+            return
+        if len(self._buckets) < self.k:
+            self._errors[item] = 0
+            self._insert(item, count)
+            return
+        # 替换计数最小的元素，新元素先放入最小元素所在的组再增加计数
+        head = self._head
+        evicted = head.items.pop()
+        del self._buckets[evicted]
+        del self._errors[evicted]
+        head.items.add(item)
+        self._buckets[item] = head
+        self._errors[item] = head.count
+        self._move(item, head, head.count + count)
+
+    def _insert(self, item, count):
+        """加入新元素，新元素的计数通常很小，从链表头部开始查找位置
+        """
+        if self._head is None or self._head.count > count:
+            bucket = _Bucket(count)
+            bucket.next = self._head
+            if self._head is not None:
+                self._head.prev = bucket
+            self._head = bucket
+        else:
+            node = self._head
+            while node.next is not None and node.next.count <= count:
+                node = node.next
+            bucket = node if node.count == count else self._link_after(node, count)
+        bucket.items.add(item)
+        self._buckets[item] = bucket
+
+    def _move(self, item, bucket, count):
+        """将元素移动到计数为count的组，count大于元素当前的计数
+        """
+        node = bucket
+        while node.next is not None and node.next.count <= count:
+            node = node.next
+        target = node if node.count == count else self._link_after(node, count)
+        bucket.items.remove(item)
+        target.items.add(item)
+        self._buckets[item] = target
+        if not bucket.items:
+            self._unlink(bucket)
+
+    @staticmethod
+    def _link_after(node, count):
+        bucket = _Bucket(count)
+        bucket.prev = node
+        bucket.next = node.next
+        if node.next is not None:
+            node.next.prev = bucket
+        node.next = bucket
+        return bucket
+
+    def _unlink(self, bucket):
+        if bucket.prev is None:
+            self._head = bucket.next
+        else:
+            bucket.prev.next = bucket.next
+        if bucket.next is not None:
+            bucket.next.prev = bucket.prev
+
+    def items(self, limit=None):
+        """按计数从大到小排列的元素
+
+        Returns:
+                list: (元素, 计数, 误差)，真实次数在 计数-误差 和 计数 之间
+        """
+        items = sorted(((item, bucket.count) for item, bucket in self._buckets.items()),
+                       key=lambda item: item[1], reverse=True)
+        return [(item, count, self._errors[item]) for item, count in items[:limit]]
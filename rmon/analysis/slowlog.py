@@ -0,0 +1,406 @@
+"""rmon.analysis.slowlog
+
+慢查询日志采集和按指令签名汇总
+
+定时对每个服务器执行 SLOWLOG GET，根据日志id只保留上一次之后的新日志，
+每条日志归一化为指令签名(指令名称和键名模式，去掉其他参数)，
+每个签名按时间分桶保存耗时直方图，查询时合并指定时间范围内的桶
+"""
+import logging
+import re
+import threading
+import time
+from collections import namedtuple
+
+from rmon.metrics.histogram import LogHistogram
+
+
+logger = logging.getLogger(__name__)
+
+SlowlogEntry = namedtuple('SlowlogEntry', ['id', 'timestamp', 'duration', 'args'])
+
+OTHER = '<other>'
+
+# 没有键名参数的指令
+NO_KEY_COMMANDS = {
+    'PING', 'ECHO', 'INFO', 'DBSIZE', 'TIME', 'LASTSAVE', 'SAVE', 'BGSAVE', 'BGREWRITEAOF',
+    'FLUSHDB', 'FLUSHALL', 'KEYS', 'SCAN', 'RANDOMKEY', 'SELECT', 'AUTH', 'MULTI', 'EXEC',
+    'DISCARD', 'UNWATCH', 'PUBLISH', 'SUBSCRIBE', 'PSUBSCRIBE', 'UNSUBSCRIBE',
+    'PUNSUBSCRIBE', 'MONITOR', 'SYNC', 'PSYNC', 'REPLCONF', 'SLAVEOF', 'REPLICAOF',
+    'SHUTDOWN', 'WAIT', 'SWAPDB', 'QUIT', 'HELLO', 'RESET', 'FAILOVER', 'ROLE', 'LOLWUT',
+}
+
+# 第一个参数为子指令的指令，值为带键名参数的子指令
+SUBCOMMANDS = {
+    'CONFIG': set(),
+    'CLIENT': set(),
+    'CLUSTER': set(),
+    'SCRIPT': set(),
+    'SLOWLOG': set(),
+    'LATENCY': set(),
+    'COMMAND': set(),
+    'DEBUG': {'OBJECT'},
+    'MEMORY': {'USAGE'},
+    'OBJECT': {'ENCODING', 'FREQ', 'IDLETIME', 'REFCOUNT'},
+    'XGROUP': {'CREATE', 'CREATECONSUMER', 'DELCONSUMER', 'DESTROY', 'SETID'},
+    'XINFO': {'CONSUMERS', 'GROUPS', 'STREAM'},
+    'ACL': set(),
+    'MODULE': set(),
+    'PUBSUB': set(),
+    'FUNCTION': set(),
+}
+
+# 键名中的分隔符
+DELIMITERS = re.compile(r'([:./|#{}\[\]=,@ ]+)')
+# 十六进制id、uuid 等
+HEX_ID = re.compile(r'^(?=.*\d)[0-9a-fA-F-]{8,}$')
+DIGITS = re.compile(r'\d+')
+
+
+def key_pattern(key):
+    """将键名中的数字和十六进制id替换为*
+
+    user:1000:name 和 user:1001:name 的模式都为 user:*:name，
+    session:9f86d081884c7d65 的模式为 session:*
+    """
+    parts = DELIMITERS.split(key)
+    for i in range(0, len(parts), 2):
+        part = parts[i]
+        if HEX_ID.match(part):
+            parts[i] = '*'
+        elif part:
+            parts[i] = DIGITS.sub('*', part)
+    return ''.join(parts)
+
+
+def split_command(args):
+    """将指令拆分为指令名称部分和键名
+
+    Args:
+            args(list): 指令和参数
+
+    Returns:
+            tuple: (指令名称部分的列表, 键名)，如 (['MEMORY', 'USAGE'], 'user:1')，没有键名时为None
+    """
+    args = [arg.decode('utf-8', 'backslashreplace') if isinstance(arg, bytes) else str(arg)
+            for arg in args]
+    command = args[0].upper()
+    parts = [command]
+    key = None
+
+    if command in SUBCOMMANDS and len(args) > 1:
+        subcommand = args[1].upper()
+        parts.append(subcommand)
+        if subcommand in SUBCOMMANDS[command] and len(args) > 2:
+            key = args[2]
+    elif command in ('EVAL', 'EVALSHA', 'EVAL_RO', 'EVALSHA_RO', 'FCALL', 'FCALL_RO'):
+        # 脚本内容不计入签名，EVALSHA 和 FCALL 保留脚本的标识
+        if command != 'EVAL' and command != 'EVAL_RO' and len(args) > 1:
+            parts.append(args[1][:12])
+        if len(args) > 3 and args[2].isdigit() and int(args[2]) > 0:
+            key = args[3]
+    elif command == 'BITOP' and len(args) > 2:
+        parts.append(args[1].upper())
+        key = args[2]
+    elif command not in NO_KEY_COMMANDS and len(args) > 1:
+        key = args[1]
+    return parts, key
+
+
+def signature(args):
+    """慢查询的指令签名
+
+    Args:
+            args(list): 慢查询日志中的指令和参数
+
+    Returns:
+            str: 如 HGETALL user:*、CONFIG GET、EVALSHA 0f3b2a1c user:*
+    """
+    if not args:
+        return ''
+    parts, key = split_command(args)
+    if key is not None:
+        parts.append(key_pattern(key))
+    return ' '.join(parts)
+
+
+def parse_entry(entry):
+    """解析 SLOWLOG GET 返回的一条日志
+
+    每条日志为 [id, 时间戳, 耗时(微秒), 参数列表, 客户端地址, 客户端名称]，
+    Redis 4.0 以下没有最后两项
+    """
+    return SlowlogEntry(int(entry[0]), int(entry[1]), int(entry[2]), list(entry[3]))
+
+
+class SlowlogAggregator:
+    """单个服务器的慢查询汇总
+
+    按日志的时间戳每 bucket 秒一个桶，每个桶保存每个签名的耗时直方图，超过保留时间的桶被删除。
+    签名数量有上限，超过上限的签名合并为 <other>
+    """
+
+    def __init__(self, bucket=60, retention=86400, max_signatures=1000):
+        self.bucket = bucket
+        self.retention = retention
+        self.max_signatures = max_signatures
+        # 已处理的最大日志id
+        self.last_id = None
+        # 下一次 SLOWLOG GET 获取的数量
+        self.fetch_size = None
+        self.collected_at = None
+        self._buckets = {}
+        # 签名 -> (最近一次的时间戳, 最近一次的指令)
+        self._examples = {}
+        self.lock = threading.Lock()
+
+    def new_entries(self, entries):
+        """过滤掉已经处理过的日志
+
+        Args:
+                entries(list): SLOWLOG GET 的结果，从新到旧排列
+
+        Returns:
+                list: 新日志
+        """
+        if self.last_id is None or not entries:
+            return entries
+        if entries[0].id < self.last_id:
+            # 日志id变小说明服务器重启过
+            return entries
+        return [entry for entry in entries if entry.id > self.last_id]
+
+    def add(self, entries, now=None):
+        """计入新日志并删除过期的桶
+        """
+        if now is None:
+            now = time.time()
+        if entries:
+            self.last_id = max(entry.id for entry in entries)
+        oldest = now - self.retention
+        for entry in entries:
+            if entry.timestamp < oldest:
+                continue
+            sig = signature(entry.args)
+            if sig not in self._examples and len(self._examples) >= self.max_signatures:
+                sig = OTHER
+            example = self._examples.get(sig)
+            if example is None or entry.timestamp >= example[0]:
+                self._examples[sig] = (entry.timestamp, self._format(entry.args))
+
+            start = entry.timestamp - entry.timestamp % self.bucket
+            stats = self._buckets.get(start)
+            if stats is None:
+                stats = self._buckets[start] = {}
+            histogram = stats.get(sig)
+            if histogram is None:
+                histogram = stats[sig] = LogHistogram()
+            histogram.add(entry.duration)
+        self.expire(now)
+
+    def expire(self, now):
+        oldest = now - self.retention
+        expired = [start for start in self._buckets if start + self.bucket <= oldest]
+        for start in expired:
+            del self._buckets[start]
+        if expired:
+            alive = set()
+            for stats in self._buckets.values():
+                alive.update(stats)
+            self._examples = {sig: example for sig, example in self._examples.items()
+                              if sig in alive}
+
+    @staticmethod
+    def _format(args, limit=200):
+        text = ' '.join(arg.decode('utf-8', 'backslashreplace') if isinstance(arg, bytes)
+                        else str(arg) for arg in args)
+        return text if len(text) <= limit else text[:limit] + '...'
+
+    def top(self, window, limit=20, sort='total', now=None):
+        """时间范围内的慢查询签名排行
+
+        Args:
+                window(int): 最近多少秒
+                limit(int): 最多返回的签名数量
+                sort(str): 排序字段，total、count、max 或 p99
+
+        Returns:
+                list: 每个签名的数量、总耗时、平均耗时、最大耗时和分位数，耗时单位为微秒
+        """
+        if now is None:
+            now = time.time()
+        since = now - window
+        merged = {}
+        for start, stats in self._buckets.items():
+            if start + self.bucket <= since:
+                continue
+            for sig, histogram in stats.items():
+                total = merged.get(sig)
+                if total is None:
+                    total = merged[sig] = LogHistogram()
+                total.merge(histogram)
+
+        rows = []
+        for sig, histogram in merged.items():
+            p50, p99, p999 = histogram.quantiles(0.5, 0.99, 0.999)
+            last_seen, example = self._examples.get(sig, (None, None))
+            rows.append({
+                'signature': sig,
+                'count': histogram.count,
+                'total': histogram.total,
+                'mean': round(histogram.mean, 1),
+                'max': histogram.max,
+                'p50': round(p50, 1),
+                'p99': round(p99, 1),
+                'p999': round(p999, 1),
+                'last_seen': last_seen,
+                'example': example,
+            })
+        rows.sort(key=lambda row: row[sort], reverse=True)
+        return rows[:limit]
+
+
+class SlowlogCollector:
+    """慢查询日志采集器
+
+    SLOWLOG_COLLECTOR_ENABLED 为 True 时在后台线程中定时采集所有服务器，
+    否则在请求慢查询汇总时采集该服务器。
+
+    每次采集的数量根据上一次的新日志数量调整：新日志很少时只获取少量日志，
+    获取的日志全部是新日志时说明可能还有遗漏，加倍数量重新获取，直到 SLOWLOG_FETCH_MAX
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.interval = 60
+        self.fetch_min = 16
+        self.fetch_max = 1024
+        self.bucket = 60
+        self.retention = 86400
+        self.max_signatures = 1000
+        self._aggregators = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """从app配置中读取采集参数，如果开启了采集则在处理第一个请求前启动后台线程
+        """
+        self.app = app
+        self.interval = app.config.get('SLOWLOG_COLLECT_INTERVAL', self.interval)
+        self.fetch_max = app.config.get('SLOWLOG_FETCH_MAX', self.fetch_max)
+        self.bucket = app.config.get('SLOWLOG_BUCKET', self.bucket)
+        self.retention = app.config.get('SLOWLOG_RETENTION', self.retention)
+        self.max_signatures = app.config.get('SLOWLOG_MAX_SIGNATURES', self.max_signatures)
+        app.extensions['slowlog_collector'] = self
+
+        if app.config.get('SLOWLOG_COLLECTOR_ENABLED', False):
+            app.before_first_request(self.start)
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """启动后台采集线程
+        """
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='rmon-slowlog', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            started = time.monotonic()
+            try:
+                with self.app.app_context():
+                    self.collect()
+            except Exception:
+                logger.exception('slowlog collection failed')
+            elapsed = time.monotonic() - started
+            self._stop.wait(max(self.interval - elapsed, 0))
+
+    def collect(self):
+        """采集所有服务器的慢查询日志，需要在app context中调用
+        """
+        from rmon.extensions import collector, fanout
+
+        servers = collector.servers()
+        results = fanout.map(self.poll, servers)
+        for ok, result in results:
+            if not ok:
+                logger.warning(result)
+        alive = {server.id for server in servers}
+        with self._lock:
+            for server_id in [key for key in self._aggregators if key not in alive]:
+                del self._aggregators[server_id]
+
+    def aggregator(self, server_id):
+        with self._lock:
+            aggregator = self._aggregators.get(server_id)
+            if aggregator is None:
+                aggregator = self._aggregators[server_id] = SlowlogAggregator(
+                    self.bucket, self.retention, self.max_signatures)
+            return aggregator
+
+    def poll(self, server):
+        """获取服务器的新慢查询日志
+
+        Returns:
+                int: 新日志数量
+        """
+        aggregator = self.aggregator(server.id)
+        with aggregator.lock:
+            size = aggregator.fetch_size or self.fetch_max
+            while True:
+                entries = [parse_entry(entry) for entry in
+                           server.redis.execute_command('SLOWLOG', 'GET', size)]
+                new = aggregator.new_entries(entries)
+                if (aggregator.last_id is not None and len(new) == len(entries) == size
+                        and size < self.fetch_max):
+                    # 获取到的全部是新日志，更早的新日志可能没有获取到
+                    size = min(size * 2, self.fetch_max)
+                    continue
+                break
+            if aggregator.last_id is not None and len(new) == size == self.fetch_max:
+                logger.warning('slowlog of redis server %s grows faster than collected, '
+                               'some entries may be missed', server.host)
+
+            aggregator.add(new)
+            aggregator.collected_at = time.time()
+            aggregator.fetch_size = max(self.fetch_min, min(len(new) * 2, self.fetch_max))
+        return len(new)
+
+    def top(self, server_id, window, limit=20, sort='total'):
+        aggregator = self.aggregator(server_id)
+        with aggregator.lock:
+            return {
+                'collected_at': aggregator.collected_at,
+                'last_id': aggregator.last_id,
+                'signatures': aggregator.top(window, limit, sort),
+            }
+
+    def fresh(self, server_id):
+        """服务器在一个采集周期内是否采集过
+        """
+        aggregator = self._aggregators.get(server_id)
+        return (aggregator is not None and aggregator.collected_at is not None
+                and time.time() - aggregator.collected_at < self.interval)
+
+    def forget(self, server_id):
+        with self._lock:
+            self._aggregators.pop(server_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._aggregators.clear()
@@ -5,12 +5,18 @@ import os
 from flask import Flask
 
 from rmon.config import DevConfig, ProductConfig
-from rmon.extensions import db
+from rmon.extensions import (db, redis_pools, collector, fanout, metrics_cache,
+                             metric_store, metrics_snapshot, token_cache, json_encoder,
+                             server_registry, analysis_jobs, slowlog_collector,
+                             latency_prober)
 from rmon.views import api
 
-def create_app():
+def create_app(**config):
 	"""创建并初始化 Flask app
 	主要三个事情：1.创建app对象 2.读取配置 3. 初始化扩展和注册蓝图 
+
+	Args:
+		config: 覆盖配置文件的配置项，例如采集进程中关闭内置的采集器
 	"""
 
 	#创建app对象
@@ -28,13 +34,29 @@ def create_app():
 	app.config.from_envvar('RMON_SETTINGS', silent=True)
 
 	app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+	app.config.update(config)
 
 	#注册 Blueprint
 	app.register_blueprint(api)
 	#初始化数据库(扩展)
 	db.init_app(app)
+	redis_pools.init_app(app)
+	fanout.init_app(app)
+	metrics_cache.init_app(app)
+	metric_store.init_app(app)
+	metrics_snapshot.init_app(app)
+	token_cache.init_app(app)
+	json_encoder.init_app(app)
+	server_registry.init_app(app)
+	analysis_jobs.init_app(app)
 	# 如果是开发环境则创建所有数据库表
 	if app.debug:
 		with app.app_context():
 			db.create_all()
+	# 监控信息采集器使用上面初始化的磁盘存储、快照和json序列化扩展，
+	# 开启的采集器在处理第一个请求前启动，flask 命令行不会启动
+	collector.init_app(app)
+	# 慢查询采集器和延迟探测器只处理监控信息采集器负责的服务器
+	slowlog_collector.init_app(app)
+	latency_prober.init_app(app)
 	return app
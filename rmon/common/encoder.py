@@ -0,0 +1,92 @@
+"""rmon.common.encoder
+
+API响应的json序列化，安装了 orjson 或 ujson 时优先使用，否则使用标准库json，
+序列化结果直接为bytes，避免再次编码
+"""
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None
+
+
+ENCODERS = ('auto', 'orjson', 'ujson', 'json')
+
+
+def default(obj):
+    """序列化标准json不支持的类型，日期时间与 ServerSchema 一样使用ISO格式
+    """
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, (bytes, bytearray)):
+        return obj.decode('utf-8', 'replace')
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError('%r is not JSON serializable' % obj)
+
+
+def _orjson_dumps(data):
+    return orjson.dumps(data, default=default, option=orjson.OPT_NON_STR_KEYS)
+
+
+def _ujson_dumps(data):
+    return ujson.dumps(data, ensure_ascii=False, default=default).encode('utf-8')
+
+
+_json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=default)
+
+
+def _json_dumps(data):
+    return _json_encoder.encode(data).encode('utf-8')
+
+
+def get_dumps(name='auto'):
+    """获取序列化函数
+
+    Args:
+            name(str): auto、orjson、ujson 或 json，auto 时按 orjson、ujson、json 的顺序选择
+
+    Returns:
+            tuple: (实际使用的序列化库名称, 序列化函数)
+    """
+    if name not in ENCODERS:
+        raise ValueError('unknown json encoder %s' % name)
+    if name in ('auto', 'orjson') and orjson is not None:
+        return 'orjson', _orjson_dumps
+    if name in ('auto', 'ujson') and ujson is not None:
+        return 'ujson', _ujson_dumps
+    if name not in ('auto', 'json'):
+        raise ValueError('json encoder %s not installed' % name)
+    return 'json', _json_dumps
+
+
+class ResponseEncoder:
+    """API响应序列化扩展
+
+    通过配置 JSON_RESPONSE_ENCODER 选择序列化库
+    """
+
+    def __init__(self, app=None):
+        self.name, self._dumps = get_dumps()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.name, self._dumps = get_dumps(app.config.get('JSON_RESPONSE_ENCODER', 'auto'))
+        app.extensions['json_encoder'] = self
+
+    def dumps(self, data):
+        """序列化为bytes
+        """
+        return self._dumps(data)
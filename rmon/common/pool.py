@@ -0,0 +1,173 @@
+"""rmon.common.pool
+
+进程内Redis连接池注册表，每个Redis服务器复用同一个连接池，避免每次访问都重新建立TCP连接和AUTH认证
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from redis import StrictRedis, BlockingConnectionPool
+
+
+class TrackedConnectionPool(BlockingConnectionPool):
+    """记录借出的连接数量和最近一次使用时间的连接池
+
+    StrictRedis对象和管道执行指令时都通过 get_connection 和 release 借出和归还连接，
+    长期持有StrictRedis对象的调用者(例如键空间分析)不需要额外通知注册表
+    """
+
+    def reset(self):
+        # fork后的子进程中重新计数
+        self._usage_lock = threading.Lock()
+        self.in_use = 0
+        self.used = time.monotonic()
+        super().reset()
+
+    def get_connection(self, command_name, *keys, **options):
+        connection = super().get_connection(command_name, *keys, **options)
+        with self._usage_lock:
+            self.in_use += 1
+            self.used = time.monotonic()
+        return connection
+
+    def release(self, connection):
+        if connection.pid == self.pid:
+            with self._usage_lock:
+                self.in_use -= 1
+                self.used = time.monotonic()
+        super().release(connection)
+
+    def idle(self, now, timeout):
+        """没有借出的连接并且超过timeout秒未使用
+        """
+        return self.in_use == 0 and now - self.used > timeout
+
+
+class RedisPoolRegistry:
+    """Redis连接池注册表
+
+    以服务器id为索引保存连接池，连接池同时记录服务器的host、port、password，
+    当服务器信息发生变化时自动重建连接池，没有借出的连接并且长时间未使用的连接池会被回收。
+    尚未保存的服务器没有id，只能通过 temporary 使用临时连接
+    """
+
+    def __init__(self, app=None):
+        self._pools = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+
+        self.max_connections = 10
+        self.socket_timeout = 5
+        self.socket_connect_timeout = 2
+        self.pool_timeout = 5
+        self.idle_timeout = 300
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """从app配置中读取连接池参数
+        """
+        config = app.config
+        self.max_connections = config.get('REDIS_MAX_CONNECTIONS', self.max_connections)
+        self.socket_timeout = config.get('REDIS_SOCKET_TIMEOUT', self.socket_timeout)
+        self.socket_connect_timeout = config.get(
+            'REDIS_SOCKET_CONNECT_TIMEOUT', self.socket_connect_timeout)
+        self.pool_timeout = config.get('REDIS_POOL_TIMEOUT', self.pool_timeout)
+        self.idle_timeout = config.get('REDIS_POOL_IDLE_TIMEOUT', self.idle_timeout)
+        app.extensions['redis_pools'] = self
+
+    @staticmethod
+    def make_key(server):
+        """连接池索引，服务器地址或密码变化后索引随之变化
+        """
+        return (server.id, server.host, server.port, server.password)
+
+    def _create_pool(self, server):
+        return TrackedConnectionPool(
+            host=server.host, port=server.port, password=server.password,
+            max_connections=self.max_connections,
+            timeout=self.pool_timeout,
+            socket_timeout=self.socket_timeout,
+            socket_connect_timeout=self.socket_connect_timeout)
+
+    def get(self, server):
+        """获取服务器对应的StrictRedis对象
+
+        Args:
+                server(Server): Redis服务器记录
+
+        Returns:
+                object: 共享连接池的StrictRedis对象
+
+        Raises:
+                ValueError: 服务器尚未保存
+        """
+        # 不进入注册表的连接池不会被回收，尚未保存的服务器需要使用 temporary
+        if server.id is None:
+            raise ValueError('server is not saved, use a temporary connection')
+
+        key = self.make_key(server)
+        now = time.monotonic()
+        stale = []
+
+        with self._lock:
+            entry = self._pools.get(server.id)
+            # 服务器信息已经改变，原有连接池失效
+            if entry is not None and entry[0] != key:
+                stale.append(entry[1])
+                entry = None
+
+            if entry is None:
+                pool = self._create_pool(server)
+                self._pools[server.id] = (key, pool)
+            else:
+                pool = entry[1]
+            pool.used = now
+
+            if self.idle_timeout and now - self._last_sweep > self.idle_timeout:
+                stale.extend(self._sweep(now))
+
+        for old in stale:
+            old.disconnect()
+        return StrictRedis(connection_pool=pool)
+
+    @contextmanager
+    def temporary(self, server):
+        """不进入注册表的临时StrictRedis对象，使用后断开连接
+
+        用于检查尚未保存或连接信息尚未生效的服务器
+        """
+        pool = self._create_pool(server)
+        try:
+            yield StrictRedis(connection_pool=pool)
+        finally:
+            pool.disconnect()
+
+    def _sweep(self, now):
+        """回收没有借出的连接并且长时间未使用的连接池，调用者需持有锁
+        """
+        self._last_sweep = now
+        expired = [server_id for server_id, (_, pool) in self._pools.items()
+                   if pool.idle(now, self.idle_timeout)]
+        return [self._pools.pop(server_id)[1] for server_id in expired]
+
+    def invalidate(self, server_id):
+        """服务器被更新或删除时，关闭并移除其连接池
+        """
+        with self._lock:
+            entry = self._pools.pop(server_id, None)
+        if entry is not None:
+            entry[1].disconnect()
+
+    def clear(self):
+        """关闭所有连接池
+        """
+        with self._lock:
+            entries = list(self._pools.values())
+            self._pools.clear()
+        for entry in entries:
+            entry[1].disconnect()
+
+    def __len__(self):
+        return len(self._pools)
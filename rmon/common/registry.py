@@ -0,0 +1,141 @@
+"""rmon.common.registry
+
+Redis服务器的进程内索引，避免每次请求都查询数据库
+"""
+import threading
+
+from rmon.common.version import VersionFile
+
+
+class ServerRegistry:
+    """按id和名称索引的服务器缓存
+
+    第一次访问时从数据库加载全部服务器，之后通过 Server.save、Server.delete 同步更新。
+    多个进程之间通过版本文件中的计数器判断数据是否被其他进程修改，
+    计数器变化时重新加载，SERVER_REGISTRY_VERSION_FILE 为空时只在当前进程内同步。
+    修改时复制索引后整体替换，读取时不需要加锁。
+
+    缓存中的服务器对象不属于任何数据库会话，只能读取，修改服务器时需要查询数据库
+    """
+
+    def __init__(self, app=None):
+        self.version_file = None
+        # (id索引, 名称索引)，未加载时为None
+        self._indexes = None
+        self._version = None
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """从app配置中读取版本文件路径
+        """
+        path = app.config.get('SERVER_REGISTRY_VERSION_FILE')
+        self.version_file = VersionFile(path) if path else None
+        app.extensions['server_registry'] = self
+
+    def _file_version(self):
+        if self.version_file is None:
+            return None
+        return self.version_file.read()
+
+    def _ensure(self):
+        """未加载或其他进程修改了服务器时重新加载
+
+        Returns:
+                tuple: (id索引, 名称索引)
+        """
+        version = self._file_version()
+        indexes = self._indexes
+        if indexes is not None and version == self._version:
+            return indexes
+        with self._lock:
+            if self._indexes is None or version != self._version:
+                self._load(version)
+            return self._indexes
+
+    def _load(self, version):
+        from rmon.models.server import Server, SERVER_COLUMNS
+
+        rows = Server.query.with_entities(
+            *[getattr(Server, column) for column in SERVER_COLUMNS]).all()
+        servers = {}
+        for row in rows:
+            server = Server(**dict(zip(SERVER_COLUMNS, row)))
+            servers[server.id] = server
+        names = {server.name: server for server in servers.values()}
+        self._indexes = (servers, names)
+        self._version = version
+
+    @staticmethod
+    def snapshot(server):
+        """复制服务器的列，缓存中不保存数据库会话中的对象
+        """
+        from rmon.models.server import Server, SERVER_COLUMNS
+
+        return Server(**{column: getattr(server, column) for column in SERVER_COLUMNS})
+
+    def get(self, server_id):
+        """根据id获取服务器，不存在时返回None
+        """
+        servers, _ = self._ensure()
+        return servers.get(server_id)
+
+    def find(self, name):
+        """根据名称获取服务器，不存在时返回None
+        """
+        _, names = self._ensure()
+        return names.get(name)
+
+    def all(self):
+        """按id排序的所有服务器
+        """
+        servers, _ = self._ensure()
+        return [server for _, server in sorted(servers.items())]
+
+    def put(self, server):
+        """服务器创建或更新后同步到缓存
+        """
+        snapshot = self.snapshot(server)
+        with self._lock:
+            if self._indexes is not None:
+                servers, names = dict(self._indexes[0]), dict(self._indexes[1])
+                previous = servers.get(snapshot.id)
+                if previous is not None:
+                    names.pop(previous.name, None)
+                servers[snapshot.id] = snapshot
+                names[snapshot.name] = snapshot
+                self._indexes = (servers, names)
+            self._touch()
+
+    def remove(self, server_id):
+        """服务器删除后同步到缓存
+        """
+        with self._lock:
+            if self._indexes is not None:
+                servers, names = dict(self._indexes[0]), dict(self._indexes[1])
+                server = servers.pop(server_id, None)
+                if server is not None:
+                    names.pop(server.name, None)
+                self._indexes = (servers, names)
+            self._touch()
+
+    def _touch(self):
+        """递增版本文件中的计数器，通知其他进程重新加载，调用者需持有锁
+
+        版本文件在本进程上次加载后没有被其他进程修改时，本进程的缓存仍是最新的，
+        不需要重新加载
+        """
+        if self.version_file is None:
+            return
+        previous, version = self.version_file.bump()
+        if previous == self._version:
+            self._version = version
+
+    def clear(self):
+        """清空缓存，下一次访问时重新加载
+        """
+        with self._lock:
+            self._indexes = None
+            self._version = None
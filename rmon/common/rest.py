@@ -1,21 +1,133 @@
 """rmon.common.rest
 """
-from collections import Mapping
-from flask import request, make_response
-from flask.json import dumps
+import gzip
+import hashlib
+from collections.abc import Mapping
+from flask import request, current_app
 from flask.views import MethodView
 from rmon.common.errors import RestError
+from rmon.extensions import json_encoder
 
 from werkzeug.wrappers import Response
 
 
+class NotModified(Exception):
+    """客户端缓存的响应仍然有效，由 RestView.check_etag 抛出
+    """
+
+
 class RestView(MethodView):
     """自定义View类，所有API均继承自该类
 
-    json序列化，异常处理，装饰器支持
+    json序列化，异常处理，装饰器支持，ETag条件请求和gzip压缩
     """
     content_type = 'application/json; charset=utf-8'
     method_decorators = []
+    etag = None
+
+    @classmethod
+    def handler(cls, method):
+        """获取经过装饰器包装的视图方法
+
+        装饰器包装的是未绑定的函数，调用时需要传入视图对象，
+        每个视图类的每个HTTP方法只包装一次，之后的请求直接复用
+
+        Args:
+                method(str): 小写的HTTP方法名称
+
+        Returns:
+                function: 包装后的函数，视图类没有实现该方法时返回None
+        """
+        # 只使用当前类自己的缓存，避免子类复用父类的包装结果
+        handlers = cls.__dict__.get('_handlers')
+        if handlers is None:
+            handlers = {}
+            setattr(cls, '_handlers', handlers)
+
+        try:
+            return handlers[method]
+        except KeyError:
+            pass
+
+        func = getattr(cls, method, None)
+        if func is not None:
+            # HTTP 请求方法定义了不同的装饰器
+            if isinstance(cls.method_decorators, Mapping):
+                decorators = cls.method_decorators.get(method, [])
+            else:
+                decorators = cls.method_decorators
+            for decorator in decorators:
+                func = decorator(func)
+        handlers[method] = func
+        return func
+
+    @classmethod
+    def as_view(cls, name, *class_args, **class_kwargs):
+        """创建视图函数时预先包装所有HTTP方法
+        """
+        for method in cls.methods or ():
+            cls.handler(method.lower())
+        return super().as_view(name, *class_args, **class_kwargs)
+
+    def check_etag(self, *parts):
+        """根据数据版本计算ETag
+
+        视图方法在读取、序列化数据之前调用，请求头 If-None-Match 与ETag一致时
+        抛出 NotModified，直接返回304响应；否则ETag会被添加到响应头中。
+        查询参数也参与计算，同一资源不同参数的响应使用不同的ETag
+
+        Args:
+                parts: 能够标识数据版本的值，如服务器列表版本号、采样时间戳
+        """
+        key = repr(parts).encode('utf-8') + b'?' + request.query_string
+        self.etag = hashlib.md5(key).hexdigest()
+        if request.if_none_match.contains_weak(self.etag):
+            raise NotModified()
+
+    def make_not_modified_response(self):
+        """生成304响应
+        """
+        response = current_app.response_class(status=304)
+        response.set_etag(self.etag, weak=True)
+        return response
+
+    def make_json_response(self, data, code=200, headers=None):
+        """序列化数据并生成HTTP响应
+
+        序列化库由 JSON_RESPONSE_ENCODER 配置，结果直接为bytes。
+        响应体不小于 JSON_COMPRESS_MIN_SIZE 且客户端支持时使用gzip压缩
+        """
+        return self.make_body_response(json_encoder.dumps(data) + b'\n', code, headers)
+
+    def make_body_response(self, body, code=200, headers=None, compressed=False):
+        """使用已经序列化的json生成HTTP响应，添加ETag并按需压缩
+
+        Args:
+                compressed(bool): body已经gzip压缩，客户端不支持gzip时解压
+        """
+        response = current_app.response_class(
+            body, status=code, headers=headers, content_type=self.content_type)
+
+        if code == 200 and self.etag is not None:
+            # gzip压缩后内容与未压缩时不同，因此使用弱ETag
+            response.set_etag(self.etag, weak=True)
+
+        if compressed:
+            response.vary.add('Accept-Encoding')
+            if request.accept_encodings['gzip']:
+                response.headers['Content-Encoding'] = 'gzip'
+            else:
+                response.set_data(gzip.decompress(body))
+            return response
+
+        min_size = current_app.config.get('JSON_COMPRESS_MIN_SIZE')
+        if min_size is not None and len(body) >= min_size:
+            response.vary.add('Accept-Encoding')
+            if request.accept_encodings['gzip']:
+                level = current_app.config.get('JSON_COMPRESS_LEVEL', 6)
+                response.set_data(gzip.compress(body, level))
+                response.headers['Content-Encoding'] = 'gzip'
+        return response
 
     def handler_error(self, exception):
         """处理异常
@@ -24,38 +136,26 @@ class RestView(MethodView):
             'ok': False,
             'message': exception.message
         }
-
-        result = dumps(data) + '\n'
-        resp = make_response(result, exception.code)
-        resp.headers['Content-Type'] = self.content_type
-        return resp
+        return self.make_json_response(data, exception.code)
 
     def dispatch_request(self, *args, **kwargs):
         """重写父类方法，支持数据自动序列化
         """
 
-        # 获取对应于 HTTP 请求方式的视图方法(rmon.views里的视图控制器类中的方法)
-        method = getattr(self, request.method.lower(), None)
+        # 获取对应于 HTTP 请求方式的视图方法(rmon.views里的视图控制器类中的方法)，已经包装了装饰器
+        method = self.handler(request.method.lower())
 
         if method is None and request.method == 'HEAD':  # 如果请求方法为HEAD，而且没有对应的视图方法
             # 那么就用视图控制器类中的get方法来返回
-            method = getattr(self, 'get', None)
+            method = self.handler('get')
 
         # 如果仍然没法获取到视图方法，就抛出异常，打印request请求的方法
         assert method is not None, 'Unimplemented method %r' % request.method
 
-        # HTTP 请求方法定义了不同的装饰器
-        if isinstance(self.method_decorators, Mapping):
-            decorators = self.method_decorators.get(request.method.lower(), [])
-        else:
-            decorators = self.method_decorators
-
-        # 首先执行装饰器函数,如果decorators为[],那么这段代码什么也不做，method还是原来的方法
-        for decorator in decorators:
-            method = decorator(method)
-
         try:
-            resp = method(*args, **kwargs)
+            resp = method(self, *args, **kwargs)
+        except NotModified:
+            return self.make_not_modified_response()
         except RestError as e:
             resp = self.handler_error(e)
 
@@ -77,15 +177,8 @@ class RestView(MethodView):
                     message = data[key]
             data = {'ok': False, 'message': message}
 
-        # 序列化数据
-        result = dumps(data) + '\n'
-        # 生成HTTP响应
-        response = make_response(result, code)
-        response.headers.extend(headers)
-
-        # 设置响应头部为 application/json
-        response.headers['Content-Type'] = self.content_type
-        return response
+        # 序列化数据并生成HTTP响应，响应头部为 application/json
+        return self.make_json_response(data, code, headers)
 
     @staticmethod
     def unpack(value):
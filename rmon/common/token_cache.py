@@ -0,0 +1,107 @@
+"""rmon.common.token_cache
+
+已验证的json web token缓存，避免每次请求都重新验证签名和查询数据库
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from rmon.common.version import VersionFile
+
+
+# 缓存中保存的轻量用户信息
+UserPrincipal = namedtuple('UserPrincipal', ['id', 'is_admin'])
+
+
+class TokenCache:
+    """LRU token缓存
+
+    以token的摘要为key，缓存在token过期或缓存超过 ttl 秒后失效，用户信息改变或者用户被删除时
+    需要调用 invalidate_user 删除该用户的所有缓存。
+    多进程部署时通过 TOKEN_CACHE_VERSION_FILE 版本文件通知其他进程清空缓存；
+    没有配置版本文件时，其他进程最多在 ttl 秒内继续使用旧的用户信息
+    """
+
+    def __init__(self, app=None):
+        self.max_size = 10000
+        self.ttl = 60
+        self.version_file = None
+        self._version = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """从app配置中读取缓存大小、缓存时间和版本文件
+        """
+        self.max_size = app.config.get('TOKEN_CACHE_SIZE', self.max_size)
+        self.ttl = app.config.get('TOKEN_CACHE_TTL', self.ttl)
+        path = app.config.get('TOKEN_CACHE_VERSION_FILE')
+        self.version_file = VersionFile(path) if path else None
+        self._version = self.version_file.read() if path else None
+        app.extensions['token_cache'] = self
+
+    @staticmethod
+    def digest(token):
+        if isinstance(token, str):
+            token = token.encode('utf-8')
+        return hashlib.sha256(token).digest()
+
+    def get(self, token):
+        """获取token对应的用户信息，不存在或已过期时返回None
+        """
+        key = self.digest(token)
+        version = self.version_file.read() if self.version_file is not None else None
+        with self._lock:
+            if version != self._version:
+                # 其他进程修改了用户
+                self._entries.clear()
+                self._version = version
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            principal, exp = entry
+            if exp <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return principal
+
+    def put(self, token, principal, exp):
+        """缓存已验证的token
+
+        Args:
+                token(str): json web token
+                principal(UserPrincipal): 用户信息
+                exp(float): token过期时间戳
+        """
+        key = self.digest(token)
+        exp = min(exp, time.time() + self.ttl)
+        with self._lock:
+            self._entries[key] = (principal, exp)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate_user(self, user_id):
+        """删除用户的所有缓存，并通知其他进程清空缓存
+        """
+        with self._lock:
+            for key in [key for key, (principal, _) in self._entries.items()
+                        if principal.id == user_id]:
+                del self._entries[key]
+            if self.version_file is not None:
+                previous, version = self.version_file.bump()
+                # 版本文件在本进程上次读取后没有被其他进程修改时，本进程的缓存仍是最新的
+                if previous == self._version:
+                    self._version = version
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
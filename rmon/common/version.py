@@ -0,0 +1,59 @@
+"""rmon.common.version
+
+多进程共享的版本号，保存在文件中的递增计数器
+
+进程修改共享数据后递增计数器，其他进程读取计数器判断自己的缓存是否已经过期。
+计数器以定长十进制写在文件开头，每次修改都会改变计数器，不依赖文件的修改时间精度
+"""
+import fcntl
+import os
+
+
+WIDTH = 20
+
+
+class VersionFile:
+    """版本号文件
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            open(path, 'a').close()
+
+    def read(self):
+        """当前版本号，文件不存在或内容无效时返回None
+        """
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except FileNotFoundError:
+            return None
+        try:
+            data = os.pread(fd, WIDTH, 0)
+        finally:
+            os.close(fd)
+        try:
+            return int(data)
+        except ValueError:
+            return 0 if not data else None
+
+    def bump(self):
+        """递增版本号，多个进程同时修改时通过文件锁保证每次修改都被计数
+
+        Returns:
+                tuple: (修改前的版本号, 修改后的版本号)
+        """
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            data = os.pread(fd, WIDTH, 0)
+            try:
+                current = int(data) if data else 0
+            except ValueError:
+                current = 0
+            version = current + 1
+            # 定长写入，读取时不会读到被截断的内容
+            os.pwrite(fd, b'%0*d' % (WIDTH, version), 0)
+            return current, version
+        finally:
+            os.close(fd)
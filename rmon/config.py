@@ -11,12 +11,118 @@ class DevConfig:
 	SQLALCHEMY_DATABASE_URI = 'sqlite://'
 	TEMPLATES_AUTO_RELOAD = True
 
+	# Redis 连接池配置
+	REDIS_MAX_CONNECTIONS = 10
+	REDIS_SOCKET_TIMEOUT = 5
+	REDIS_SOCKET_CONNECT_TIMEOUT = 2
+	REDIS_POOL_TIMEOUT = 5
+	REDIS_POOL_IDLE_TIMEOUT = 300
+
+	# API响应的json序列化库: auto、orjson、ujson 或 json
+	JSON_RESPONSE_ENCODER = 'auto'
+
+	# 不小于该字节数的响应在客户端支持时使用gzip压缩，None表示不压缩
+	JSON_COMPRESS_MIN_SIZE = 1024
+	JSON_COMPRESS_LEVEL = 6
+
+	# 多进程部署时用于同步服务器缓存的版本文件，为空时只在当前进程内同步
+	SERVER_REGISTRY_VERSION_FILE = None
+
+	# 已验证token的缓存数量
+	TOKEN_CACHE_SIZE = 10000
+	# 已验证token的最长缓存时间(秒)，用户被修改或删除后其他进程最多在这段时间内使用旧的用户信息
+	TOKEN_CACHE_TTL = 60
+	# 多进程部署时用于通知其他进程清空token缓存的版本文件
+	TOKEN_CACHE_VERSION_FILE = None
+
+	# 监控信息采集配置
+	METRICS_COLLECTOR_ENABLED = False
+	METRICS_COLLECT_INTERVAL = 10
+	METRICS_HISTORY_SIZE = 360
+	METRICS_FANOUT_WORKERS = 32
+	METRICS_FANOUT_TIMEOUT = 5
+	# 线程池已满时任务在队列中等待的最长时间，超时后不再访问该服务器
+	METRICS_FANOUT_QUEUE_TIMEOUT = 5
+	# 监控信息缓存的过期时间(秒)，所有服务器相同；过期后 STALE_TTL 秒内返回旧值并在后台刷新
+	METRICS_CACHE_TTL = 5
+	METRICS_CACHE_STALE_TTL = 30
+	METRICS_STREAM_MIN_INTERVAL = 1
+	METRICS_STREAM_HEARTBEAT = 15
+
+	# 采集引擎: thread 为线程池，asyncio 为异步长连接，适用于大量服务器
+	METRICS_COLLECTOR_ENGINE = 'thread'
+	METRICS_COLLECT_TIMEOUT = 2
+	METRICS_COLLECT_CONCURRENCY = 500
+	METRICS_COLLECT_JITTER = 0.1
+
+	# 监控指标磁盘存储配置，METRICS_STORE_PATH 为空时不启用
+	METRICS_STORE_PATH = None
+	METRICS_STORE_SEGMENT_DURATION = 3600
+	METRICS_STORE_RETENTION = 7 * 24 * 3600
+	METRICS_STORE_BUFFER_SIZE = 1000
+	# 缓冲的采样最长保留时间(秒)，需要小于 METRICS_COLLECT_INTERVAL x METRICS_HISTORY_SIZE
+	METRICS_STORE_FLUSH_INTERVAL = 300
+	METRICS_STORE_COMPRESS = True
+
+	# 键空间分析: 每次SCAN的数量，每秒最多分析的键数量，Redis服务器处理分析请求的最大时间占比
+	KEYSPACE_SCAN_COUNT = 100
+	KEYSPACE_SCAN_RATE = 1000
+	KEYSPACE_SCAN_DUTY = 0.1
+
+	# 多进程共享分析任务(键空间分析、MONITOR 采样)状态的目录，为空时任务只在启动它的进程内可见，
+	# 此时多进程部署需要把分析API的请求都转发到同一个进程。运行任务的进程每 PUBLISH_INTERVAL 秒更新状态
+	ANALYSIS_JOB_PATH = None
+	ANALYSIS_JOB_PUBLISH_INTERVAL = 1
+
+	# 慢查询日志采集: 关闭时在请求慢查询汇总时采集，FETCH_MAX 为每次 SLOWLOG GET 的最大数量，
+	# 汇总按 BUCKET 秒分桶保存 RETENTION 秒，每个服务器最多保留 MAX_SIGNATURES 个指令签名
+	SLOWLOG_COLLECTOR_ENABLED = False
+	SLOWLOG_COLLECT_INTERVAL = 60
+	SLOWLOG_FETCH_MAX = 1024
+	SLOWLOG_BUCKET = 60
+	SLOWLOG_RETENTION = 24 * 3600
+	SLOWLOG_MAX_SIGNATURES = 1000
+
+	# 延迟探测: 每 INTERVAL 秒通过长连接发送 PIPELINE 个 PING，
+	# 往返时间按 BUCKET 秒分桶保存 RETENTION 秒
+	LATENCY_PROBE_ENABLED = False
+	LATENCY_PROBE_INTERVAL = 1
+	LATENCY_PROBE_PIPELINE = 10
+	LATENCY_PROBE_TIMEOUT = 2
+	LATENCY_PROBE_BUCKET = 10
+	LATENCY_PROBE_RETENTION = 3600
+
+	# MONITOR 采样: 默认和最长采样时间(秒)，最多读取的字节数，最多保留的高频键数量，
+	# Count-Min 草图的宽度和行数
+	MONITOR_SAMPLE_DURATION = 10
+	MONITOR_SAMPLE_MAX_DURATION = 60
+	MONITOR_SAMPLE_MAX_BYTES = 64 * 1024 * 1024
+	MONITOR_SAMPLE_MAX_TOP = 200
+	MONITOR_SKETCH_WIDTH = 4096
+	MONITOR_SKETCH_DEPTH = 4
+
+	# 多进程共享的最新监控信息快照，METRICS_SNAPSHOT_PATH 为空时不启用，
+	# id超过槽数量的服务器或超过槽大小的监控信息不写入快照
+	METRICS_SNAPSHOT_PATH = None
+	METRICS_SNAPSHOT_SLOTS = 4096
+	METRICS_SNAPSHOT_SLOT_SIZE = 32768
+
 class ProductConfig(DevConfig):
 	"""生产环境配置
 	"""
 	
 	DEBUG = False
+	# 生产环境由 flask collect 启动的采集进程统一采集，采样写入磁盘存储和共享快照，
+	# web 进程(如 gunicorn 的每个 worker)只读取，不启动进程内的采集器，
+	# 否则每个 worker 都会访问所有Redis服务器并重复写入快照。
+	# 只有一个 web 进程且不运行 flask collect 时，可以在 RMON_SETTINGS 中开启
+	METRICS_COLLECTOR_ENABLED = False
 
 	path = os.path.join(os.getcwd(), 'rmon.db').replace('\\', '/')
 	SQLALCHEMY_DATABASE_URI = 'sqlite:///%s' % path
+	METRICS_STORE_PATH = os.path.join(os.getcwd(), 'metrics').replace('\\', '/')
+	SERVER_REGISTRY_VERSION_FILE = os.path.join(os.getcwd(), 'rmon.version').replace('\\', '/')
+	TOKEN_CACHE_VERSION_FILE = os.path.join(os.getcwd(), 'rmon.token.version').replace('\\', '/')
+	METRICS_SNAPSHOT_PATH = os.path.join(os.getcwd(), 'metrics.snapshot').replace('\\', '/')
+	ANALYSIS_JOB_PATH = os.path.join(os.getcwd(), 'jobs').replace('\\', '/')
 		
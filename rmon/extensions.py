@@ -1,3 +1,28 @@
 from flask_sqlalchemy import SQLAlchemy
 
-db = SQLAlchemy()
\ No newline at end of file
+from rmon.analysis.jobs import JobRegistry
+from rmon.analysis.slowlog import SlowlogCollector
+from rmon.common.encoder import ResponseEncoder
+from rmon.common.pool import RedisPoolRegistry
+from rmon.common.registry import ServerRegistry
+from rmon.common.token_cache import TokenCache
+from rmon.metrics.cache import MetricsCache
+from rmon.metrics.collector import MetricsCollector
+from rmon.metrics.fanout import Fanout
+from rmon.metrics.latency import LatencyProber
+from rmon.metrics.snapshot import MetricsSnapshot
+from rmon.metrics.store import MetricStore
+
+db = SQLAlchemy()
+redis_pools = RedisPoolRegistry()
+collector = MetricsCollector()
+fanout = Fanout()
+metrics_cache = MetricsCache()
+metric_store = MetricStore()
+token_cache = TokenCache()
+json_encoder = ResponseEncoder()
+server_registry = ServerRegistry()
+metrics_snapshot = MetricsSnapshot()
+analysis_jobs = JobRegistry()
+slowlog_collector = SlowlogCollector()
+latency_prober = LatencyProber()
@@ -0,0 +1,143 @@
+"""rmon.metrics.cache
+
+监控信息缓存，支持过期后返回旧数据并在后台刷新，以及并发请求合并
+"""
+import threading
+import time
+
+
+class _Flight:
+    """正在进行中的加载操作，并发请求等待同一个结果
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class MetricsCache:
+    """带过期时间的监控信息缓存
+
+    所有服务器使用同一个过期时间 METRICS_CACHE_TTL，服务器没有各自的采集周期，
+    过期时间只决定同一服务器的请求最多多久执行一次INFO
+
+    - 缓存未过期时直接返回缓存值
+    - 缓存过期但未超过 stale_ttl 时返回旧值，同时在后台刷新
+    - 同一个key同时只有一个加载操作，其他请求等待该操作的结果
+    """
+
+    def __init__(self, app=None):
+        self.ttl = 5
+        self.stale_ttl = 30
+
+        self._entries = {}
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'stale': 0, 'coalesced': 0, 'errors': 0}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """从app配置中读取缓存参数
+        """
+        self.ttl = app.config.get('METRICS_CACHE_TTL', self.ttl)
+        self.stale_ttl = app.config.get('METRICS_CACHE_STALE_TTL', self.stale_ttl)
+        app.extensions['metrics_cache'] = self
+
+    def get(self, key, loader):
+        """获取缓存值
+
+        Args:
+                key(tuple): 缓存key，第一个元素为服务器id
+                loader(callable): 缓存不存在或过期时调用的加载函数
+
+        Returns:
+                object: 缓存值
+        """
+        ttl = self.ttl
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                age = now - entry[1]
+                if age < ttl:
+                    self._stats['hits'] += 1
+                    return entry[0]
+                if age < ttl + self.stale_ttl:
+                    self._stats['stale'] += 1
+                    flight, leader = self._join(key)
+                    if leader:
+                        threading.Thread(target=self._load, args=(key, loader, flight),
+                                         daemon=True).start()
+                    return entry[0]
+            self._stats['misses'] += 1
+            flight, leader = self._join(key)
+
+        if leader:
+            self._load(key, loader, flight)
+        else:
+            flight.event.wait()
+
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    def peek(self, key):
+        """不论是否过期，返回缓存值，不存在时返回None，不计入命中统计
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        return entry[0] if entry is not None else None
+
+    def _join(self, key):
+        """加入正在进行的加载操作，没有时新建一个，调用者需持有锁
+
+        Returns:
+                tuple: (加载操作, 是否由当前请求执行加载)
+        """
+        flight = self._flights.get(key)
+        if flight is not None:
+            self._stats['coalesced'] += 1
+            return flight, False
+        flight = self._flights[key] = _Flight()
+        return flight, True
+
+    def _load(self, key, loader, flight):
+        try:
+            flight.value = loader()
+        except Exception as e:
+            flight.error = e
+
+        with self._lock:
+            if flight.error is None:
+                self._entries[key] = (flight.value, time.monotonic())
+            else:
+                self._stats['errors'] += 1
+            self._flights.pop(key, None)
+        flight.event.set()
+
+    def invalidate(self, server_id):
+        """删除服务器的所有缓存值
+        """
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == server_id]:
+                del self._entries[key]
+
+    def clear(self):
+        """清空缓存
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """缓存命中统计
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        stats['ttl'] = self.ttl
+        stats['stale_ttl'] = self.stale_ttl
+        return stats
@@ -0,0 +1,310 @@
+"""rmon.metrics.collector
+
+后台监控信息采集器，定时对所有Redis服务器执行INFO指令并将结果保存在内存中
+"""
+import gzip
+import logging
+import threading
+import time
+from collections import namedtuple
+
+from rmon.metrics.derive import RateCalculator
+from rmon.metrics.series import ServerSeries, parse_info
+
+
+logger = logging.getLogger(__name__)
+
+Sample = namedtuple('Sample', ['timestamp', 'info', 'derived'])
+
+
+class MetricsCollector:
+    """监控信息采集器
+
+    每个服务器保存最近一次INFO结果、衍生指标以及数值指标的历史记录，
+    视图函数直接从内存中读取，不需要访问Redis服务器。
+
+    METRICS_COLLECTOR_ENGINE 为 thread 时在后台线程中通过线程池定时采集所有服务器，
+    为 asyncio 时使用 rmon.metrics.engine.AsyncEngine，适用于服务器数量很多的情况。
+
+    只有启动了采集的进程(开启 METRICS_COLLECTOR_ENABLED 的进程或 flask collect 的采集进程)
+    才将采样写入磁盘存储和共享快照，web 进程只读取
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.store = None
+        self.snapshot = None
+        self.encoder = None
+        self.compress_min_size = None
+        self.compress_level = 6
+        self.interval = 10
+        self.history_size = 360
+        self.engine = 'thread'
+        self.timeout = 2
+        self.concurrency = 500
+        self.jitter = 0.1
+        self.purge_interval = 3600
+        # 多进程采集时当前进程负责的服务器，参见 rmon.metrics.shard.Shard
+        self.shard = None
+        self._last_purge = 0
+
+        self._latest = {}
+        self._series = {}
+        self._rates = RateCalculator()
+        self._lock = threading.Lock()
+        # 每次保存采样后通知等待新采样的请求
+        self._changed = threading.Condition(self._lock)
+        self.version = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """从app配置中读取采集参数，如果开启了采集器则在处理第一个请求前启动后台线程
+
+        flask 命令行(例如离线分析RDB文件)不处理请求，不会启动采集器
+        """
+        self.app = app
+        self.interval = app.config.get('METRICS_COLLECT_INTERVAL', self.interval)
+        self.history_size = app.config.get('METRICS_HISTORY_SIZE', self.history_size)
+        self.engine = app.config.get('METRICS_COLLECTOR_ENGINE', self.engine)
+        self.timeout = app.config.get('METRICS_COLLECT_TIMEOUT', self.timeout)
+        self.concurrency = app.config.get('METRICS_COLLECT_CONCURRENCY', self.concurrency)
+        self.jitter = app.config.get('METRICS_COLLECT_JITTER', self.jitter)
+        app.extensions['metrics_collector'] = self
+
+        if app.config.get('METRICS_COLLECTOR_ENABLED', False):
+            app.before_first_request(self.start)
+
+    def publish(self):
+        """采样同时写入app配置的磁盘存储和共享快照，由启动采集的进程调用
+        """
+        # 配置了磁盘存储时，采样同时写入磁盘
+        store = self.app.extensions.get('metric_store')
+        if store is not None and store.enabled:
+            self.store = store
+
+        # 配置了共享快照时，最新的采样同时写入快照供其他进程读取
+        snapshot = self.app.extensions.get('metrics_snapshot')
+        if snapshot is not None and snapshot.enabled:
+            self.snapshot = snapshot
+            self.encoder = self.app.extensions['json_encoder']
+            self.compress_min_size = self.app.config.get('JSON_COMPRESS_MIN_SIZE')
+            self.compress_level = self.app.config.get('JSON_COMPRESS_LEVEL', self.compress_level)
+
+    def start(self):
+        """启动后台采集线程，采样写入磁盘存储和共享快照
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self.publish()
+        self._stop.clear()
+        target = self._run_async if self.engine == 'asyncio' else self._run
+        self._thread = threading.Thread(
+            target=target, name='rmon-metrics-collector', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止后台采集线程
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+            if self.store is not None:
+                self.store.flush()
+
+    def _run(self):
+        while not self._stop.is_set():
+            started = time.monotonic()
+            try:
+                with self.app.app_context():
+                    self.collect()
+            except Exception:
+                logger.exception('metrics collection failed')
+            elapsed = time.monotonic() - started
+            self._stop.wait(max(self.interval - elapsed, 0))
+
+    def _run_async(self):
+        from rmon.metrics.engine import AsyncEngine
+
+        engine = AsyncEngine(self, self.interval, self.timeout, self.concurrency, self.jitter)
+        try:
+            engine.run(self._stop)
+        except Exception:
+            logger.exception('metrics collection engine failed')
+
+    def collect(self):
+        """采集所有服务器的监控信息，需要在app context中调用
+        """
+        from rmon.extensions import fanout
+
+        servers = self.servers()
+        results = fanout.map(lambda server: server.get_metrics(), servers)
+        for server, (ok, result) in zip(servers, results):
+            if not ok:
+                logger.warning(result)
+                continue
+            self.record(server.id, result)
+        self.maintain([server.id for server in servers])
+
+    def servers(self):
+        """需要采集的服务器，多进程采集时只返回当前进程负责的服务器
+        """
+        from rmon.extensions import server_registry
+
+        servers = server_registry.all()
+        if self.shard is not None:
+            servers = [server for server in servers if self.shard.owns(server.id)]
+        return servers
+
+    def maintain(self, server_ids):
+        """每个采集周期结束后的清理：删除已删除或已分配给其他进程的服务器的采样，
+        将缓冲时间超过 METRICS_STORE_FLUSH_INTERVAL 的采样写入磁盘
+
+        Args:
+                server_ids(list): 仍然由当前进程采集的服务器id
+        """
+        alive = set(server_ids)
+        with self._lock:
+            removed = [server_id for server_id in self._latest if server_id not in alive]
+            for server_id in removed:
+                self._forget(server_id)
+
+        deleted = self._deleted(removed)
+        for server_id in deleted:
+            if self.store is not None:
+                self.store.forget(server_id)
+            if self.snapshot is not None:
+                self.snapshot.remove(server_id)
+
+        if self.store is not None:
+            # 服务器可能已分配给其他采集进程，之后由该进程写入新的段文件
+            for server_id in removed:
+                if server_id not in deleted:
+                    self.store.release(server_id)
+            now = time.time()
+            self.store.flush_due(now)
+            if now - self._last_purge > self.purge_interval:
+                self._last_purge = now
+                server_ids = alive if self.shard is not None else None
+                self.store.purge(now, server_ids)
+                self.store.compact(server_ids)
+
+    def _deleted(self, server_ids):
+        """已经删除的服务器，web 进程不写入磁盘存储和共享快照，由采集进程删除其数据
+        """
+        if not server_ids or (self.store is None and self.snapshot is None):
+            return set()
+        from rmon.extensions import server_registry
+
+        with self.app.app_context():
+            return {server_id for server_id in server_ids
+                    if server_registry.get(server_id) is None}
+
+    def record(self, server_id, info, timestamp=None):
+        """保存一次INFO结果
+
+        Args:
+                server_id(int): 服务器id
+                info(dict): INFO指令返回结果
+                timestamp(float): 采样时间戳，默认为当前时间
+
+        Returns:
+                Sample: 采样记录
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        values = parse_info(info)
+
+        with self._lock:
+            derived = self._rates.update(server_id, timestamp, info)
+            values.update(derived)
+            sample = Sample(timestamp, info, derived)
+            series = self._series.get(server_id)
+            if series is None:
+                series = self._series[server_id] = ServerSeries(self.history_size)
+            series.append(timestamp, values)
+            self._latest[server_id] = sample
+            self.version += 1
+            self._changed.notify_all()
+
+        if self.store is not None:
+            self.store.append(server_id, timestamp, values)
+        if self.snapshot is not None:
+            # 与监控信息API的响应一致，web进程可以直接作为响应体，
+            # 需要压缩的响应在这里压缩一次，web进程不需要为每个请求压缩
+            data = dict(info, derived=derived) if derived else info
+            body = self.encoder.dumps(data) + b'\n'
+            if self.compress_min_size is not None and len(body) >= self.compress_min_size:
+                body = gzip.compress(body, self.compress_level)
+            self.snapshot.write(server_id, timestamp, body)
+        return sample
+
+    def wait(self, version, timeout=None):
+        """等待新的采样
+
+        Args:
+                version(int): 调用者已知的采样版本
+                timeout(float): 最长等待时间(秒)
+
+        Returns:
+                int: 当前采样版本，超时时与version相同
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def latest(self, server_id):
+        """服务器最近一次采样记录，没有采样时返回None
+        """
+        return self._latest.get(server_id)
+
+    def fresh(self, server_id):
+        """服务器最近一次采样记录，采样时间超过两个采集周期时认为已过期，返回None
+        """
+        sample = self._latest.get(server_id)
+        if sample is None or time.time() - sample.timestamp > 2 * self.interval:
+            return None
+        return sample
+
+    def history(self, server_id):
+        """服务器的指标历史记录，没有采样时返回None
+        """
+        return self._series.get(server_id)
+
+    def series(self, server_id, metric):
+        """在锁内同时读取服务器的采样时间戳和指标值，保证两者一一对应
+
+        Returns:
+                tuple: (时间戳列表, 指标值列表)，没有采样时为 ([], None)，指标不存在时指标值为None
+        """
+        with self._lock:
+            history = self._series.get(server_id)
+            if history is None:
+                return [], None
+            return history.timestamps(), history.series(metric)
+
+    def _forget(self, server_id):
+        self._latest.pop(server_id, None)
+        self._series.pop(server_id, None)
+        self._rates.forget(server_id)
+
+    def clear(self):
+        """删除所有服务器的采样记录
+        """
+        with self._lock:
+            for server_id in list(self._latest):
+                self._forget(server_id)
+
+    def forget(self, server_id):
+        """删除服务器的所有采样记录，采集进程同时删除磁盘存储和共享快照中的数据
+        """
+        with self._lock:
+            self._forget(server_id)
+        if self.store is not None:
+            self.store.forget(server_id)
+        if self.snapshot is not None:
+            self.snapshot.remove(server_id)
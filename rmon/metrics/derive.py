@@ -0,0 +1,136 @@
+"""rmon.metrics.derive
+
+根据INFO中单调递增的计数器增量计算速率等衍生指标
+"""
+
+
+# 衍生指标名称 -> INFO计数器字段
+RATES = {
+    'ops_per_sec': 'total_commands_processed',
+    'connections_per_sec': 'total_connections_received',
+    'rejected_connections_per_sec': 'rejected_connections',
+    'net_input_bytes_per_sec': 'total_net_input_bytes',
+    'net_output_bytes_per_sec': 'total_net_output_bytes',
+    'expired_keys_per_sec': 'expired_keys',
+    'evicted_keys_per_sec': 'evicted_keys',
+    'keyspace_hits_per_sec': 'keyspace_hits',
+    'keyspace_misses_per_sec': 'keyspace_misses',
+}
+
+CPU_FIELDS = ('used_cpu_sys', 'used_cpu_user')
+
+
+def _counters(info):
+    counters = {}
+    for field in list(RATES.values()) + list(CPU_FIELDS):
+        value = info.get(field)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            counters[field] = value
+    return counters
+
+
+def hit_ratio(hits, misses):
+    """命中率，没有访问时返回None
+    """
+    total = hits + misses
+    if total <= 0:
+        return None
+    return hits / total
+
+
+def _state(info):
+    """计算速率需要保存的字段: 计数器以及判断服务器是否重启的 run_id 和 uptime_in_seconds
+    """
+    state = _counters(info)
+    state['run_id'] = info.get('run_id')
+    state['uptime_in_seconds'] = info.get('uptime_in_seconds')
+    return state
+
+
+def rates(previous, timestamp, info):
+    """根据上一次采样计算衍生指标，不修改任何状态
+
+    Args:
+            previous(tuple): 上一次采样的 (时间戳, INFO结果)，没有上一次采样时为None
+            timestamp(float): 本次采样时间戳
+            info(dict): 本次INFO结果，可以只包含部分section，只计算其中包含的计数器的速率，
+                        需要包含 server section 中的 run_id 和 uptime_in_seconds 以判断服务器是否重启
+
+    Returns:
+            dict: 衍生指标名称到数值的映射
+    """
+    counters = _counters(info)
+    run_id = info.get('run_id')
+    uptime = info.get('uptime_in_seconds')
+
+    derived = {}
+    ratio = hit_ratio(counters.get('keyspace_hits', 0), counters.get('keyspace_misses', 0))
+    if ratio is not None:
+        derived['hit_ratio'] = ratio
+
+    if previous is None:
+        return derived
+    last_timestamp, last_info = previous
+    elapsed = timestamp - last_timestamp
+    if elapsed <= 0:
+        return derived
+
+    # 服务器重启后计数器被重置
+    last_run_id = last_info.get('run_id')
+    if run_id != last_run_id:
+        return derived
+    last_uptime = last_info.get('uptime_in_seconds')
+    if uptime is not None and last_uptime is not None and uptime < last_uptime:
+        return derived
+
+    last_counters = _counters(last_info)
+    deltas = {}
+    for field, value in counters.items():
+        if field in last_counters and value >= last_counters[field]:
+            deltas[field] = value - last_counters[field]
+
+    for name, field in RATES.items():
+        if field in deltas:
+            derived[name] = deltas[field] / elapsed
+
+    if 'keyspace_hits' in deltas and 'keyspace_misses' in deltas:
+        ratio = hit_ratio(deltas['keyspace_hits'], deltas['keyspace_misses'])
+        if ratio is not None:
+            derived['interval_hit_ratio'] = ratio
+
+    if all(field in deltas for field in CPU_FIELDS):
+        cpu = sum(deltas[field] for field in CPU_FIELDS)
+        derived['cpu_percent'] = cpu / elapsed * 100
+    return derived
+
+
+class RateCalculator:
+    """衍生指标计算器
+
+    为每个服务器保存上一次采样的计数器，每次采样时根据增量计算每秒速率、
+    命中率和CPU使用率。当 run_id 变化或 uptime_in_seconds 变小时认为服务器已重启，
+    计数器被重置，本次采样不计算速率
+    """
+
+    def __init__(self):
+        self._previous = {}
+
+    def update(self, server_id, timestamp, info):
+        """根据新的采样计算衍生指标
+
+        Args:
+                server_id(int): 服务器id
+                timestamp(float): 采样时间戳
+                info(dict): INFO指令返回结果
+
+        Returns:
+                dict: 衍生指标名称到数值的映射
+        """
+        previous = self._previous.get(server_id)
+        self._previous[server_id] = (timestamp, _state(info))
+        return rates(previous, timestamp, info)
+
+    def forget(self, server_id):
+        """删除服务器的上一次采样
+        """
+        self._previous.pop(server_id, None)
@@ -0,0 +1,154 @@
+"""rmon.metrics.downsample
+
+监控指标降采样，支持分桶聚合(min/max/avg)和 LTTB (Largest-Triangle-Three-Buckets) 算法，
+安装了 numpy 时使用向量化实现，否则使用纯Python实现
+"""
+import math
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+
+METHODS = ('avg', 'lttb')
+
+
+def select(timestamps, values, start=None, end=None):
+    """选取时间范围内的非NaN采样点
+
+    Args:
+            timestamps(sequence): 按时间先后排序的时间戳
+            values(sequence): 对应的指标值
+            start(float): 起始时间戳(包含)
+            end(float): 结束时间戳(包含)
+
+    Returns:
+            tuple: (timestamps, values)，安装numpy时为ndarray，否则为list
+    """
+    if np is not None:
+        ts = np.asarray(timestamps, dtype='f8')
+        vs = np.asarray(values, dtype='f8')
+        mask = ~np.isnan(vs)
+        if start is not None:
+            mask &= ts >= start
+        if end is not None:
+            mask &= ts <= end
+        return ts[mask], vs[mask]
+
+    ts, vs = [], []
+    for t, v in zip(timestamps, values):
+        if math.isnan(v):
+            continue
+        if start is not None and t < start:
+            continue
+        if end is not None and t > end:
+            continue
+        ts.append(t)
+        vs.append(v)
+    return ts, vs
+
+
+def buckets(timestamps, values, points):
+    """按时间等宽分桶，每个桶返回 [时间戳, 平均值, 最小值, 最大值]
+
+    时间戳为桶内第一个采样点的时间
+    """
+    n = len(timestamps)
+    if n == 0:
+        return []
+    start, end = timestamps[0], timestamps[-1]
+    width = (end - start) / points or 1
+
+    if np is not None:
+        index = np.minimum(((timestamps - start) / width).astype('i8'), points - 1)
+        # 时间戳有序，因此桶编号单调递增，可以用reduceat分段聚合
+        offsets = np.flatnonzero(np.diff(index, prepend=-1))
+        counts = np.diff(np.append(offsets, n))
+        avg = np.add.reduceat(values, offsets) / counts
+        low = np.minimum.reduceat(values, offsets)
+        high = np.maximum.reduceat(values, offsets)
+        return np.column_stack((timestamps[offsets], avg, low, high)).tolist()
+
+    result = []
+    current = None
+    for t, v in zip(timestamps, values):
+        index = min(int((t - start) / width), points - 1)
+        if index != current:
+            current = index
+            # [时间戳, 总和, 最小值, 最大值, 数量]
+            result.append([t, 0.0, v, v, 0])
+        bucket = result[-1]
+        bucket[1] += v
+        bucket[2] = min(bucket[2], v)
+        bucket[3] = max(bucket[3], v)
+        bucket[4] += 1
+    return [[t, total / count, low, high] for t, total, low, high, count in result]
+
+
+def lttb(timestamps, values, points):
+    """LTTB降采样，保留曲线形状，返回 [时间戳, 值] 列表
+
+    LTTB 总是保留第一个和最后一个点，points 小于3时按3计算
+    """
+    points = max(points, 3)
+    n = len(timestamps)
+    if n <= points:
+        return [[float(t), float(v)] for t, v in zip(timestamps, values)]
+
+    every = (n - 2) / (points - 2)
+    selected = [0]
+    a = 0
+    for i in range(points - 2):
+        # 下一个桶的平均点
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        # 当前桶
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+
+        if np is not None:
+            avg_t = timestamps[next_start:next_end].mean()
+            avg_v = values[next_start:next_end].mean()
+            ts = timestamps[start:end]
+            vs = values[start:end]
+            areas = np.abs((timestamps[a] - avg_t) * (vs - values[a]) -
+                           (timestamps[a] - ts) * (avg_v - values[a]))
+            a = start + int(areas.argmax())
+        else:
+            count = next_end - next_start
+            avg_t = sum(timestamps[next_start:next_end]) / count
+            avg_v = sum(values[next_start:next_end]) / count
+            best, best_area = start, -1.0
+            for j in range(start, end):
+                area = abs((timestamps[a] - avg_t) * (values[j] - values[a]) -
+                           (timestamps[a] - timestamps[j]) * (avg_v - values[a]))
+                if area > best_area:
+                    best, best_area = j, area
+            a = best
+        selected.append(a)
+    selected.append(n - 1)
+    return [[float(timestamps[i]), float(values[i])] for i in selected]
+
+
+def downsample(timestamps, values, points, method='avg', start=None, end=None):
+    """对时间序列降采样
+
+    Args:
+            timestamps(sequence): 按时间先后排序的时间戳
+            values(sequence): 对应的指标值，NaN表示缺失
+            points(int): 最多返回的点数
+            method(str): avg 为分桶聚合，lttb 为LTTB算法
+            start(float): 起始时间戳
+            end(float): 结束时间戳
+
+    Returns:
+            list: avg 时每个点为 [时间戳, 平均值, 最小值, 最大值]，lttb 时为 [时间戳, 值]
+    """
+    ts, vs = select(timestamps, values, start, end)
+    if method == 'lttb':
+        return lttb(ts, vs, points)
+
+    if len(ts) <= points:
+        return [[float(t), float(v), float(v), float(v)] for t, v in zip(ts, vs)]
+    return buckets(ts, vs, points)
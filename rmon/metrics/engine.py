@@ -0,0 +1,284 @@
+"""rmon.metrics.engine
+
+基于asyncio的监控信息采集引擎，直接使用RESP协议与Redis服务器通信
+
+每个服务器保持一个长连接，按各自的周期执行INFO指令，采样周期加入随机偏移，
+避免所有服务器在同一时刻被访问。同时进行的请求数量有上限，单个服务器超时只影响该服务器
+"""
+import asyncio
+import logging
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+from redis.client import parse_info
+
+
+logger = logging.getLogger(__name__)
+
+
+class RespError(Exception):
+    """Redis服务器返回的错误
+    """
+
+
+def encode_command(*args):
+    """将指令编码为RESP数组
+    """
+    parts = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode('utf-8')
+        elif not isinstance(arg, bytes):
+            arg = str(arg).encode('utf-8')
+        parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+    return b''.join(parts)
+
+
+async def read_reply(reader):
+    """读取一个RESP回复
+
+    Returns:
+            object: 简单字符串和批量字符串为bytes，整数为int，数组为list，空值为None
+
+    Raises:
+            RespError: 服务器返回错误
+    """
+    line = await reader.readline()
+    if not line.endswith(b'\r\n'):
+        raise ConnectionError('connection closed')
+    kind, body = line[:1], line[1:-2]
+    if kind == b'+':
+        return body
+    if kind == b'-':
+        raise RespError(body.decode('utf-8', 'replace'))
+    if kind == b':':
+        return int(body)
+    if kind == b'$':
+        length = int(body)
+        if length < 0:
+            return None
+        data = await reader.readexactly(length + 2)
+        return data[:-2]
+    if kind == b'*':
+        length = int(body)
+        if length < 0:
+            return None
+        return [await read_reply(reader) for _ in range(length)]
+    raise ConnectionError('invalid reply %r' % line)
+
+
+class RespConnection:
+    """Redis服务器长连接
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def open(cls, host, port, password=None):
+        """建立连接，设置了密码时进行认证
+        """
+        reader, writer = await asyncio.open_connection(host, port)
+        connection = cls(reader, writer)
+        if password:
+            try:
+                await connection.execute('AUTH', password)
+            except Exception:
+                connection.close()
+                raise
+        return connection
+
+    async def execute(self, *args):
+        """执行指令并返回回复
+        """
+        self.writer.write(encode_command(*args))
+        return await read_reply(self.reader)
+
+    async def info(self):
+        """执行INFO指令，返回结果与 StrictRedis.info 一致
+        """
+        return parse_info(await self.execute('INFO'))
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncEngine:
+    """asyncio采集引擎
+
+    在独立线程的事件循环中运行，采集结果在单独的线程池中通过 MetricsCollector.record 保存，
+    写入磁盘存储和共享快照的耗时不会阻塞事件循环和其他服务器的采集，
+    磁盘变慢时也不会占用同步服务器列表和清理操作使用的默认线程池。
+    每个采集周期从服务器缓存中同步服务器列表，并执行采集器的清理操作
+    """
+
+    def __init__(self, collector, interval=10, timeout=2, concurrency=500, jitter=0.1,
+                 writers=4):
+        """
+        Args:
+                collector(MetricsCollector): 保存采样结果的采集器
+                interval(float): 采集周期(秒)
+                timeout(float): 单个服务器建立连接和执行INFO的最长时间(秒)
+                concurrency(int): 同时进行的请求数量上限
+                jitter(float): 每个周期的随机偏移，占采集周期的比例
+                writers(int): 保存采样结果的线程数量
+        """
+        self.collector = collector
+        self.interval = interval
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.jitter = jitter
+        self.writers = writers
+        self._semaphore = None
+        self._executor = None
+        self._tasks = {}
+
+    def run(self, stop):
+        """运行事件循环直到stop被设置
+
+        Args:
+                stop(threading.Event): 停止信号
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self._main(stop))
+        finally:
+            loop.close()
+            self.close()
+
+    def close(self):
+        """关闭保存采样结果的线程池，等待正在保存的采样完成
+        """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    async def record(self, server, info):
+        """在保存采样结果的线程池中调用 MetricsCollector.record
+
+        Returns:
+                Sample: 采样记录
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.writers)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, self.collector.record, server.id, info)
+
+    async def _main(self, stop):
+        loop = asyncio.get_event_loop()
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        try:
+            while not stop.is_set():
+                # 数据库或磁盘的临时错误只影响当前周期，下一个周期重试
+                try:
+                    servers = await loop.run_in_executor(None, self._servers)
+                    self._sync(servers)
+                    await loop.run_in_executor(
+                        None, self.collector.maintain, [server.id for server in servers])
+                except Exception:
+                    logger.exception('metrics collection cycle failed')
+                await loop.run_in_executor(None, stop.wait, self.interval)
+        finally:
+            tasks = [task for _, task in self._tasks.values()]
+            self._tasks.clear()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _servers(self):
+        with self.collector.app.app_context():
+            return self.collector.servers()
+
+    def _sync(self, servers):
+        """为新服务器启动采集任务，停止已删除服务器的任务，
+        连接信息改变或任务意外结束时重新启动任务
+        """
+        current = {}
+        for server in servers:
+            key = (server.host, server.port, server.password)
+            entry = self._tasks.get(server.id)
+            if entry is not None and entry[0] == key and not entry[1].done():
+                current[server.id] = entry
+                continue
+            if entry is not None:
+                entry[1].cancel()
+            current[server.id] = (key, asyncio.ensure_future(self._poll(server)))
+
+        for server_id, (_, task) in self._tasks.items():
+            if server_id not in current:
+                task.cancel()
+        self._tasks = current
+
+    async def fetch(self, server, connection=None):
+        """获取一次服务器的INFO，受并发数量和超时限制
+
+        Args:
+                server(Server): Redis服务器
+                connection(RespConnection): 已建立的连接，为空时新建连接
+
+        Returns:
+                tuple: (连接, INFO结果)
+        """
+        async with self._semaphore:
+            if connection is None:
+                connection = await asyncio.wait_for(
+                    RespConnection.open(server.host, server.port, server.password),
+                    self.timeout)
+            try:
+                info = await asyncio.wait_for(connection.info(), self.timeout)
+            except BaseException:
+                connection.close()
+                raise
+        return connection, info
+
+    async def collect_once(self, servers):
+        """对所有服务器并发执行一次INFO并保存结果
+
+        Returns:
+                list: 与servers一一对应，采集成功时为 Sample，失败时为异常
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def collect(server):
+            connection, info = await self.fetch(server)
+            connection.close()
+            return await self.record(server, info)
+
+        return await asyncio.gather(*[collect(server) for server in servers],
+                                    return_exceptions=True)
+
+    async def _poll(self, server):
+        """单个服务器的采集循环
+        """
+        loop = asyncio.get_event_loop()
+        connection = None
+        # 第一次采集的时间随机分布在一个周期内
+        deadline = loop.time() + random.uniform(0, self.interval)
+        try:
+            while True:
+                await asyncio.sleep(max(deadline - loop.time(), 0))
+                deadline += self.interval * (1 + random.uniform(-self.jitter, self.jitter))
+                # 落后超过一个周期时跳过错过的采样
+                if deadline < loop.time():
+                    deadline = loop.time() + self.interval
+
+                try:
+                    connection, info = await self.fetch(server, connection)
+                except (OSError, EOFError, asyncio.TimeoutError, RespError) as e:
+                    connection = None
+                    logger.warning('redis server %s collect failed: %r', server.host, e)
+                    continue
+                except Exception:
+                    connection = None
+                    logger.exception('redis server %s collect failed', server.host)
+                    continue
+                # 解析或保存采样失败时保留连接，下一个周期继续采集
+                try:
+                    await self.record(server, info)
+                except Exception:
+                    logger.exception('redis server %s record failed', server.host)
+        finally:
+            if connection is not None:
+                connection.close()
@@ -0,0 +1,126 @@
+"""rmon.metrics.fanout
+
+使用有界线程池并发访问多个Redis服务器
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from rmon.common.errors import RestError
+
+
+class Fanout:
+    """并发执行器
+
+    所有请求共享同一个线程池，线程数量有上限，单个服务器超时或无法访问时
+    只标记该服务器失败，不影响其他服务器的结果。
+    Redis连接设置了 socket 超时时间(REDIS_SOCKET_TIMEOUT、REDIS_SOCKET_CONNECT_TIMEOUT)，
+    无法访问的服务器不会一直占用线程
+    """
+
+    def __init__(self, app=None):
+        self.max_workers = 32
+        self.timeout = 5
+        self.queue_timeout = 5
+        self._executor = None
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """从app配置中读取线程池参数
+        """
+        self.max_workers = app.config.get('METRICS_FANOUT_WORKERS', self.max_workers)
+        self.timeout = app.config.get('METRICS_FANOUT_TIMEOUT', self.timeout)
+        self.queue_timeout = app.config.get('METRICS_FANOUT_QUEUE_TIMEOUT', self.queue_timeout)
+        app.extensions['fanout'] = self
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.max_workers, thread_name_prefix='rmon-fanout')
+        return self._executor
+
+    def map(self, func, servers, timeout=None, queue_timeout=None):
+        """对每个服务器并发执行func
+
+        超时时间从任务开始执行时计算，在线程池队列中等待的时间不计入；
+        在队列中等待超过 queue_timeout 仍未开始执行的任务被取消，不标记为服务器超时。
+        已经开始执行的任务无法取消，由连接的 socket 超时时间保证最终结束
+
+        Args:
+                func(callable): 以服务器为参数的函数
+                servers(list): 服务器列表
+                timeout(float): 单个服务器的最长执行时间(秒)，默认使用配置值
+                queue_timeout(float): 在线程池队列中等待的最长时间(秒)，默认使用配置值
+
+        Returns:
+                list: 与servers一一对应的 (ok, result) 元组，失败时result为错误信息
+        """
+        if timeout is None:
+            timeout = self.timeout
+        if queue_timeout is None:
+            queue_timeout = self.queue_timeout
+
+        # 每个任务开始执行的时间，由线程池中的线程设置
+        started = [None] * len(servers)
+
+        def call(index, server):
+            started[index] = time.monotonic()
+            return func(server)
+
+        submitted = time.monotonic()
+        futures = [self.executor.submit(call, index, server)
+                   for index, server in enumerate(servers)]
+        results = [None] * len(servers)
+        pending = set(range(len(servers)))
+
+        while pending:
+            now = time.monotonic()
+            deadlines = []
+            for index in list(pending):
+                future, server = futures[index], servers[index]
+                if future.done():
+                    results[index] = self._result(future)
+                elif started[index] is None:
+                    if now - submitted < queue_timeout:
+                        deadlines.append(submitted + queue_timeout)
+                        continue
+                    if not future.cancel():
+                        # 任务刚刚开始执行，下一轮按执行时间计算超时
+                        deadlines.append(now)
+                        continue
+                    results[index] = (False, 'redis server %s was not polled, '
+                                             'fanout workers are busy' % server.host)
+                elif now - started[index] >= timeout:
+                    results[index] = (False, 'redis server %s timed out' % server.host)
+                else:
+                    deadlines.append(started[index] + timeout)
+                    continue
+                pending.discard(index)
+
+            if pending:
+                wait([futures[index] for index in pending],
+                     timeout=max(min(deadlines) - now, 0.001), return_when=FIRST_COMPLETED)
+        return results
+
+    @staticmethod
+    def _result(future):
+        try:
+            return True, future.result()
+        except RestError as e:
+            return False, e.message
+        except Exception as e:
+            return False, str(e)
+
+    def shutdown(self):
+        """关闭线程池
+        """
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
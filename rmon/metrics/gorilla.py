@@ -0,0 +1,234 @@
+"""rmon.metrics.gorilla
+
+Gorilla 风格的时间序列压缩编码
+
+时间戳转换为毫秒整数后使用 delta-of-delta 编码，固定间隔采样时每个时间戳只占1位；
+数值与前一个数值按位异或，只保存有意义的位，变化缓慢的指标每个值只占几位。
+解码为流式，可以在读取到结束时间后提前停止
+"""
+import struct
+
+
+def _float_to_bits(value):
+    return struct.unpack('<Q', struct.pack('<d', value))[0]
+
+
+def _bits_to_float(bits):
+    return struct.unpack('<d', struct.pack('<Q', bits))[0]
+
+
+class BitWriter:
+    """按位写入
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+        self._acc = 0
+        self._nbits = 0
+
+    def write(self, value, nbits):
+        """写入value的低nbits位
+        """
+        self._acc = (self._acc << nbits) | (value & ((1 << nbits) - 1))
+        self._nbits += nbits
+        while self._nbits >= 8:
+            self._nbits -= 8
+            self.data.append((self._acc >> self._nbits) & 0xff)
+        self._acc &= (1 << self._nbits) - 1
+
+    def getvalue(self):
+        """返回已写入的字节，最后不足一个字节的部分以0补齐
+        """
+        if self._nbits:
+            return bytes(self.data) + bytes([(self._acc << (8 - self._nbits)) & 0xff])
+        return bytes(self.data)
+
+
+class BitReader:
+    """按位读取
+    """
+
+    def __init__(self, data, offset=0):
+        self.data = data
+        self.pos = offset * 8
+
+    def read(self, nbits):
+        value = 0
+        data, pos = self.data, self.pos
+        while nbits > 0:
+            byte = data[pos >> 3]
+            used = pos & 7
+            take = min(8 - used, nbits)
+            value = (value << take) | ((byte >> (8 - used - take)) & ((1 << take) - 1))
+            pos += take
+            nbits -= take
+        self.pos = pos
+        return value
+
+    def read_bit(self):
+        pos = self.pos
+        self.pos = pos + 1
+        return (self.data[pos >> 3] >> (7 - (pos & 7))) & 1
+
+
+def _signed(value, nbits):
+    """将nbits位的无符号数转换为有符号数
+    """
+    if value >= 1 << (nbits - 1):
+        value -= 1 << nbits
+    return value
+
+
+# delta-of-delta 的编码区间: (前缀, 前缀位数, 数值位数)
+_DOD_RANGES = (
+    (0b10, 2, 7),
+    (0b110, 3, 9),
+    (0b1110, 4, 12),
+)
+
+HEADER = struct.Struct('<I')
+
+
+class Encoder:
+    """流式编码器
+
+    Example:
+            encoder = Encoder()
+            encoder.append(timestamp, value)
+            data = encoder.getvalue()
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._bits = BitWriter()
+        self._timestamp = 0
+        self._delta = 0
+        self._value = 0
+        self._leading = -1
+        self._trailing = 0
+
+    def append(self, timestamp, value):
+        """追加一个采样点
+
+        Args:
+                timestamp(float): 时间戳(秒)，精确到毫秒
+                value(float): 指标值
+        """
+        ts = int(round(timestamp * 1000))
+        bits = _float_to_bits(value)
+        w = self._bits
+
+        if self.count == 0:
+            w.write(ts, 64)
+            w.write(bits, 64)
+        else:
+            delta = ts - self._timestamp
+            self._write_dod(delta - self._delta)
+            self._delta = delta
+            self._write_value(bits ^ self._value)
+
+        self._timestamp = ts
+        self._value = bits
+        self.count += 1
+
+    def _write_dod(self, dod):
+        w = self._bits
+        if dod == 0:
+            w.write(0, 1)
+            return
+        for prefix, prefix_bits, value_bits in _DOD_RANGES:
+            if -(1 << (value_bits - 1)) <= dod < (1 << (value_bits - 1)):
+                w.write(prefix, prefix_bits)
+                w.write(dod, value_bits)
+                return
+        w.write(0b1111, 4)
+        w.write(dod, 64)
+
+    def _write_value(self, xor):
+        w = self._bits
+        if xor == 0:
+            w.write(0, 1)
+            return
+        w.write(1, 1)
+
+        leading = min(64 - xor.bit_length(), 31)
+        trailing = (xor & -xor).bit_length() - 1
+        # 有意义的位落在上一个窗口内时复用窗口
+        if self._leading >= 0 and leading >= self._leading and trailing >= self._trailing:
+            w.write(0, 1)
+            w.write(xor >> self._trailing, 64 - self._leading - self._trailing)
+            return
+
+        length = 64 - leading - trailing
+        w.write(1, 1)
+        w.write(leading, 5)
+        # 长度范围为1~64，64以0表示
+        w.write(length & 63, 6)
+        w.write(xor >> trailing, length)
+        self._leading = leading
+        self._trailing = trailing
+
+    def getvalue(self):
+        """编码结果，前4字节为采样点数量
+        """
+        return HEADER.pack(self.count) + self._bits.getvalue()
+
+
+def encode(timestamps, values):
+    """编码时间序列
+
+    Returns:
+            bytes: 编码后的数据块
+    """
+    encoder = Encoder()
+    for timestamp, value in zip(timestamps, values):
+        encoder.append(timestamp, value)
+    return encoder.getvalue()
+
+
+def decode(data, offset=0):
+    """流式解码数据块
+
+    Args:
+            data(bytes): 编码后的数据，可以是mmap或memoryview
+            offset(int): 数据块在data中的偏移
+
+    Yields:
+            tuple: (timestamp, value)
+    """
+    count, = HEADER.unpack_from(data, offset)
+    if count == 0:
+        return
+    r = BitReader(data, offset + HEADER.size)
+
+    ts = r.read(64)
+    bits = r.read(64)
+    yield ts / 1000, _bits_to_float(bits)
+
+    delta = 0
+    leading = trailing = 0
+    for _ in range(count - 1):
+        # delta-of-delta，前缀依次为 0、10、110、1110、1111
+        if r.read_bit() == 0:
+            dod = 0
+        elif r.read_bit() == 0:
+            dod = _signed(r.read(7), 7)
+        elif r.read_bit() == 0:
+            dod = _signed(r.read(9), 9)
+        elif r.read_bit() == 0:
+            dod = _signed(r.read(12), 12)
+        else:
+            dod = _signed(r.read(64), 64)
+        delta += dod
+        ts += delta
+
+        # 异或值
+        if r.read_bit() == 1:
+            if r.read_bit() == 1:
+                leading = r.read(5)
+                length = r.read(6) or 64
+                trailing = 64 - leading - length
+            xor = r.read(64 - leading - trailing) << trailing
+            bits ^= xor
+
+        yield ts / 1000, _bits_to_float(bits)
@@ -0,0 +1,120 @@
+"""rmon.metrics.histogram
+
+可合并的对数分桶直方图
+
+值v落入第 floor(log2(v) * PRECISION) 个桶，每个桶的上下界之比为 2^(1/PRECISION)，
+分位数取桶的几何中点，相对误差不超过约4.4%。桶只与值有关，
+多个直方图(不同时间段、不同服务器)可以直接按桶累加合并，合并后的分位数与整体计算的一致
+"""
+import math
+
+
+PRECISION = 8
+
+
+def bucket_of(value):
+    """值所在的桶，小于1的值都计入第0个桶
+    """
+    if value <= 1:
+        return 0
+    return int(math.log2(value) * PRECISION)
+
+
+def bucket_value(index):
+    """桶的几何中点
+    """
+    return 2 ** ((index + 0.5) / PRECISION)
+
+
+class LogHistogram:
+    """对数分桶直方图，同时记录数量、总和、最小值和最大值
+    """
+    __slots__ = ('counts', 'count', 'total', 'min', 'max')
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value, count=1):
+        index = bucket_of(value)
+        self.counts[index] = self.counts.get(index, 0) + count
+        self.count += count
+        self.total += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """将另一个直方图累加到当前直方图
+        """
+        if not other.count:
+            return self
+        counts = self.counts
+        for index, count in other.counts.items():
+            counts[index] = counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+        return self
+
+    def quantiles(self, *qs):
+        """计算多个分位数，结果限制在最小值和最大值之间
+
+        Args:
+                qs(float): 0到1之间的分位数，如 0.5、0.99
+
+        Returns:
+                list: 与qs一一对应，没有数据时为None
+        """
+        if not self.count:
+            return [None] * len(qs)
+        ranks = sorted((max(math.ceil(q * self.count), 1), i) for i, q in enumerate(qs))
+        results = [None] * len(qs)
+        seen = 0
+        position = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            while position < len(ranks) and ranks[position][0] <= seen:
+                value = min(max(bucket_value(index), self.min), self.max)
+                results[ranks[position][1]] = value
+                position += 1
+            if position == len(ranks):
+                break
+        for _, i in ranks[position:]:
+            results[i] = self.max
+        return results
+
+    def quantile(self, q):
+        return self.quantiles(q)[0]
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def to_dict(self):
+        """序列化为json兼容的字典，可以通过 from_dict 还原后合并
+        """
+        return {
+            'counts': {str(index): count for index, count in self.counts.items()},
+            'count': self.count,
+            'total': self.total,
+            'min': self.min,
+            'max': self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls()
+        histogram.counts = {int(index): count for index, count in data['counts'].items()}
+        histogram.count = data['count']
+        histogram.total = data['total']
+        histogram.min = data['min']
+        histogram.max = data['max']
+        return histogram
@@ -0,0 +1,332 @@
+"""rmon.metrics.latency
+
+主动延迟探测
+
+每个服务器保持一个长连接，每个探测周期一次性发送多个 PING 指令(管道)，
+记录每个回复相对于发送时间的往返时间。往返时间按时间分桶保存在对数分桶直方图中，
+查询时合并指定时间范围内的桶；不同服务器的直方图可以直接合并，得到所有服务器整体的分位数
+"""
+import asyncio
+import logging
+import threading
+import time
+
+from rmon.metrics.engine import RespConnection, encode_command, read_reply, RespError
+from rmon.metrics.histogram import LogHistogram
+
+
+logger = logging.getLogger(__name__)
+
+
+def summarize(histogram):
+    """直方图的统计结果，时间单位为微秒
+    """
+    p50, p99, p999 = histogram.quantiles(0.5, 0.99, 0.999)
+    mean = histogram.mean
+
+    def rounded(value):
+        return None if value is None else round(value, 1)
+
+    return {
+        'count': histogram.count,
+        'min': rounded(histogram.min),
+        'max': rounded(histogram.max),
+        'mean': rounded(mean),
+        'p50': rounded(p50),
+        'p99': rounded(p99),
+        'p999': rounded(p999),
+    }
+
+
+class LatencySeries:
+    """单个服务器的往返时间，每 bucket 秒一个直方图，超过保留时间的桶被删除
+    """
+
+    def __init__(self, bucket=10, retention=3600):
+        self.bucket = bucket
+        self.retention = retention
+        self.errors = 0
+        self.last_error = None
+        self._buckets = {}
+
+    def record(self, timestamp, rtts):
+        """记录一次探测的往返时间
+
+        Args:
+                timestamp(float): 探测时间戳
+                rtts(list): 每个 PING 的往返时间(微秒)
+        """
+        start = int(timestamp - timestamp % self.bucket)
+        histogram = self._buckets.get(start)
+        if histogram is None:
+            histogram = self._buckets[start] = LogHistogram()
+            self.expire(timestamp)
+        for rtt in rtts:
+            histogram.add(rtt)
+
+    def error(self, timestamp, message):
+        self.errors += 1
+        self.last_error = {'timestamp': timestamp, 'message': message}
+
+    def expire(self, now):
+        oldest = now - self.retention
+        for start in [start for start in self._buckets if start + self.bucket <= oldest]:
+            del self._buckets[start]
+
+    def histogram(self, window, now=None):
+        """合并最近window秒内的桶
+        """
+        if now is None:
+            now = time.time()
+        since = now - window
+        merged = LogHistogram()
+        for start, histogram in self._buckets.items():
+            if start + self.bucket > since:
+                merged.merge(histogram)
+        return merged
+
+
+class LatencyProber:
+    """延迟探测器
+
+    LATENCY_PROBE_ENABLED 为 True 时在后台线程的事件循环中按 LATENCY_PROBE_INTERVAL 探测
+    监控信息采集器负责的所有服务器，每次发送 LATENCY_PROBE_PIPELINE 个 PING。
+    管道中后面的 PING 的往返时间包含前面 PING 的处理时间，反映的是一批指令的排队延迟
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.interval = 1
+        self.pipeline = 10
+        self.timeout = 2
+        self.bucket = 10
+        self.retention = 3600
+        self._series = {}
+        self._tasks = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """从app配置中读取探测参数，如果开启了探测则在处理第一个请求前启动后台线程
+        """
+        self.app = app
+        self.interval = app.config.get('LATENCY_PROBE_INTERVAL', self.interval)
+        self.pipeline = app.config.get('LATENCY_PROBE_PIPELINE', self.pipeline)
+        self.timeout = app.config.get('LATENCY_PROBE_TIMEOUT', self.timeout)
+        self.bucket = app.config.get('LATENCY_PROBE_BUCKET', self.bucket)
+        self.retention = app.config.get('LATENCY_PROBE_RETENTION', self.retention)
+        app.extensions['latency_prober'] = self
+
+        if app.config.get('LATENCY_PROBE_ENABLED', False):
+            app.before_first_request(self.start)
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """启动后台探测线程
+        """
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='rmon-latency', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self._main())
+        except Exception:
+            logger.exception('latency probe failed')
+        finally:
+            loop.close()
+
+    async def _main(self):
+        loop = asyncio.get_event_loop()
+        try:
+            while not self._stop.is_set():
+                # 数据库的临时错误只影响当前周期，下一个周期重试
+                try:
+                    servers = await loop.run_in_executor(None, self._servers)
+                    self._sync(servers)
+                except Exception:
+                    logger.exception('latency probe cycle failed')
+                # 服务器列表的同步周期与监控信息采集周期一致
+                await loop.run_in_executor(None, self._stop.wait, self._sync_interval())
+        finally:
+            tasks = [task for _, task in self._tasks.values()]
+            self._tasks.clear()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _servers(self):
+        from rmon.extensions import collector
+
+        with self.app.app_context():
+            return collector.servers()
+
+    def _sync_interval(self):
+        from rmon.extensions import collector
+
+        return collector.interval
+
+    def _sync(self, servers):
+        """为新服务器启动探测任务，停止已删除服务器的任务，
+        连接信息改变或任务意外结束时重新启动任务
+        """
+        current = {}
+        for server in servers:
+            key = (server.host, server.port, server.password)
+            entry = self._tasks.get(server.id)
+            if entry is not None and entry[0] == key and not entry[1].done():
+                current[server.id] = entry
+                continue
+            if entry is not None:
+                entry[1].cancel()
+            current[server.id] = (key, asyncio.ensure_future(self._poll(server)))
+
+        for server_id, (_, task) in self._tasks.items():
+            if server_id not in current:
+                task.cancel()
+                self.forget(server_id)
+        self._tasks = current
+
+    async def probe(self, server, connection=None):
+        """发送一批 PING 并测量每个回复的往返时间
+
+        Args:
+                server(Server): Redis服务器
+                connection(RespConnection): 已建立的连接，为空时新建连接
+
+        Returns:
+                tuple: (连接, 往返时间列表(微秒))
+        """
+        if connection is None:
+            connection = await asyncio.wait_for(
+                RespConnection.open(server.host, server.port, server.password), self.timeout)
+        try:
+            rtts = await asyncio.wait_for(self._ping(connection), self.timeout)
+        except BaseException:
+            connection.close()
+            raise
+        return connection, rtts
+
+    async def _ping(self, connection):
+        loop = asyncio.get_event_loop()
+        connection.writer.write(encode_command('PING') * self.pipeline)
+        sent = loop.time()
+        rtts = []
+        for _ in range(self.pipeline):
+            await read_reply(connection.reader)
+            rtts.append((loop.time() - sent) * 1e6)
+        return rtts
+
+    async def _poll(self, server):
+        """单个服务器的探测循环
+        """
+        loop = asyncio.get_event_loop()
+        connection = None
+        try:
+            while True:
+                started = loop.time()
+                try:
+                    connection, rtts = await self.probe(server, connection)
+                except (OSError, EOFError, asyncio.TimeoutError, RespError) as e:
+                    connection = None
+                    self.error(server.id, repr(e))
+                except Exception as e:
+                    connection = None
+                    logger.exception('redis server %s latency probe failed', server.id)
+                    self.error(server.id, repr(e))
+                else:
+                    self.record(server.id, rtts)
+                await asyncio.sleep(max(self.interval - (loop.time() - started), 0))
+        finally:
+            if connection is not None:
+                connection.close()
+
+    def probe_once(self, server):
+        """在当前线程中探测一次，后台探测没有开启时使用
+
+        Returns:
+                list: 往返时间列表(微秒)
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            connection, rtts = loop.run_until_complete(self.probe(server))
+            connection.close()
+        finally:
+            loop.close()
+        self.record(server.id, rtts)
+        return rtts
+
+    def _get(self, server_id):
+        series = self._series.get(server_id)
+        if series is None:
+            series = self._series[server_id] = LatencySeries(self.bucket, self.retention)
+        return series
+
+    def record(self, server_id, rtts, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            self._get(server_id).record(timestamp, rtts)
+
+    def error(self, server_id, message, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        logger.warning('redis server %s latency probe failed: %s', server_id, message)
+        with self._lock:
+            self._get(server_id).error(timestamp, message)
+
+    def histogram(self, server_id, window):
+        """服务器最近window秒的往返时间直方图，没有探测记录时返回None
+        """
+        with self._lock:
+            series = self._series.get(server_id)
+            if series is None:
+                return None
+            return series.histogram(window)
+
+    def summary(self, server_id, window):
+        """服务器最近window秒的往返时间统计，没有探测记录时返回None
+        """
+        with self._lock:
+            series = self._series.get(server_id)
+            if series is None:
+                return None
+            data = summarize(series.histogram(window))
+            data['errors'] = series.errors
+            data['last_error'] = series.last_error
+        return data
+
+    def merged(self, server_ids, window):
+        """多个服务器合并后的往返时间直方图
+        """
+        merged = LogHistogram()
+        with self._lock:
+            for server_id in server_ids:
+                series = self._series.get(server_id)
+                if series is not None:
+                    merged.merge(series.histogram(window))
+        return merged
+
+    def forget(self, server_id):
+        with self._lock:
+            self._series.pop(server_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
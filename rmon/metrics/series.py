@@ -0,0 +1,103 @@
+"""rmon.metrics.series
+
+基于array实现的定长环形缓冲区，用于在内存中保存每个服务器的监控指标历史
+"""
+import math
+from array import array
+
+
+NAN = float('nan')
+
+
+def parse_info(info, prefix=''):
+    """将INFO指令返回的字典展开为数值指标
+
+    嵌套的字典(如 db0 的 keys、expires)展开为 ``db0.keys`` 形式，
+    字符串类型的字段(如 redis_version)被忽略
+
+    Args:
+            info(dict): INFO指令返回结果
+
+    Returns:
+            dict: 指标名称到浮点数值的映射
+    """
+    values = {}
+    for key, value in info.items():
+        name = prefix + key
+        if isinstance(value, dict):
+            values.update(parse_info(value, name + '.'))
+        elif isinstance(value, (bool, int, float)):
+            values[name] = float(value)
+    return values
+
+
+class ServerSeries:
+    """单个服务器的监控指标历史
+
+    所有指标共享同一个写入位置，缺失的采样点以NaN填充，
+    缓冲区写满后覆盖最早的数据，因此内存占用固定为 capacity * (指标数 + 1) * 8 字节
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.count = 0
+        self._timestamps = array('d', [NAN]) * capacity
+        self._metrics = {}
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, timestamp, values):
+        """写入一个采样点
+
+        Args:
+                timestamp(float): 采样时间戳
+                values(dict): 指标名称到数值的映射
+        """
+        index = self.count % self.capacity
+        self._timestamps[index] = timestamp
+
+        for name, buf in self._metrics.items():
+            buf[index] = values.get(name, NAN)
+
+        for name in values.keys() - self._metrics.keys():
+            buf = array('d', [NAN]) * self.capacity
+            buf[index] = values[name]
+            self._metrics[name] = buf
+
+        self.count += 1
+
+    def names(self):
+        """所有指标名称
+        """
+        return sorted(self._metrics)
+
+    def _ordered(self, buf):
+        """按时间先后顺序返回缓冲区内容
+        """
+        if self.count <= self.capacity:
+            return buf[:self.count]
+        index = self.count % self.capacity
+        return buf[index:] + buf[:index]
+
+    def timestamps(self):
+        """按时间先后顺序返回所有采样时间戳
+        """
+        return self._ordered(self._timestamps)
+
+    def series(self, name):
+        """按时间先后顺序返回指标的所有采样值，指标不存在时返回None
+        """
+        buf = self._metrics.get(name)
+        if buf is None:
+            return None
+        return self._ordered(buf)
+
+    def latest(self):
+        """最新采样点的所有非NaN指标值
+        """
+        if self.count == 0:
+            return {}
+        index = (self.count - 1) % self.capacity
+        return {name: buf[index] for name, buf in self._metrics.items()
+                if not math.isnan(buf[index])}
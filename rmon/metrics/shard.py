@@ -0,0 +1,90 @@
+"""rmon.metrics.shard
+
+一致性哈希，将服务器分配给多个采集进程
+"""
+import bisect
+import hashlib
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """一致性哈希环
+
+    每个节点在环上有 replicas 个虚拟节点，增加或删除一个节点时，
+    只有大约 1/N 的key会改变所属的节点
+    """
+
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self._keys = []
+        self._nodes = []
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        """增加节点
+        """
+        for i in range(self.replicas):
+            key = _hash('%s-%d' % (node, i))
+            index = bisect.bisect(self._keys, key)
+            self._keys.insert(index, key)
+            self._nodes.insert(index, node)
+
+    def remove(self, node):
+        """删除节点
+        """
+        pairs = [(key, n) for key, n in zip(self._keys, self._nodes) if n != node]
+        self._keys = [key for key, _ in pairs]
+        self._nodes = [n for _, n in pairs]
+
+    def get(self, key):
+        """key所属的节点，环为空时返回None
+        """
+        if not self._keys:
+            return None
+        index = bisect.bisect(self._keys, _hash(str(key))) % len(self._keys)
+        return self._nodes[index]
+
+    def __len__(self):
+        return len(set(self._nodes))
+
+
+class Shard:
+    """采集进程负责的服务器
+
+    采集进程的数量可以在运行时改变(例如 multiprocessing.Value)，
+    数量改变后根据新的哈希环重新分配服务器
+    """
+
+    def __init__(self, index, size, replicas=100):
+        """
+        Args:
+                index(int): 当前进程的编号
+                size(int or multiprocessing.Value): 采集进程数量
+                replicas(int): 每个进程的虚拟节点数量
+        """
+        self.index = index
+        self.size = size
+        self.replicas = replicas
+        self._ring = None
+        self._ring_size = None
+
+    @property
+    def current_size(self):
+        return getattr(self.size, 'value', self.size)
+
+    @property
+    def ring(self):
+        size = self.current_size
+        if size != self._ring_size:
+            self._ring = HashRing(range(size), self.replicas)
+            self._ring_size = size
+        return self._ring
+
+    def owns(self, server_id):
+        """服务器是否由当前进程采集
+        """
+        return self.ring.get(server_id) == self.index
@@ -0,0 +1,218 @@
+"""rmon.metrics.snapshot
+
+多进程共享的最新监控信息快照
+
+快照保存在mmap的文件中，采集进程写入，所有web进程直接读取，不需要各自访问Redis服务器。
+文件为固定布局，服务器id为n的快照保存在第n-1个槽中：
+
+    文件头: magic(8字节) | 槽数量(uint32) | 槽大小(uint32) | 填充至64字节
+    槽: 序号(uint64) | 服务器id(uint32) | 数据长度(uint32) | 采样时间戳(float64) | 数据
+
+数据为监控信息API的json响应，不小于 JSON_COMPRESS_MIN_SIZE 时为gzip压缩后的响应，
+读取后可以直接作为响应体，web进程不需要为每个请求序列化和压缩。
+
+每个槽使用seqlock保证一致性：写入前序号加1变为奇数，写入完成后再加1变为偶数，
+读取时序号为奇数或者读取前后序号不同说明读到了正在写入的数据，需要重试。
+多个进程写入同一个槽时通过文件锁互斥，读取不加锁
+"""
+import fcntl
+import gzip
+import logging
+import mmap
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'RMSNAP01'
+HEADER = struct.Struct('<8sII')
+HEADER_SIZE = 64
+SEQUENCE = struct.Struct('<Q')
+SLOT_HEADER = struct.Struct('<IId')
+SLOT_HEADER_SIZE = SEQUENCE.size + SLOT_HEADER.size
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def is_compressed(data):
+    """快照数据是否为gzip压缩后的响应，json响应不会以gzip文件头开始
+    """
+    return data[:2] == GZIP_MAGIC
+
+
+def decompress(data):
+    """快照数据对应的json响应
+    """
+    return gzip.decompress(data) if is_compressed(data) else data
+
+
+class MetricsSnapshot:
+    """最新监控信息快照
+
+    没有配置 METRICS_SNAPSHOT_PATH 时不启用
+    """
+
+    def __init__(self, app=None):
+        self.path = None
+        self.slots = 4096
+        self.slot_size = 32768
+        self.retries = 10
+        self._file = None
+        self._mmap = None
+        # 文件锁只在进程之间互斥，同一进程的多个线程还需要线程锁
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """从app配置中读取快照参数并映射快照文件
+        """
+        self.close()
+        self.path = app.config.get('METRICS_SNAPSHOT_PATH', self.path)
+        self.slots = app.config.get('METRICS_SNAPSHOT_SLOTS', self.slots)
+        self.slot_size = app.config.get('METRICS_SNAPSHOT_SLOT_SIZE', self.slot_size)
+        app.extensions['metrics_snapshot'] = self
+
+        if self.path:
+            self.open()
+
+    @property
+    def enabled(self):
+        return self._mmap is not None
+
+    def open(self):
+        """打开快照文件，文件不存在或布局与配置不一致时重新创建
+
+        文件大小为 槽数量 x 槽大小，只有写入过的页面占用磁盘和内存
+        """
+        size = HEADER_SIZE + self.slots * self.slot_size
+        header = HEADER.pack(MAGIC, self.slots, self.slot_size)
+        f = open(self.path, 'a+b')
+        try:
+            fcntl.lockf(f, fcntl.LOCK_EX, HEADER_SIZE, 0)
+            f.seek(0)
+            if f.read(HEADER.size) != header:
+                f.truncate(0)
+                f.truncate(size)
+                f.seek(0)
+                f.write(header)
+                f.flush()
+            fcntl.lockf(f, fcntl.LOCK_UN, HEADER_SIZE, 0)
+            self._mmap = mmap.mmap(f.fileno(), size)
+        except Exception:
+            f.close()
+            raise
+        self._file = f
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _offset(self, server_id):
+        """服务器对应的槽偏移，服务器id超出槽数量时返回None
+        """
+        if not 1 <= server_id <= self.slots:
+            return None
+        return HEADER_SIZE + (server_id - 1) * self.slot_size
+
+    def write(self, server_id, timestamp, data):
+        """写入服务器的最新监控信息
+
+        Args:
+                server_id(int): 服务器id
+                timestamp(float): 采样时间戳
+                data(bytes): 监控信息API的json响应或gzip压缩后的响应
+
+        Returns:
+                bool: 服务器id超出槽数量或者数据超过槽大小时不写入，返回False
+        """
+        if not self.enabled:
+            return False
+        offset = self._offset(server_id)
+        if offset is None or len(data) > self.slot_size - SLOT_HEADER_SIZE:
+            return False
+
+        with self._locked(offset):
+            sequence = self._begin(offset)
+            start = offset + SLOT_HEADER_SIZE
+            self._mmap[start:start + len(data)] = data
+            SLOT_HEADER.pack_into(self._mmap, offset + SEQUENCE.size,
+                                  server_id, len(data), timestamp)
+            SEQUENCE.pack_into(self._mmap, offset, sequence + 1)
+        return True
+
+    def remove(self, server_id):
+        """删除服务器的快照
+        """
+        if not self.enabled:
+            return
+        offset = self._offset(server_id)
+        if offset is None:
+            return
+        with self._locked(offset):
+            sequence = self._begin(offset)
+            SLOT_HEADER.pack_into(self._mmap, offset + SEQUENCE.size, 0, 0, 0.0)
+            SEQUENCE.pack_into(self._mmap, offset, sequence + 1)
+
+    @contextmanager
+    def _locked(self, offset):
+        with self._lock:
+            fcntl.lockf(self._file, fcntl.LOCK_EX, self.slot_size, offset)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._file, fcntl.LOCK_UN, self.slot_size, offset)
+
+    def _begin(self, offset):
+        """开始写入，将序号改为奇数并返回
+        """
+        sequence, = SEQUENCE.unpack_from(self._mmap, offset)
+        # 序号为奇数说明上一次写入的进程在写入过程中退出
+        sequence += 1 if sequence % 2 == 0 else 2
+        SEQUENCE.pack_into(self._mmap, offset, sequence)
+        return sequence
+
+    def read(self, server_id, max_age=None):
+        """读取服务器的最新监控信息，不加锁
+
+        数据从槽中复制一次: 复制完成后序号没有变化才能确认读到的是完整的数据，
+        WSGI服务器也要求响应体为bytes，不能直接使用槽的memoryview
+
+        Args:
+                server_id(int): 服务器id
+                max_age(float): 采样时间超过该秒数时认为已过期
+
+        Returns:
+                tuple: (采样时间戳, 数据)，没有快照、快照已过期或多次重试仍在写入时返回None
+        """
+        if not self.enabled:
+            return None
+        offset = self._offset(server_id)
+        if offset is None:
+            return None
+
+        mm = self._mmap
+        start = offset + SLOT_HEADER_SIZE
+        for _ in range(self.retries):
+            before, = SEQUENCE.unpack_from(mm, offset)
+            if before % 2:
+                continue
+            sid, length, timestamp = SLOT_HEADER.unpack_from(mm, offset + SEQUENCE.size)
+            length = min(length, self.slot_size - SLOT_HEADER_SIZE)
+            data = mm[start:start + length]
+            after, = SEQUENCE.unpack_from(mm, offset)
+            if before == after:
+                if sid != server_id or not length:
+                    return None
+                if max_age is not None and time.time() - timestamp > max_age:
+                    return None
+                return timestamp, data
+        logger.debug('snapshot of server %s is being written', server_id)
+        return None
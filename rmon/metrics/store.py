@@ -0,0 +1,561 @@
+"""rmon.metrics.store
+
+监控指标的磁盘存储
+
+每个服务器一个目录，目录下按时间切分为多个段文件，文件名为段的起始时间戳。
+段文件由文件头和定长记录组成：
+
+    magic(8字节) | 文件头长度(uint32) | 指标名称列表(json) | 填充至8字节对齐
+    记录: 时间戳(float64) | 指标1(float64) | 指标2(float64) | ...
+
+记录只追加写入，读取时使用mmap按列取值，段文件的起始时间戳构成时间索引，
+超过保留时间的段文件整体删除。
+
+不再写入的段文件会被压缩为 Gorilla 编码的压缩段文件(.gor)：
+
+    magic(8字节) | 文件头长度(uint32) | 指标名称到数据块偏移的映射(json) | 数据块...
+"""
+import bisect
+import heapq
+import json
+import logging
+import mmap
+import os
+import shutil
+import struct
+import threading
+import time
+from array import array
+from operator import itemgetter
+
+from rmon.metrics.gorilla import encode, decode
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'RMSEG001'
+COMPRESSED_MAGIC = b'RMGOR001'
+SEGMENT_SUFFIX = '.seg'
+COMPRESSED_SUFFIX = '.gor'
+NAN = float('nan')
+
+
+def write_header(f, meta, magic=MAGIC):
+    """写入段文件头
+    """
+    meta = json.dumps(meta).encode('utf-8')
+    length = len(magic) + 4 + len(meta)
+    padding = -length % 8
+    f.write(magic + struct.pack('<I', length + padding) + meta + b' ' * padding)
+
+
+def read_header(buf, magic=MAGIC):
+    """读取段文件头
+
+    Returns:
+            tuple: (文件头长度, 文件头中的json数据)
+    """
+    if bytes(buf[:len(magic)]) != magic:
+        raise ValueError('invalid segment file')
+    offset = len(magic)
+    length, = struct.unpack_from('<I', buf, offset)
+    meta = json.loads(bytes(buf[offset + 4:length]).decode('utf-8'))
+    return length, meta
+
+
+class _Column:
+    """记录中的一列，用于二分查找时间戳
+    """
+
+    def __init__(self, values, width, index=0):
+        self.values = values
+        self.width = width
+        self.index = index
+
+    def __len__(self):
+        return len(self.values) // self.width
+
+    def __getitem__(self, i):
+        return self.values[i * self.width + self.index]
+
+
+class Segment:
+    """只读的段文件，使用mmap访问
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.header_size, self.names = read_header(self._mmap)
+        self.width = len(self.names) + 1
+        records = (len(self._mmap) - self.header_size) // (self.width * 8)
+        self._view = memoryview(self._mmap)[
+            self.header_size:self.header_size + records * self.width * 8].cast('d')
+
+    def __len__(self):
+        return len(self._view) // self.width
+
+    def end(self):
+        """最后一条记录的时间戳，没有记录时返回None
+        """
+        count = len(self)
+        return self._view[(count - 1) * self.width] if count else None
+
+    def close(self):
+        self._view.release()
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def read(self, metric, start=None, end=None):
+        """读取时间范围内的指标值
+
+        Returns:
+                tuple: (timestamps, values)，指标不存在时返回None
+        """
+        if metric not in self.names:
+            return None
+        column = self.names.index(metric) + 1
+
+        timestamps = _Column(self._view, self.width)
+        lo = 0 if start is None else bisect.bisect_left(timestamps, start)
+        hi = len(timestamps) if end is None else bisect.bisect_right(timestamps, end)
+        if lo >= hi:
+            return [], []
+
+        if np is not None:
+            records = np.frombuffer(self._view, dtype='f8').reshape(-1, self.width)[lo:hi]
+            return records[:, 0].tolist(), records[:, column].tolist()
+
+        records = self._view[lo * self.width:hi * self.width]
+        return records[::self.width].tolist(), records[column::self.width].tolist()
+
+
+class CompressedSegment:
+    """只读的压缩段文件，每个指标一个 Gorilla 数据块，读取时流式解码
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.header_size, self.offsets = read_header(self._mmap, COMPRESSED_MAGIC)
+
+    def close(self):
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def end(self):
+        """最后一条记录的时间戳，需要解码一个指标的全部数据，没有记录时返回None
+        """
+        timestamp = None
+        for offset in self.offsets.values():
+            for timestamp, _ in decode(self._mmap, self.header_size + offset):
+                pass
+            break
+        return timestamp
+
+    def read(self, metric, start=None, end=None):
+        """读取时间范围内的指标值
+
+        Returns:
+                tuple: (timestamps, values)，指标不存在时返回None
+        """
+        offset = self.offsets.get(metric)
+        if offset is None:
+            return None
+        timestamps, values = [], []
+        for timestamp, value in decode(self._mmap, self.header_size + offset):
+            if start is not None and timestamp < start:
+                continue
+            if end is not None and timestamp > end:
+                break
+            timestamps.append(timestamp)
+            values.append(value)
+        return timestamps, values
+
+
+def compress_segment(path):
+    """将段文件压缩为压缩段文件，并删除原文件
+
+    Returns:
+            str: 压缩段文件路径
+    """
+    blocks = []
+    with Segment(path) as segment:
+        for name in segment.names:
+            blocks.append((name, encode(*segment.read(name))))
+
+    offsets = {}
+    position = 0
+    for name, block in blocks:
+        offsets[name] = position
+        position += len(block)
+
+    target = path[:-len(SEGMENT_SUFFIX)] + COMPRESSED_SUFFIX
+    tmp = target + '.tmp'
+    with open(tmp, 'wb') as f:
+        write_header(f, offsets, COMPRESSED_MAGIC)
+        for _, block in blocks:
+            f.write(block)
+    os.replace(tmp, target)
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    return target
+
+
+def merge_runs(runs):
+    """合并多段各自按时间排序的采样
+
+    Args:
+            runs(list): (timestamps, values) 列表，每段不为空
+
+    Returns:
+            tuple: 按时间排序的 (timestamps, values)
+    """
+    timestamps, values = [], []
+    if all(a[0][-1] <= b[0][0] for a, b in zip(runs, runs[1:])):
+        for run_timestamps, run_values in runs:
+            timestamps.extend(run_timestamps)
+            values.extend(run_values)
+        return timestamps, values
+
+    # 段之间时间范围重叠时按时间戳归并
+    for timestamp, value in heapq.merge(*[zip(*run) for run in runs], key=itemgetter(0)):
+        timestamps.append(timestamp)
+        values.append(value)
+    return timestamps, values
+
+
+class MetricStore:
+    """监控指标磁盘存储
+
+    append 只写入内存缓冲区，缓冲区已满或最早的采样超过 flush_interval 秒时批量写入磁盘，
+    web 进程只通过 mmap 读取，不承担写入开销。
+    flush_interval 需要小于内存中历史记录覆盖的时间，否则查询时可能缺少尚未写入的采样
+    """
+
+    def __init__(self, app=None):
+        self.path = None
+        self.segment_duration = 3600
+        self.retention = 7 * 24 * 3600
+        self.buffer_size = 1000
+        self.flush_interval = 300
+        self.compress = True
+
+        self._buffers = {}
+        self._writers = {}
+        self._index = {}
+        # 压缩段文件不再修改，缓存其最后一条记录的时间戳
+        self._ends = {}
+        self._lock = threading.Lock()
+        # 保护段文件的写入和 _writers，同一服务器的多批采样按顺序写入
+        self._write_lock = threading.RLock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """从app配置中读取存储参数，没有配置 METRICS_STORE_PATH 时不启用
+        """
+        self.path = app.config.get('METRICS_STORE_PATH', self.path)
+        self.segment_duration = app.config.get(
+            'METRICS_STORE_SEGMENT_DURATION', self.segment_duration)
+        self.retention = app.config.get('METRICS_STORE_RETENTION', self.retention)
+        self.buffer_size = app.config.get('METRICS_STORE_BUFFER_SIZE', self.buffer_size)
+        self.flush_interval = app.config.get('METRICS_STORE_FLUSH_INTERVAL', self.flush_interval)
+        self.compress = app.config.get('METRICS_STORE_COMPRESS', self.compress)
+        app.extensions['metric_store'] = self
+
+        if self.path:
+            os.makedirs(self.path, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def _server_path(self, server_id):
+        return os.path.join(self.path, str(server_id))
+
+    def _segment_path(self, server_id, start):
+        """段文件路径，已经压缩的段文件返回压缩段文件路径
+        """
+        path = os.path.join(self._server_path(server_id), str(start))
+        if os.path.exists(path + COMPRESSED_SUFFIX):
+            return path + COMPRESSED_SUFFIX
+        return path + SEGMENT_SUFFIX
+
+    def append(self, server_id, timestamp, values):
+        """写入一个采样点到缓冲区
+
+        Args:
+                server_id(int): 服务器id
+                timestamp(float): 采样时间戳
+                values(dict): 指标名称到数值的映射
+        """
+        with self._lock:
+            buf = self._buffers.setdefault(server_id, [])
+            buf.append((timestamp, values))
+            full = len(buf) >= self.buffer_size
+        if full:
+            self.flush(server_id)
+
+    def flush(self, server_id=None):
+        """将缓冲区写入磁盘
+
+        Args:
+                server_id(int): 只写入该服务器的缓冲区，默认写入所有服务器
+        """
+        with self._write_lock:
+            with self._lock:
+                if server_id is None:
+                    buffers, self._buffers = self._buffers, {}
+                else:
+                    buffers = {server_id: self._buffers.pop(server_id, [])}
+            self._write_buffers(buffers)
+
+    def flush_due(self, now=None):
+        """将最早的采样超过 flush_interval 秒的缓冲区写入磁盘，由采集线程在每个采集周期结束后调用
+        """
+        if now is None:
+            now = time.time()
+        deadline = now - self.flush_interval
+        with self._write_lock:
+            with self._lock:
+                due = [sid for sid, samples in self._buffers.items()
+                       if samples and samples[0][0] <= deadline]
+                buffers = {sid: self._buffers.pop(sid) for sid in due}
+            self._write_buffers(buffers)
+
+    def _write_buffers(self, buffers):
+        """写入多个服务器的缓冲区，调用者需持有写入锁
+        """
+        for sid, samples in buffers.items():
+            if samples:
+                try:
+                    self._write(sid, samples)
+                except OSError:
+                    logger.exception('write metrics of server %s failed', sid)
+
+    def _write(self, server_id, samples):
+        """将一批采样写入服务器当前的段文件，必要时创建新的段文件，调用者需持有写入锁
+        """
+        names = set()
+        for _, values in samples:
+            names.update(values)
+
+        writer = self._writers.get(server_id)
+        first = samples[0][0]
+        if writer is not None:
+            start, path, schema = writer
+            if not names <= set(schema) or first - start >= self.segment_duration:
+                writer = None
+        if writer is None:
+            writer = self._open_segment(server_id, first, sorted(names))
+            self._writers[server_id] = writer
+        _, path, schema = writer
+
+        records = array('d')
+        for timestamp, values in samples:
+            records.append(timestamp)
+            records.extend(values.get(name, NAN) for name in schema)
+        with open(path, 'ab') as f:
+            records.tofile(f)
+
+    def _open_segment(self, server_id, timestamp, names):
+        """创建新的段文件
+        """
+        directory = self._server_path(server_id)
+        os.makedirs(directory, exist_ok=True)
+        start = int(timestamp)
+        while True:
+            base = os.path.join(directory, str(start))
+            # 同一秒内重建段文件(例如指标集合发生变化)或其他进程同时创建段文件时，
+            # 通过 O_EXCL 保证不会截断已有的段文件，文件名已被占用时顺延一秒
+            if not os.path.exists(base + COMPRESSED_SUFFIX):
+                try:
+                    fd = os.open(base + SEGMENT_SUFFIX, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+                    break
+                except FileExistsError:
+                    pass
+            start += 1
+        path = base + SEGMENT_SUFFIX
+        with open(fd, 'wb') as f:
+            write_header(f, names)
+        self._index.pop(server_id, None)
+        return start, path, names
+
+    def segments(self, server_id):
+        """服务器所有段文件的起始时间戳，按时间先后排序
+        """
+        starts = self._index.get(server_id)
+        if starts is None:
+            try:
+                files = os.listdir(self._server_path(server_id))
+            except FileNotFoundError:
+                files = []
+            starts = sorted({int(name[:-len(SEGMENT_SUFFIX)]) for name in files
+                             if name.endswith((SEGMENT_SUFFIX, COMPRESSED_SUFFIX))})
+            self._index[server_id] = starts
+        return starts
+
+    @staticmethod
+    def _open(path):
+        segment_class = CompressedSegment if path.endswith(COMPRESSED_SUFFIX) else Segment
+        return segment_class(path)
+
+    def _segment_end(self, server_id, segment_start):
+        """段文件最后一条记录的时间戳，段文件不存在或没有记录时返回None
+        """
+        ends = self._ends.setdefault(server_id, {})
+        if segment_start in ends:
+            return ends[segment_start]
+        path = self._segment_path(server_id, segment_start)
+        try:
+            with self._open(path) as segment:
+                end = segment.end()
+        except (FileNotFoundError, ValueError):
+            return None
+        if path.endswith(COMPRESSED_SUFFIX):
+            ends[segment_start] = end
+        return end
+
+    def query(self, server_id, metric, start=None, end=None):
+        """读取时间范围内的指标值
+
+        服务器在采集进程之间迁移时，新旧进程的段文件时间范围可能重叠，
+        各段文件的结果按时间戳归并
+
+        Returns:
+                tuple: (timestamps, values)
+        """
+        # 其他进程可能创建了新的段文件，重新读取目录
+        self._index.pop(server_id, None)
+        starts = self.segments(server_id)
+
+        # 第一个可能包含 start 的段文件，之前的段文件与其时间范围重叠时也需要读取
+        first = 0 if start is None else max(bisect.bisect_right(starts, start) - 1, 0)
+        while first > 0:
+            previous_end = self._segment_end(server_id, starts[first - 1])
+            if previous_end is None or previous_end < start:
+                break
+            first -= 1
+
+        runs = []
+        for segment_start in starts[first:]:
+            if end is not None and segment_start > end:
+                break
+            try:
+                with self._open(self._segment_path(server_id, segment_start)) as segment:
+                    result = segment.read(metric, start, end)
+            except (FileNotFoundError, ValueError):
+                continue
+            if result is not None and result[0]:
+                runs.append(result)
+
+        # 当前进程中尚未写入磁盘的采样
+        with self._lock:
+            buffered = list(self._buffers.get(server_id, ()))
+        buffered = [(timestamp, sample[metric]) for timestamp, sample in buffered
+                    if metric in sample and (start is None or timestamp >= start)
+                    and (end is None or timestamp <= end)]
+        if buffered:
+            runs.append(tuple(list(column) for column in zip(*buffered)))
+        return merge_runs(runs)
+
+    def _server_ids(self):
+        return [int(name) for name in os.listdir(self.path) if name.isdigit()]
+
+    def compact(self, server_ids=None):
+        """压缩不再写入的段文件
+
+        每个服务器最后一个段文件以及正在写入的段文件不压缩
+
+        Args:
+                server_ids(iterable): 只压缩这些服务器的段文件，默认为所有服务器
+        """
+        if not self.enabled or not self.compress:
+            return
+
+        for server_id in self._server_ids() if server_ids is None else server_ids:
+            with self._write_lock:
+                writer = self._writers.get(server_id)
+            current = writer[0] if writer is not None else None
+            for segment_start in self.segments(server_id)[:-1]:
+                path = self._segment_path(server_id, segment_start)
+                if segment_start == current or not path.endswith(SEGMENT_SUFFIX):
+                    continue
+                try:
+                    compress_segment(path)
+                except (OSError, ValueError):
+                    logger.exception('compress segment %s failed', path)
+
+    def purge(self, now=None, server_ids=None):
+        """删除超过保留时间的段文件
+
+        段文件的结束时间为下一个段文件的起始时间，最后一个段文件始终保留
+
+        Args:
+                now(float): 当前时间戳
+                server_ids(iterable): 只清理这些服务器的段文件，默认为所有服务器
+        """
+        if not self.enabled:
+            return
+        if now is None:
+            now = time.time()
+        deadline = now - self.retention
+
+        for server_id in self._server_ids() if server_ids is None else server_ids:
+            starts = self.segments(server_id)
+            for segment_start, next_start in zip(starts, starts[1:]):
+                if next_start > deadline:
+                    break
+                try:
+                    os.remove(self._segment_path(server_id, segment_start))
+                except FileNotFoundError:
+                    # 其他进程已经删除或压缩了该段文件
+                    pass
+            self._index.pop(server_id, None)
+            ends = self._ends.get(server_id)
+            if ends:
+                remaining = set(self.segments(server_id))
+                self._ends[server_id] = {segment_start: segment_end
+                                         for segment_start, segment_end in ends.items()
+                                         if segment_start in remaining}
+
+    def release(self, server_id):
+        """写入服务器缓冲的采样并关闭其段文件，之后的采样写入新的段文件
+        """
+        with self._write_lock:
+            self.flush(server_id)
+            self._writers.pop(server_id, None)
+        self._index.pop(server_id, None)
+
+    def forget(self, server_id):
+        """删除服务器的所有数据
+        """
+        with self._write_lock:
+            with self._lock:
+                self._buffers.pop(server_id, None)
+            self._writers.pop(server_id, None)
+        self._index.pop(server_id, None)
+        self._ends.pop(server_id, None)
+        if self.enabled:
+            shutil.rmtree(self._server_path(server_id), ignore_errors=True)
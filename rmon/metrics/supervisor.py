@@ -0,0 +1,135 @@
+"""rmon.metrics.supervisor
+
+多进程监控信息采集
+
+解析INFO结果受GIL限制，单个进程无法利用多个CPU核心。管理进程启动多个采集进程，
+每个采集进程只采集一致性哈希分配给它的服务器，采样写入共享的 MetricStore，
+web进程从磁盘存储中读取
+"""
+import logging
+import multiprocessing
+import signal
+import time
+
+from rmon.metrics.shard import Shard
+
+
+logger = logging.getLogger(__name__)
+
+
+def run_worker(index, size, replicas):
+    """采集进程入口
+
+    Args:
+            index(int): 采集进程编号
+            size(multiprocessing.Value): 采集进程数量，编号不小于该值时退出
+            replicas(int): 一致性哈希每个进程的虚拟节点数量
+    """
+    from rmon.app import create_app
+    from rmon.extensions import collector, metric_store, slowlog_collector, latency_prober
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+
+    # 采集进程不处理请求，开启的采集器需要在这里启动
+    app = create_app()
+    collector.shard = Shard(index, size, replicas)
+    collector.start()
+    # 慢查询采集器和延迟探测器只处理当前采集进程负责的服务器
+    if app.config['SLOWLOG_COLLECTOR_ENABLED']:
+        slowlog_collector.start()
+    if app.config['LATENCY_PROBE_ENABLED']:
+        latency_prober.start()
+    logger.info('collector worker %d started', index)
+    try:
+        while not stopping and index < size.value:
+            time.sleep(1)
+    finally:
+        slowlog_collector.stop()
+        latency_prober.stop()
+        collector.stop()
+        metric_store.flush()
+    logger.info('collector worker %d stopped', index)
+
+
+class CollectorSupervisor:
+    """采集进程管理
+
+    启动并监控采集进程，采集进程异常退出时重新启动。
+    收到 SIGTTIN 时增加一个采集进程，收到 SIGTTOU 时减少一个，
+    其余采集进程根据新的哈希环调整负责的服务器，只有一部分服务器需要迁移
+    """
+
+    def __init__(self, workers=None, replicas=100, check_interval=1):
+        """
+        Args:
+                workers(int): 采集进程数量，默认为CPU核心数
+                replicas(int): 一致性哈希每个进程的虚拟节点数量
+                check_interval(float): 检查采集进程状态的间隔(秒)
+        """
+        self.replicas = replicas
+        self.check_interval = check_interval
+        # 使用spawn启动采集进程，不继承当前进程的数据库连接和线程池
+        self.context = multiprocessing.get_context('spawn')
+        self.size = self.context.Value('i', workers or multiprocessing.cpu_count())
+        self.processes = {}
+        self._running = False
+
+    def spawn(self, index):
+        process = self.context.Process(
+            target=run_worker, args=(index, self.size, self.replicas),
+            name='rmon-collector-%d' % index, daemon=True)
+        process.start()
+        self.processes[index] = process
+
+    def resize(self, workers):
+        """修改采集进程数量，多余的采集进程会在下一次检查时自行退出
+        """
+        workers = max(workers, 1)
+        logger.info('resize collector workers to %d', workers)
+        with self.size.get_lock():
+            self.size.value = workers
+
+    def check(self):
+        """启动缺少的采集进程，回收已退出的采集进程
+        """
+        size = self.size.value
+        for index, process in list(self.processes.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            del self.processes[index]
+            if index < size:
+                logger.warning('collector worker %d exited with %s, restarting',
+                               index, process.exitcode)
+        for index in range(size):
+            if index not in self.processes:
+                self.spawn(index)
+
+    def stop(self, *args):
+        self._running = False
+
+    def run(self):
+        """运行直到收到 SIGINT 或 SIGTERM
+        """
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGTTIN, lambda *args: self.resize(self.size.value + 1))
+        signal.signal(signal.SIGTTOU, lambda *args: self.resize(self.size.value - 1))
+
+        self._running = True
+        while self._running:
+            self.check()
+            time.sleep(self.check_interval)
+        self.shutdown()
+
+    def shutdown(self, timeout=30):
+        """停止所有采集进程
+        """
+        for process in self.processes.values():
+            process.terminate()
+        deadline = time.monotonic() + timeout
+        for process in self.processes.values():
+            process.join(max(deadline - time.monotonic(), 0))
+        self.processes.clear()
@@ -8,7 +8,7 @@ class BaseModel(db.Model):
     """
     __abstract__ = True
 
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     def __repr__(self):
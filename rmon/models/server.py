@@ -1,13 +1,16 @@
 """rmon.models.server
 该模块实现了Server类以及相应的序列化类
 """
+from contextlib import contextmanager
+
 from .base import BaseModel
-from rmon.extensions import db
+from rmon.extensions import db, redis_pools, server_registry
 from datetime import datetime
-from redis import StrictRedis, RedisError
+from redis import RedisError
 from rmon.common.rest import RestException
 from marshmallow import (Schema, fields, validate,
                          post_load, validates_schema, ValidationError)
+from marshmallow.utils import isoformat
 
 
 class Server(BaseModel):
@@ -19,38 +22,172 @@ class Server(BaseModel):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), unique=True)
     description = db.Column(db.String(512))
-    host = db.Column(db.String(15))
+    host = db.Column(db.String(15), index=True)
     port = db.Column(db.Integer, default=6379)
     password = db.Column(db.String())
 
     def __repr__(self):
         return '<Server(name=%s)>' % self.name
 
+    def save(self):
+        """保存到数据库中，同时更新服务器缓存
+        """
+        super().save()
+        server_registry.put(self)
+
+    def delete(self):
+        """从数据库中删除，同时删除服务器缓存
+        """
+        server_id = self.id
+        super().delete()
+        server_registry.remove(server_id)
+
+    @classmethod
+    def get_cached(cls, server_id):
+        """从进程内缓存中获取服务器，返回的对象不属于数据库会话，只能读取
+        """
+        return server_registry.get(server_id)
+
+    @classmethod
+    def list_version(cls):
+        """服务器列表的版本号
+
+        由服务器数量和最近的更新时间组成，创建、更新、删除服务器都会改变版本号，
+        只需要一次聚合查询，不需要读取所有记录
+        """
+        count, updated_at = db.session.query(
+            db.func.count(cls.id), db.func.max(cls.updated_at)).one()
+        return count, updated_at and updated_at.isoformat()
+
+    @classmethod
+    def page(cls, after_id=0, limit=100, name=None, host=None):
+        """按id分页查询服务器，只查询列而不创建ORM对象
+
+        使用 id > after_id 的条件分页(keyset)，查询耗时与页码无关
+
+        Args:
+                after_id(int): 上一页最后一个服务器的id
+                limit(int): 每页数量
+                name(str): 服务器名称前缀
+                host(str): 服务器地址
+
+        Returns:
+                tuple: (服务器列表, 下一页的after_id)，没有下一页时为None，
+                       服务器与 ServerSchema 的序列化结果一致
+        """
+        query = db.session.query(*[getattr(cls, column) for column in SERVER_COLUMNS])
+        query = query.filter(cls.id > after_id)
+        if name:
+            # 转义 % 和 _，LIKE 在SQLite中不区分大小写，再比较前缀，与 filter_servers 的结果一致
+            query = query.filter(cls.name.startswith(name, autoescape=True),
+                                 db.func.substr(cls.name, 1, len(name)) == name)
+        if host:
+            query = query.filter(cls.host == host)
+        # 多查询一条记录，用于判断是否存在下一页
+        rows = query.order_by(cls.id).limit(limit + 1).all()
+
+        next_after_id = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_after_id = rows[-1][0]
+        return [dump_server_row(row) for row in rows], next_after_id
+
     @property
     def redis(self):
-        return StrictRedis(host=self.host, port=self.port, password=self.password)
+        """共享连接池的StrictRedis对象，服务器需要已经保存
+        """
+        return redis_pools.get(self)
+
+    @contextmanager
+    def client(self, temporary=False):
+        """访问Redis服务器的StrictRedis对象
 
-    def ping(self):
+        Args:
+                temporary(bool): 使用临时连接，使用后断开，不创建共享连接池。
+                                 尚未保存的服务器总是使用临时连接
+        """
+        if temporary or self.id is None:
+            with redis_pools.temporary(self) as redis:
+                yield redis
+        else:
+            yield self.redis
+
+    def ping(self, temporary=False):
         """检查Redis服务器是否可以访问
+
+        Args:
+                temporary(bool): 使用临时连接，检查后断开，参见 client
         """
         try:
-            return self.redis.ping()  # 这里调用的是StrictRedis对象的ping方法
+            with self.client(temporary) as redis:
+                return redis.ping()  # 这里调用的是StrictRedis对象的ping方法
         except RedisError:
             raise RestException(
                 400, 'redis server %s can not connected' % self.host)
 
-    def get_metrics(self):
+    def get_metrics(self, sections=None):
         """获取Redis服务器监控信息
 
-        通过Redis服务器指令INFO返回监控信息
+        通过Redis服务器指令INFO返回监控信息，尚未保存的服务器使用临时连接
+
+        Args:
+                sections(list): INFO指令的section，为空时返回默认的全部信息
+        """
+        if sections:
+            info = {}
+            for result in self.get_sections(sections).values():
+                info.update(result)
+            return info
+        try:
+            with self.client() as redis:
+                return redis.info()  # 这里调用的是StrictRedis对象的info方法
+        except RedisError:
+            raise RestException(
+                400, 'redis server %s can not connected' % self.host)
+
+    def get_sections(self, sections):
+        """分别获取INFO的各个section
+
+        每个section执行一次 INFO <section>，在同一个连接上批量发送
+
+        Args:
+                sections(list): INFO指令的section
+
+        Returns:
+                dict: section名称到该section监控信息的映射
         """
         try:
-            return self.redis.info()  # 这里调用的是StrictRedis对象的info方法
+            with self.client() as redis:
+                pipe = redis.pipeline(transaction=False)
+                for section in sections:
+                    pipe.info(section)
+                return dict(zip(sections, pipe.execute()))
         except RedisError:
             raise RestException(
                 400, 'redis server %s can not connected' % self.host)
 
 
+# 服务器列表查询的列，与 ServerSchema 的字段一致，第一列必须为id
+SERVER_COLUMNS = ('id', 'name', 'description', 'host', 'port', 'password',
+                  'updated_at', 'created_at')
+
+
+def dump_server_row(row):
+    """序列化查询结果的一行，日期格式与 ServerSchema 的 DateTime 字段一致
+    """
+    data = dict(zip(SERVER_COLUMNS, row))
+    for key in ('updated_at', 'created_at'):
+        if data[key] is not None:
+            data[key] = isoformat(data[key])
+    return data
+
+
+# INFO 指令支持的section
+INFO_SECTIONS = ('server', 'clients', 'memory', 'persistence', 'stats',
+                 'replication', 'cpu', 'commandstats', 'cluster', 'keyspace',
+                 'errorstats', 'latencystats', 'modules', 'all', 'default', 'everything')
+
+
 class ServerSchema(Schema):
     """Redis服务器记录序列化类
     """
@@ -72,17 +209,21 @@ class ServerSchema(Schema):
         if 'port' not in data:
             data['port'] = 6379
 
+        # 批量操作时由调用者通过一次查询统一检查名称
+        if self.context.get('skip_unique'):
+            return
+
         # 此处利用marshmallow.Schema的context属性，这个属性中的对象是通过视图函数中，由url获取到的要更新的server对象，将其存入Schema.context属性中，如果该属性中存在对象，那么是更新操作，否则则是创建操作
         instance = self.context.get('instance', None)
 
-        server = Server.query.filter_by(name=data['name']).first()
+        server = server_registry.find(data['name'])
 
         # 如果server不存在则说明是创建服务器，直接返回通过验证
         if server is None:
             return
 
         # 更新服务器时：如果上下文中已经存在Server对象，说明是更新操作，但是要更新的server对象与data查询到的对象不一致时，抛出错误，也即更新为另一个同名server。
-        if instance is not None and server != instance:
+        if instance is not None and server.id != instance.id:
             raise ValidationError('Redis server alredy exist', 'name')
 
         # 创建服务器时：如果上下文中不存在server对象，说明时创建操作，但是server对象在数据库中已经存在，抛出错误
@@ -2,8 +2,10 @@
 该模块实现了User类以及相应的序列化类
 """
 from .base import BaseModel
-from rmon.extensions import db
+from rmon.extensions import db, token_cache
 from rmon.common.errors import InvalidTokenError, AuthenticationError
+from rmon.common.token_cache import UserPrincipal
+from flask import current_app
 from werkzeug import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
 from calendar import timegm
@@ -79,6 +81,19 @@ class User(BaseModel):
 
         return jwt.encode(payload, current_app.secret_key, algorithm='HS512').decode('utf-8')
 
+    def save(self):
+        """保存到数据库中，用户信息改变后该用户的token缓存失效
+        """
+        super().save()
+        token_cache.invalidate_user(self.id)
+
+    def delete(self):
+        """从数据库中删除，同时删除该用户的token缓存
+        """
+        user_id = self.id
+        super().delete()
+        token_cache.invalidate_user(user_id)
+
     @classmethod
     def verify_token(cls, token, verify_exp=True):
         """检查验证json web token
@@ -90,6 +105,51 @@ class User(BaseModel):
         Return:
                 object: 返回用户对象
 
+        Raise:
+                InvalidTokenError
+        """
+        payload = cls.decode_token(token, verify_exp)
+
+        u = User.query.get(payload.get('uid'))
+        if u is None:
+            raise InvalidTokenError(403, 'user not exist')
+        return u
+
+    @classmethod
+    def verify_token_cached(cls, token):
+        """检查验证json web token，验证结果缓存到token过期为止
+
+        缓存命中时不需要验证签名，也不需要查询数据库
+
+        Args:
+                token(str): json web token
+
+        Return:
+                UserPrincipal: 用户id以及是否为管理员
+
+        Raise:
+                InvalidTokenError
+        """
+        principal = token_cache.get(token)
+        if principal is not None:
+            return principal
+
+        payload = cls.decode_token(token)
+        u = User.query.get(payload.get('uid'))
+        if u is None:
+            raise InvalidTokenError(403, 'user not exist')
+
+        principal = UserPrincipal(u.id, u.is_admin)
+        token_cache.put(token, principal, payload['exp'])
+        return principal
+
+    @classmethod
+    def decode_token(cls, token, verify_exp=True):
+        """解码并验证json web token
+
+        Return:
+                dict: token中的数据
+
         Raise:
                 InvalidTokenError
         """
@@ -113,11 +173,7 @@ class User(BaseModel):
         # 如果刷新时间过期，则认为token无效
         if payload['refresh_exp'] < timegm(now.utctimetuple()):
             raise InvalidTokenError(403, 'invalid token')
-
-        u = User.query.get(payload.get('uid'))
-        if u is None:
-            raise InvalidTokenError(403, 'user not exist')
-        return u
+        return payload
 
     @classmethod
     def create_administrator(cls):
@@ -0,0 +1,126 @@
+"""rmon.views.analysis
+
+Redis服务器分析API
+"""
+from flask import request, g, current_app
+from redis import RedisError
+
+from rmon.common.rest import RestView
+from rmon.common.errors import RestError
+from rmon.views.decorators import ObjectMustBeExist, TokenAuthenticate
+from rmon.models.server import Server
+from rmon.analysis.keyspace import KeyspaceAnalyzer
+from rmon.extensions import analysis_jobs, slowlog_collector
+
+
+def int_arg(name, default, low, high):
+    """解析整数查询参数，超出范围时返回400
+    """
+    try:
+        value = int(request.args.get(name, default))
+    except ValueError:
+        raise RestError(400, 'invalid %s' % name)
+    if not low <= value <= high:
+        raise RestError(400, '%s must between %d and %d' % (name, low, high))
+    return value
+
+
+class ServerKeyspace(RestView):
+    """服务器键空间分析
+
+    多进程部署时需要配置 ANALYSIS_JOB_PATH，任意进程都可以查询、停止和继续分析
+    """
+    method_decorators = {
+        'get': (ObjectMustBeExist(Server, cached=True),),
+        'post': (ObjectMustBeExist(Server, cached=True), TokenAuthenticate()),
+        'delete': (ObjectMustBeExist(Server, cached=True), TokenAuthenticate()),
+    }
+
+    kind = 'keyspace'
+
+    def get(self, object_id):
+        """获取分析进度和结果，分析进行中时返回已分析部分的结果
+        """
+        data = analysis_jobs.status((object_id, self.kind))
+        if data is None:
+            raise RestError(404, 'keyspace analysis not exist')
+        return data
+
+    def post(self, object_id):
+        """启动分析
+
+        参数形如 ?rate=1000&delimiter=:&depth=3&top=50，rate 为每秒最多分析的键数量，
+        不能超过 KEYSPACE_SCAN_RATE。resume=1 时从上一次停止的位置继续分析，
+        上一次分析由其他进程运行时从共享的断点继续
+        """
+        config = current_app.config
+        max_rate = config['KEYSPACE_SCAN_RATE']
+        rate = int_arg('rate', max_rate, 1, max_rate)
+
+        key = (object_id, self.kind)
+        resume = bool(request.args.get('resume'))
+        previous = analysis_jobs.get(key) if resume else None
+        if previous is not None and (previous.active or previous.task.finished):
+            previous = None
+        checkpoint = None
+        if resume and previous is None:
+            # 上一次分析在其他进程中停止，从保存的断点继续
+            checkpoint = analysis_jobs.checkpoint(key)
+
+        if previous is not None:
+            analyzer = previous.task
+            analyzer.rate = rate
+            # 停止期间原有连接池可能已被回收或因服务器修改而失效
+            analyzer.redis = g.instance.redis
+        elif checkpoint is not None:
+            analyzer = KeyspaceAnalyzer.restore(
+                g.instance.redis, checkpoint, count=config['KEYSPACE_SCAN_COUNT'], rate=rate,
+                duty=config['KEYSPACE_SCAN_DUTY'])
+        else:
+            analyzer = KeyspaceAnalyzer(
+                g.instance.redis, count=config['KEYSPACE_SCAN_COUNT'], rate=rate,
+                duty=config['KEYSPACE_SCAN_DUTY'], delimiter=request.args.get('delimiter', ':'),
+                depth=int_arg('depth', 3, 1, 10), top=int_arg('top', 50, 1, 1000))
+
+        job = analysis_jobs.start((object_id, self.kind), analyzer)
+        if job is None:
+            raise RestError(400, 'keyspace analysis already running')
+        return job.to_dict(), 202
+
+    def delete(self, object_id):
+        """停止分析，之后可以通过 resume=1 继续
+        """
+        if not analysis_jobs.cancel((object_id, self.kind)):
+            raise RestError(404, 'keyspace analysis not exist')
+        return {'ok': True}
+
+
+class ServerSlowlog(RestView):
+    """服务器慢查询按指令签名汇总
+    """
+    method_decorators = (ObjectMustBeExist(Server, cached=True),)
+
+    sort_fields = ('total', 'count', 'max', 'p99')
+
+    def get(self, object_id):
+        """最近一段时间内的慢查询签名排行
+
+        参数形如 ?window=3600&limit=20&sort=total，window 为最近多少秒，不能超过 SLOWLOG_RETENTION，
+        sort 为排序字段: total(总耗时)、count(次数)、max(最大耗时) 或 p99。
+        后台采集没有开启或者最近一个采集周期内没有采集时先获取该服务器的新慢查询日志
+        """
+        window = int_arg('window', 3600, 1, slowlog_collector.retention)
+        limit = int_arg('limit', 20, 1, 1000)
+        sort = request.args.get('sort', 'total')
+        if sort not in self.sort_fields:
+            raise RestError(400, 'sort must be one of %s' % ', '.join(self.sort_fields))
+
+        if not slowlog_collector.fresh(object_id):
+            try:
+                slowlog_collector.poll(g.instance)
+            except RedisError:
+                raise RestError(400, 'redis server %s can not connected' % g.instance.host)
+
+        data = slowlog_collector.top(object_id, window, limit, sort)
+        data['window'] = window
+        return data
@@ -10,12 +10,15 @@ class ObjectMustBeExist:
     """该装饰器确保操作的对象必须存在
     """
 
-    def __init__(self, object_class):
+    def __init__(self, object_class, cached=False):
         """
         Args:
                 object_class(class): 数据库对象
+                cached(bool): 是否通过 object_class.get_cached 从进程内缓存获取对象，
+                              缓存的对象只能读取，不能修改后保存
         """
         self.object_class = object_class
+        self.cached = cached
 
     def __call__(self, func):  # __call__方法可以让一个类的实例(如obj)，像函数那样调用obj(func)
         """装饰器实现
@@ -30,7 +33,10 @@ class ObjectMustBeExist:
             if object_id is None:
                 raise RestException(404, 'object not exist')
 
-            obj = self.object_class.query.get(object_id)
+            if self.cached:
+                obj = self.object_class.get_cached(object_id)
+            else:
+                obj = self.object_class.query.get(object_id)
             if obj is None:
                 raise RestException(404, 'object not exist')
 
@@ -71,7 +77,8 @@ class TokenAuthenticate:
             elif len(parts) > 2:
                 raise AuthorizationError(401, 'invalid token')
             token = parts[1]
-            user = User.verify_token(token)
+            # 缓存命中时不需要查询数据库，user 为只包含 id 和 is_admin 的轻量对象
+            user = User.verify_token_cached(token)
 
             # 如果需要验证是否是管理员
             if self.admin and not user.is_admin:
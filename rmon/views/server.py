@@ -1,17 +1,195 @@
-from flask import request, g
+import asyncio
+import json
+import time
+
+from sqlalchemy.exc import IntegrityError
+
+from flask import request, g, Response, stream_with_context, current_app
 
 from rmon.common.rest import RestView
+from rmon.common.errors import RestError
 from rmon.views.decorators import ObjectMustBeExist, TokenAuthenticate
-from rmon.models.server import Server, ServerSchema
+from rmon.models.server import Server, ServerSchema, INFO_SECTIONS
+from rmon.analysis.monitor import MonitorSampler
+from rmon.metrics import derive
+from rmon.metrics.collector import Sample
+from rmon.metrics.downsample import downsample, METHODS
+from rmon.metrics.engine import RespError
+from rmon.metrics.latency import summarize
+from rmon.metrics.snapshot import decompress, is_compressed
+from rmon.views.analysis import int_arg
+from rmon.extensions import (db, redis_pools, collector, fanout, metrics_cache, metric_store,
+                             metrics_snapshot, json_encoder, server_registry, analysis_jobs,
+                             slowlog_collector, latency_prober)
+
+
+def load_metrics(server, sections=None):
+    """获取服务器监控信息
+
+    优先使用采集器或共享快照中的最近一次采样，采样不存在或已过期时通过缓存访问Redis服务器，
+    同一服务器的并发请求只会执行一次INFO指令。直接访问Redis服务器的结果只缓存，
+    不写入采集器、磁盘存储和共享快照。指定section时只获取这些section，
+    衍生指标根据最近一次完整采样计算
+
+    Args:
+            server(Server): Redis服务器
+            sections(tuple): INFO指令的section
+
+    Returns:
+            Sample: 采样记录
+    """
+    if sections:
+        return metrics_cache.get((server.id, sections), lambda: section_sample(server, sections))
+
+    sample = latest_sample(server.id)
+    if sample is None:
+        sample = metrics_cache.get((server.id, None), lambda: full_sample(server))
+    return sample
+
+
+def latest_sample(server_id):
+    """采集器或共享快照中未过期的最近一次完整采样，都没有时返回None
+    """
+    return collector.fresh(server_id) or snapshot_sample(server_id)
+
+
+def full_sample(server):
+    """直接访问Redis服务器获取完整采样，衍生指标根据上一次缓存的完整采样计算
+    """
+    timestamp = time.time()
+    info = server.get_metrics()
+    previous = metrics_cache.peek((server.id, None))
+    if previous is not None:
+        previous = (previous.timestamp, previous.info)
+    return Sample(timestamp, info, derive.rates(previous, timestamp, info))
+
+
+def section_sample(server, sections):
+    """获取部分section的采样记录
+
+    同时获取 server section 用于判断服务器是否重启，没有请求该section时不返回其中的字段。
+    没有完整采样时只有累计命中率等不需要上一次采样的衍生指标
+    """
+    timestamp = time.time()
+    fetch = sections if 'server' in sections else sections + ('server',)
+    results = server.get_sections(fetch)
+    info = {}
+    for section in sections:
+        info.update(results[section])
+
+    previous = latest_sample(server.id) or metrics_cache.peek((server.id, None))
+    if previous is not None:
+        previous = (previous.timestamp, previous.info)
+    current = dict(info, **results['server'])
+    return Sample(timestamp, info, derive.rates(previous, timestamp, current))
+
+
+def read_snapshot(server_id):
+    """读取其他进程写入共享快照的最新采样，过期时间与 MetricsCollector.fresh 相同
+
+    Returns:
+            tuple: (采样时间戳, json数据)，没有快照或已过期时返回None
+    """
+    return metrics_snapshot.read(server_id, max_age=2 * collector.interval)
+
+
+def snapshot_sample(server_id):
+    """将共享快照转换为采样记录，没有快照或已过期时返回None
+    """
+    entry = read_snapshot(server_id)
+    if entry is None:
+        return None
+    timestamp, data = entry
+    info = json.loads(decompress(data).decode('utf-8'))
+    return Sample(timestamp, info, info.pop('derived', {}))
+
+
+def metrics_args():
+    """解析监控信息API的 section 和 fields 参数
+
+    形如 ?section=memory,stats&fields=used_memory,instantaneous_ops_per_sec
+
+    Returns:
+            tuple: (sections, fields)，未指定时为None
+    """
+    sections = request.args.get('section')
+    if sections:
+        sections = tuple(sorted({s.strip().lower() for s in sections.split(',') if s.strip()}))
+        for section in sections:
+            if section not in INFO_SECTIONS:
+                raise RestError(400, 'invalid info section %s' % section)
+
+    fields = request.args.get('fields')
+    if fields:
+        fields = [f.strip() for f in fields.split(',') if f.strip()]
+    return sections or None, fields or None
+
+
+def project(info, fields):
+    """只保留指定的字段
+    """
+    if not fields:
+        return info
+    return {field: info[field] for field in fields if field in info}
+
+
+def filter_servers():
+    """根据 ids 参数(逗号分隔的服务器id)和 name 参数(服务器名称前缀)过滤服务器
+
+    服务器从进程内缓存中获取，不查询数据库
+    """
+    servers = server_registry.all()
+    ids = request.args.get('ids')
+    if ids:
+        try:
+            ids = {int(i) for i in ids.split(',') if i}
+        except ValueError:
+            raise RestError(400, 'invalid server ids')
+        servers = [server for server in servers if server.id in ids]
+    name = request.args.get('name')
+    if name:
+        servers = [server for server in servers if server.name.startswith(name)]
+    return servers
+
+
+def metrics_data(sample, fields=None):
+    """监控信息API返回的数据，衍生指标保存在 derived 字段中
+    """
+    data = dict(project(sample.info, fields))
+    derived = project(sample.derived, fields)
+    if derived:
+        data['derived'] = derived
+    return data
 
 
 class ServerList(RestView):
     """Redis服务器列表"""
 
+    default_limit = 100
+    max_limit = 1000
+
     def get(self):
-        """获取Redis列表"""
-        servers = Server.query.all()
-        return ServerSchema().dump(servers, many=True).data
+        """获取Redis列表
+
+        参数形如 ?after_id=100&limit=100&name=cache&host=127.0.0.1，按id分页，
+        name 为名称前缀，存在下一页时响应头 X-Next-After-Id 为下一页的 after_id。
+        服务器列表没有变化时返回304
+        """
+        try:
+            after_id = int(request.args.get('after_id', 0))
+            limit = int(request.args.get('limit', self.default_limit))
+        except ValueError:
+            raise RestError(400, 'invalid pagination')
+        if not 1 <= limit <= self.max_limit:
+            raise RestError(400, 'limit must between 1 and %d' % self.max_limit)
+
+        self.check_etag(*Server.list_version())
+        servers, next_after_id = Server.page(after_id, limit, request.args.get('name'),
+                                             request.args.get('host'))
+        headers = {}
+        if next_after_id is not None:
+            headers['X-Next-After-Id'] = str(next_after_id)
+        return servers, 200, headers
 
     def post(self):
         """创建Redis服务器
@@ -46,20 +224,484 @@ class ServerDetail(RestView):
         if errors:
             return errors, 400
         server.save()
+        # 服务器信息可能已改变，关闭原有连接池
+        redis_pools.invalidate(server.id)
+        metrics_cache.invalidate(server.id)
         return {'ok': True}
 
     def delete(self, object_id):
         """删除服务器
         """
+        server_id = g.instance.id
         g.instance.delete()
+        redis_pools.invalidate(server_id)
+        collector.forget(server_id)
+        metrics_cache.invalidate(server_id)
+        analysis_jobs.forget(server_id)
+        slowlog_collector.forget(server_id)
+        latency_prober.forget(server_id)
         return {'ok': True}, 204
 
+
+def is_server_id(value):
+    """是否为合法的服务器id，布尔值不是合法的id
+    """
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+class ServerBulk(RestView):
+    """批量创建、更新、删除Redis服务器
+
+    名称是否重复通过一次 IN 查询检查，新的连接信息并发ping，
+    通过验证的服务器在同一个事务中提交，返回与请求一一对应的结果：
+
+        [{"ok": true, "id": 1}, {"ok": false, "message": "..."}]
+    """
+    method_decorators = (TokenAuthenticate(),)
+
+    max_items = 1000
+
+    def items(self):
+        """请求数据，必须为不超过 max_items 个元素的列表
+        """
+        items = request.get_json()
+        if not isinstance(items, list):
+            raise RestError(400, 'list required')
+        if len(items) > self.max_items:
+            raise RestError(400, 'at most %d servers' % self.max_items)
+        return items
+
+    def post(self):
+        """批量创建服务器
+        """
+        items = self.items()
+        results = [None] * len(items)
+        servers = {}
+        for i, data in enumerate(items):
+            server, errors = ServerSchema(context={'skip_unique': True}).load(data)
+            if errors:
+                results[i] = self.error(errors)
+            else:
+                servers[i] = server
+
+        self.check_names(servers, results)
+        self.ping(servers, results)
+        db.session.add_all(servers.values())
+        self.commit()
+
+        for i, server in servers.items():
+            server_registry.put(server)
+            results[i] = {'ok': True, 'id': server.id}
+        return results
+
+    def put(self):
+        """批量更新服务器，每个元素必须包含服务器id
+        """
+        items = self.items()
+        results = [None] * len(items)
+        ids = [data.get('id') for data in items
+               if isinstance(data, dict) and is_server_id(data.get('id'))]
+        instances = {server.id: server
+                     for server in Server.query.filter(Server.id.in_(ids))}
+
+        servers = {}
+        # 加载数据时会直接修改服务器对象，检查名称前不能自动flush
+        with db.session.no_autoflush:
+            for i, data in enumerate(items):
+                if not isinstance(data, dict) or not is_server_id(data.get('id')):
+                    results[i] = {'ok': False, 'message': 'invalid server id'}
+                    continue
+                instance = instances.get(data['id'])
+                if instance is None:
+                    results[i] = {'ok': False, 'message': 'object not exist'}
+                    continue
+                data = {key: value for key, value in data.items() if key != 'id'}
+                schema = ServerSchema(context={'instance': instance, 'skip_unique': True})
+                server, errors = schema.load(data, partial=True)
+                if errors:
+                    results[i] = self.error(errors)
+                    db.session.expire(instance)
+                else:
+                    servers[i] = server
+
+            self.check_names(servers, results)
+            self.ping(servers, results)
+        self.commit()
+
+        for i, server in servers.items():
+            server_registry.put(server)
+            redis_pools.invalidate(server.id)
+            metrics_cache.invalidate(server.id)
+            results[i] = {'ok': True, 'id': server.id}
+        return results
+
+    def delete(self):
+        """批量删除服务器，请求数据为服务器id列表
+        """
+        ids = self.items()
+        if not all(is_server_id(i) for i in ids):
+            raise RestError(400, 'invalid server ids')
+        servers = {server.id: server
+                   for server in Server.query.filter(Server.id.in_(ids))}
+        for server in servers.values():
+            db.session.delete(server)
+        self.commit()
+
+        results = []
+        for server_id in ids:
+            if server_id not in servers:
+                results.append({'ok': False, 'message': 'object not exist'})
+                continue
+            server_registry.remove(server_id)
+            redis_pools.invalidate(server_id)
+            collector.forget(server_id)
+            metrics_cache.invalidate(server_id)
+            analysis_jobs.forget(server_id)
+            slowlog_collector.forget(server_id)
+            latency_prober.forget(server_id)
+            results.append({'ok': True, 'id': server_id})
+        return results
+
+    @staticmethod
+    def commit():
+        """提交事务，违反数据库约束(例如并发请求创建了同名服务器)时回滚并返回400
+        """
+        try:
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            raise RestError(400, 'commit failed: %s' % e.orig)
+
+    @staticmethod
+    def error(errors):
+        """将 {'name': ['...']} 形式的验证错误转换为失败结果
+        """
+        message = next(iter(errors.values()))
+        if isinstance(message, list):
+            message = message[0]
+        return {'ok': False, 'message': message}
+
+    def reject(self, servers, results, i, message):
+        """标记服务器验证失败，撤销对已有服务器对象的修改
+        """
+        server = servers.pop(i)
+        if server.id is not None:
+            db.session.expire(server)
+        results[i] = {'ok': False, 'message': message}
+
+    def check_names(self, servers, results):
+        """通过一次查询检查名称是否已被其他服务器使用，以及请求中是否有重复名称
+        """
+        names = [server.name for server in servers.values()]
+        existing = dict(db.session.query(Server.name, Server.id)
+                        .filter(Server.name.in_(names)))
+        seen = set()
+        for i, server in list(servers.items()):
+            owner = existing.get(server.name)
+            if server.name in seen or (owner is not None and owner != server.id):
+                self.reject(servers, results, i, 'Redis server alredy exist')
+            seen.add(server.name)
+
+    def ping(self, servers, results):
+        """并发检查服务器是否可以访问，使用临时连接，检查后断开
+        """
+        indexes = list(servers)
+        pings = fanout.map(lambda server: server.ping(temporary=True),
+                           [servers[i] for i in indexes])
+        for i, (ok, message) in zip(indexes, pings):
+            if not ok:
+                self.reject(servers, results, i, message)
+
+
 class ServerMetrics(RestView):
     """服务器监控信息
     """
-    method_decorators = (ObjectMustBeExist(Server),)  # 装饰器类实例化传入Server对象, 该装饰其保证对象存在
+    method_decorators = (ObjectMustBeExist(Server, cached=True),)  # 装饰器类实例化传入Server对象, 该装饰其保证对象存在
 
     def get(self, object_id):
         """获取服务器监控信息
+
+        section 参数指定只获取INFO的部分section，fields 参数指定只返回部分字段，
+        根据计数器计算的速率、命中率等衍生指标保存在 derived 字段中
+        """
+        sections, fields = metrics_args()
+        if not sections and not fields:
+            # 共享快照中保存的是序列化并按需压缩后的响应，直接作为响应体
+            entry = read_snapshot(object_id)
+            if entry is not None:
+                timestamp, data = entry
+                self.check_etag(object_id, timestamp)
+                return self.make_body_response(data, compressed=is_compressed(data))
+
+        sample = load_metrics(g.instance, sections)
+        # 采样没有变化时返回304，不需要再序列化
+        self.check_etag(object_id, sample.timestamp)
+        return metrics_data(sample, fields)
+
+
+class ServerMonitor(RestView):
+    """服务器 MONITOR 采样
+    """
+    method_decorators = {
+        'get': (ObjectMustBeExist(Server, cached=True),),
+        'post': (ObjectMustBeExist(Server, cached=True), TokenAuthenticate()),
+        'delete': (ObjectMustBeExist(Server, cached=True), TokenAuthenticate()),
+    }
+
+    kind = 'monitor'
+
+    def get(self, object_id):
+        """获取采样进度和高频键、高频指令
+
+        参数形如 ?keys=user:1,user:2，返回这些键出现次数的估计值。
+        Count-Min 草图只保存在运行采样的进程中，由其他进程处理请求时，
+        只返回高频键中的键的计数，其余的键为null
+        """
+        key = (object_id, self.kind)
+        data = analysis_jobs.status(key)
+        if data is None:
+            raise RestError(404, 'monitor sampling not exist')
+        keys = request.args.get('keys')
+        if keys:
+            keys = [item for item in keys.split(',') if item]
+            job = analysis_jobs.get(key)
+            if job is not None and job.started_at == data['started_at']:
+                data['estimates'] = job.task.estimate(keys)
+            else:
+                counts = {item['key']: item['count'] for item in data['result']['keys']}
+                data['estimates'] = {item: counts.get(item) for item in keys}
+        return data
+
+    def post(self, object_id):
+        """启动采样
+
+        参数形如 ?duration=10&bytes=1048576&top=50，duration 和 bytes 为采样的最长时间(秒)和
+        最多读取的字节数，分别不能超过 MONITOR_SAMPLE_MAX_DURATION 和 MONITOR_SAMPLE_MAX_BYTES，
+        任意一个用完时自动停止；top 为保留的高频键数量，不能超过 MONITOR_SAMPLE_MAX_TOP
+        """
+        config = current_app.config
+        sampler = MonitorSampler(
+            g.instance,
+            duration=int_arg('duration', config['MONITOR_SAMPLE_DURATION'],
+                             1, config['MONITOR_SAMPLE_MAX_DURATION']),
+            max_bytes=int_arg('bytes', config['MONITOR_SAMPLE_MAX_BYTES'],
+                              1, config['MONITOR_SAMPLE_MAX_BYTES']),
+            width=config['MONITOR_SKETCH_WIDTH'], depth=config['MONITOR_SKETCH_DEPTH'],
+            top=int_arg('top', 50, 1, config['MONITOR_SAMPLE_MAX_TOP']))
+
+        job = analysis_jobs.start((object_id, self.kind), sampler)
+        if job is None:
+            raise RestError(400, 'monitor sampling already running')
+        return job.to_dict(), 202
+
+    def delete(self, object_id):
+        """停止采样，已采样的结果仍然可以获取
+        """
+        if not analysis_jobs.cancel((object_id, self.kind)):
+            raise RestError(404, 'monitor sampling not exist')
+        return {'ok': True}
+
+
+class ServerMetricsHistory(RestView):
+    """服务器监控指标历史
+    """
+    method_decorators = (ObjectMustBeExist(Server, cached=True),)
+
+    max_points = 5000
+
+    def get(self, object_id):
+        """获取降采样后的监控指标历史
+
+        参数形如 ?metric=used_memory&from=1500000000&to=1500003600&points=500&method=avg，
+        from 和 to 为Unix时间戳，method 为 avg(分桶min/max/avg) 或 lttb
+        """
+        metric = request.args.get('metric')
+        if not metric:
+            raise RestError(400, 'metric required')
+        method = request.args.get('method', 'avg')
+        if method not in METHODS:
+            raise RestError(400, 'invalid method %s' % method)
+        try:
+            start, end = [float(request.args[key]) if key in request.args else None
+                          for key in ('from', 'to')]
+            points = int(request.args.get('points', 500))
+        except ValueError:
+            raise RestError(400, 'invalid history range')
+        if not 1 <= points <= self.max_points:
+            raise RestError(400, 'points must between 1 and %d' % self.max_points)
+
+        # 内存中的历史记录不能覆盖查询范围时，从磁盘存储中读取
+        timestamps, values = collector.series(object_id, metric)
+        if metric_store.enabled and (not timestamps or start is None or start < timestamps[0]):
+            stored_timestamps, stored_values = metric_store.query(object_id, metric, start, end)
+            if stored_values:
+                timestamps, values = stored_timestamps, stored_values
+        if values is None:
+            raise RestError(404, 'metric %s not exist' % metric)
+
+        return {
+            'metric': metric,
+            'method': method,
+            'points': downsample(timestamps, values, points,
+                                 method=method, start=start, end=end)
+        }
+
+
+class ServerLatency(RestView):
+    """服务器往返延迟
+    """
+    method_decorators = (ObjectMustBeExist(Server, cached=True),)
+
+    def get(self, object_id):
+        """最近一段时间内 PING 往返时间的分位数，单位为微秒
+
+        参数形如 ?window=300，window 为最近多少秒，不能超过 LATENCY_PROBE_RETENTION。
+        后台探测没有开启时先探测一次
+        """
+        window = int_arg('window', 300, 1, latency_prober.retention)
+        if not latency_prober.running:
+            try:
+                latency_prober.probe_once(g.instance)
+            except (OSError, EOFError, asyncio.TimeoutError, RespError):
+                raise RestError(400, 'redis server %s can not connected' % g.instance.host)
+
+        data = latency_prober.summary(object_id, window)
+        if data is None:
+            raise RestError(404, 'latency of server %s not exist' % g.instance.name)
+        data['window'] = window
+        return data
+
+
+class ServerListLatency(RestView):
+    """所有服务器往返延迟
+    """
+
+    def get(self):
+        """每个服务器以及所有服务器合并后的 PING 往返时间分位数
+
+        ids 和 name 参数与所有服务器监控信息API相同，window 参数与单个服务器往返延迟API相同。
+        合并后的分位数由各服务器的直方图累加得到，与所有往返时间整体计算的结果一致
+        """
+        window = int_arg('window', 300, 1, latency_prober.retention)
+        servers = filter_servers()
+        if not latency_prober.running:
+            fanout.map(latency_prober.probe_once, servers)
+
+        data = []
+        for server in servers:
+            item = {'id': server.id, 'name': server.name,
+                    'latency': latency_prober.summary(server.id, window)}
+            data.append(item)
+        fleet = summarize(latency_prober.merged([server.id for server in servers], window))
+        return {'window': window, 'fleet': fleet, 'servers': data}
+
+
+class ServerListMetrics(RestView):
+    """所有服务器监控信息
+    """
+
+    def get(self):
+        """并发获取多个服务器的监控信息
+
+        可以通过 ids 参数(逗号分隔的服务器id)或者 name 参数(服务器名称前缀)过滤服务器，
+        无法访问的服务器标记为失败，不影响其他服务器的结果。
+        section 和 fields 参数与单个服务器监控信息API相同
+        """
+        sections, fields = metrics_args()
+        servers = filter_servers()
+
+        results = fanout.map(
+            lambda server: metrics_data(load_metrics(server, sections), fields), servers)
+
+        data = []
+        for server, (ok, result) in zip(servers, results):
+            item = {'id': server.id, 'name': server.name, 'ok': ok}
+            if ok:
+                item['metrics'] = result
+            else:
+                item['message'] = result
+            data.append(item)
+        return data
+
+
+class ServerMetricsStream(RestView):
+    """服务器监控信息实时推送(Server-Sent Events)
+    """
+
+    def get(self):
+        """推送服务器监控信息的变化
+
+        ids、name 和 fields 参数与所有服务器监控信息API相同；interval 为两次推送的最小间隔，
+        heartbeat 为没有数据变化时发送心跳的间隔。每个事件只包含发生变化的字段：
+
+            event: metrics
+            data: {"id": 1, "timestamp": 1500000000.0, "metrics": {...}, "derived": {...}}
+
+        所有连接共享采集器的采样和监控信息缓存，不会为每个连接单独访问Redis服务器
+        """
+        _, fields = metrics_args()
+        servers = filter_servers()
+        min_interval = current_app.config['METRICS_STREAM_MIN_INTERVAL']
+        try:
+            interval = max(float(request.args.get('interval', min_interval)), min_interval)
+            heartbeat = float(request.args.get(
+                'heartbeat', current_app.config['METRICS_STREAM_HEARTBEAT']))
+        except ValueError:
+            raise RestError(400, 'invalid stream interval')
+
+        headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        return Response(stream_with_context(self.events(servers, fields, interval, heartbeat)),
+                        mimetype='text/event-stream', headers=headers)
+
+    @staticmethod
+    def events(servers, fields, interval, heartbeat):
+        """生成事件流
+        """
+        sent = {server.id: (0, {}, {}) for server in servers}
+        version = collector.version
+        last_event = time.monotonic()
+
+        while True:
+            started = time.monotonic()
+            for server in servers:
+                timestamp, last_metrics, last_derived = sent[server.id]
+                try:
+                    sample = load_metrics(server)
+                except RestError as e:
+                    yield b'event: error\ndata: ' + json_encoder.dumps(
+                        {'id': server.id, 'message': e.message}) + b'\n\n'
+                    last_event = time.monotonic()
+                    continue
+                if sample.timestamp <= timestamp:
+                    continue
+
+                metrics = project(sample.info, fields)
+                derived = project(sample.derived, fields)
+                data = {
+                    'id': server.id,
+                    'timestamp': sample.timestamp,
+                    'metrics': {k: v for k, v in metrics.items() if last_metrics.get(k) != v},
+                    'derived': {k: v for k, v in derived.items() if last_derived.get(k) != v},
+                }
+                sent[server.id] = (sample.timestamp, metrics, derived)
+                yield b'event: metrics\ndata: ' + json_encoder.dumps(data) + b'\n\n'
+                last_event = time.monotonic()
+
+            if time.monotonic() - last_event >= heartbeat:
+                yield b': heartbeat\n\n'
+                last_event = time.monotonic()
+
+            # 等待采集器的新采样，最长等待到下一次心跳或缓存过期，并且保证最小推送间隔
+            timeout = min(heartbeat - (time.monotonic() - last_event), metrics_cache.ttl)
+            version = collector.wait(version, max(timeout, 0))
+            time.sleep(max(interval - (time.monotonic() - started), 0))
+
+
+class MetricsCacheStats(RestView):
+    """监控信息缓存统计
+    """
+
+    def get(self):
+        """获取缓存命中、未命中、合并请求等统计数据
         """
-        return g.instance.get_metrics()
\ No newline at end of file
+        return metrics_cache.stats()
@@ -4,12 +4,26 @@
 """
 from flask import Blueprint
 from rmon.views.index import IndexView
-from rmon.views.server import ServerList, ServerDetail
+from rmon.views.server import (ServerList, ServerDetail, ServerBulk, ServerMetrics, ServerListMetrics,
+                               MetricsCacheStats, ServerMetricsHistory, ServerMetricsStream,
+                               ServerLatency, ServerListLatency, ServerMonitor)
+from rmon.views.analysis import ServerKeyspace, ServerSlowlog
 from rmon.views.auth import AuthView
 
 api = Blueprint('api', __name__)
 api.add_url_rule('/', view_func=IndexView.as_view('index'))
 api.add_url_rule('/servers/', view_func=ServerList.as_view('server_list'))
+api.add_url_rule('/servers/bulk', view_func=ServerBulk.as_view('server_bulk'))
+api.add_url_rule('/servers/metrics', view_func=ServerListMetrics.as_view('server_list_metrics'))
+api.add_url_rule('/servers/metrics/stream', view_func=ServerMetricsStream.as_view('server_metrics_stream'))
+api.add_url_rule('/servers/latency', view_func=ServerListLatency.as_view('server_list_latency'))
+api.add_url_rule('/servers/metrics/cache', view_func=MetricsCacheStats.as_view('metrics_cache_stats'))
 api.add_url_rule('/servers/<int:object_id>', view_func=ServerDetail.as_view('server_detail'))
-api.add_url_rule('/servers/<int:object_id>/metrics', view_func=ServerDetail.as_view('server_metrics'))
+api.add_url_rule('/servers/<int:object_id>/metrics', view_func=ServerMetrics.as_view('server_metrics'))
+api.add_url_rule('/servers/<int:object_id>/monitor', view_func=ServerMonitor.as_view('server_monitor'))
+api.add_url_rule('/servers/<int:object_id>/metrics/history',
+                 view_func=ServerMetricsHistory.as_view('server_metrics_history'))
+api.add_url_rule('/servers/<int:object_id>/latency', view_func=ServerLatency.as_view('server_latency'))
+api.add_url_rule('/servers/<int:object_id>/keyspace', view_func=ServerKeyspace.as_view('server_keyspace'))
+api.add_url_rule('/servers/<int:object_id>/slowlog', view_func=ServerSlowlog.as_view('server_slowlog'))
 api.add_url_rule('/login',view_func=AuthView.as_view('login'))
@@ -2,7 +2,8 @@ import pytest
 
 from rmon.app import create_app
 from rmon.models import Server
-from rmon.extensions import db as database
+from rmon.extensions import (db as database, collector, metrics_cache, server_registry,
+                             analysis_jobs, slowlog_collector, latency_prober)
 
 @pytest.fixture
 def app():
@@ -19,6 +20,13 @@ def db(app):
 		database.create_all()
 		yield database 
 		database.drop_all()
+	# 每个测试使用新的数据库，清理上一个测试中保存的监控信息
+	collector.clear()
+	metrics_cache.clear()
+	server_registry.clear()
+	analysis_jobs.clear()
+	slowlog_collector.clear()
+	latency_prober.clear()
 
 @pytest.fixture
 def server(db):
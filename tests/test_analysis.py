@@ -0,0 +1,251 @@
+import json
+import threading
+
+import pytest
+from flask import url_for
+from redis import StrictRedis
+
+from rmon.analysis.jobs import DONE, CANCELLED, PENDING, RUNNING, FAILED, JobRegistry
+from rmon.analysis.keyspace import KeyspaceAnalyzer
+from rmon.analysis.report import PrefixTree, TopK, KeyspaceReport, OTHER
+from rmon.common.token_cache import UserPrincipal
+from rmon.extensions import analysis_jobs
+from rmon.models import User
+
+
+class TestKeyspaceReport:
+    """测试键空间分析结果汇总
+    """
+
+    def test_prefix_tree(self):
+        """按分隔符统计每一级前缀，超过子节点上限时合并为 <other>"""
+
+        tree = PrefixTree(depth=2, max_children=2)
+        tree.add('user:1:name', 10)
+        tree.add('user:2:name', 20)
+        tree.add('user:3:name', 30)
+        tree.add('session:abc', 5)
+        tree.add('counter', 1)
+        tree.add('cache:x', 7)
+
+        prefixes = tree.to_dict()
+        assert [item['prefix'] for item in prefixes] == ['user', OTHER, 'session']
+        assert prefixes[0]['keys'] == 3
+        assert prefixes[0]['bytes'] == 60
+        assert [item['prefix'] for item in prefixes[0]['children']] == [
+            'user:' + OTHER, 'user:2', 'user:1']
+        assert prefixes[1]['bytes'] == 7
+        assert tree.root.keys == 6
+
+    def test_top_k(self):
+        """只保留最大的k个"""
+
+        top = TopK(3)
+        for size in [5, 1, 9, 3, 7, 2]:
+            top.add(size, 'key%d' % size)
+        assert top.items() == [(9, 'key9'), (7, 'key7'), (5, 'key5')]
+
+    def test_report(self):
+        report = KeyspaceReport(top=1)
+        report.add('a:1', 'string', 10)
+        report.add('a:2', 'hash', 100, ttl=60)
+
+        result = report.to_dict()
+        assert result['keys'] == 2
+        assert result['bytes'] == 110
+        assert result['expires'] == 1
+        assert result['types'] == {'string': {'keys': 1, 'bytes': 10},
+                                   'hash': {'keys': 1, 'bytes': 100}}
+        assert result['largest'] == [{'key': 'a:2', 'type': 'hash', 'bytes': 100, 'ttl': 60}]
+
+
+class TestKeyspaceAnalyzer:
+    """测试基于 SCAN 的键空间分析
+    """
+
+    @pytest.fixture
+    def redis(self):
+        redis = StrictRedis(db=15)
+        redis.flushdb()
+        for i in range(50):
+            redis.set('user:%d' % i, 'x' * i)
+        redis.hmset('big:hash', {str(i): 'v' * 100 for i in range(100)})
+        redis.expire('big:hash', 600)
+        yield redis
+        redis.flushdb()
+
+    def test_run(self, redis):
+        """分析所有键，最大的键排在最前面"""
+
+        analyzer = KeyspaceAnalyzer(redis, count=10, rate=0, duty=1, top=5)
+        analyzer.run(threading.Event())
+
+        assert analyzer.finished
+        assert analyzer.progress()['percent'] == 100
+        result = analyzer.result()
+        assert result['keys'] == 51
+        assert result['expires'] == 1
+        assert result['types']['string']['keys'] == 50
+        assert result['largest'][0]['key'] == 'big:hash'
+        assert result['largest'][0]['ttl'] > 0
+        assert {item['prefix'] for item in result['prefixes']} == {'user', 'big'}
+
+    def test_resume(self, redis):
+        """停止后从保存的游标继续分析"""
+
+        analyzer = KeyspaceAnalyzer(redis, count=10, rate=0, duty=1)
+        analyzer.step()
+        assert not analyzer.finished
+        assert 0 < analyzer.scanned < 51
+
+        analyzer.run(threading.Event())
+        assert analyzer.result()['keys'] == 51
+
+    def test_checkpoint(self, redis):
+        """断点序列化后在新的分析器中继续，结果与一次完成的分析一致"""
+
+        expected = KeyspaceAnalyzer(redis, count=10, rate=0, duty=1, top=5)
+        expected.run(threading.Event())
+
+        analyzer = KeyspaceAnalyzer(redis, count=10, rate=0, duty=1, top=5)
+        analyzer.step()
+        checkpoint = json.loads(json.dumps(analyzer.checkpoint()))
+        restored = KeyspaceAnalyzer.restore(redis, checkpoint, count=10, rate=0, duty=1)
+        restored.run(threading.Event())
+        assert restored.result() == expected.result()
+        assert restored.checkpoint() is None
+
+    def test_throttle(self, redis):
+        """休眠时间同时满足速率上限和占空比"""
+
+        analyzer = KeyspaceAnalyzer(redis, rate=100, duty=0.1)
+        # 占空比10%: 执行10ms之后休眠90ms
+        assert analyzer.throttle(0, 0.01) == pytest.approx(0.09)
+        # 速率上限: 100个键需要1秒
+        assert analyzer.throttle(100, 0.01) == pytest.approx(0.99)
+
+
+class TestServerKeyspace:
+    """测试键空间分析API
+    """
+
+    endpoint = 'api.server_keyspace'
+
+    @pytest.fixture(autouse=True)
+    def admin(self, monkeypatch):
+        """跳过token认证"""
+        monkeypatch.setattr(User, 'verify_token_cached',
+                            staticmethod(lambda token: UserPrincipal(1, True)))
+
+    def request(self, client, method, server_id, **args):
+        return client.open(url_for(self.endpoint, object_id=server_id, **args), method=method,
+                           headers={'Authorization': 'jwt token'})
+
+    @pytest.fixture
+    def keys(self, server):
+        redis = server.redis
+        for i in range(20):
+            redis.set('rmon_test:%d' % i, i)
+        yield
+        redis.delete(*['rmon_test:%d' % i for i in range(20)])
+
+    def test_analyze(self, server, client, keys):
+        """启动分析，完成后获取结果"""
+
+        resp = self.request(client, 'GET', server.id)
+        assert resp.status_code == 404
+
+        resp = self.request(client, 'POST', server.id, rate=100000)
+        assert resp.status_code == 400
+
+        resp = self.request(client, 'POST', server.id)
+        assert resp.status_code == 202
+
+        job = analysis_jobs.get((server.id, 'keyspace'))
+        job.join(10)
+        assert job.state == DONE
+
+        resp = self.request(client, 'GET', server.id)
+        assert resp.status_code == 200
+        data = json.loads(resp.data.decode('utf-8'))
+        assert data['state'] == DONE
+        assert data['progress']['percent'] == 100
+        assert data['result']['keys'] == server.redis.dbsize()
+
+    def test_cancel(self, server, client, keys):
+        """停止后可以继续分析"""
+
+        analyzer = KeyspaceAnalyzer(server.redis, count=1, rate=1)
+        analysis_jobs.start((server.id, 'keyspace'), analyzer)
+
+        resp = self.request(client, 'POST', server.id)
+        assert resp.status_code == 400
+
+        resp = self.request(client, 'DELETE', server.id)
+        assert resp.status_code == 200
+        job = analysis_jobs.get((server.id, 'keyspace'))
+        job.join(10)
+        assert job.state == CANCELLED
+
+        resp = self.request(client, 'POST', server.id, resume=1)
+        assert resp.status_code == 202
+        assert analysis_jobs.get((server.id, 'keyspace')).task is analyzer
+
+
+class TestSharedJobs:
+    """测试多进程共享的分析任务状态
+    """
+
+    @pytest.fixture
+    def redis(self):
+        redis = StrictRedis(db=15)
+        redis.flushdb()
+        for i in range(30):
+            redis.set('user:%d' % i, i)
+        yield redis
+        redis.flushdb()
+
+    def registries(self, tmpdir):
+        """模拟两个进程的任务登记"""
+        registries = []
+        for owner in ('worker-a', 'worker-b'):
+            registry = JobRegistry()
+            registry.path = str(tmpdir)
+            registry.interval = 0.05
+            registry._owner = owner
+            registries.append(registry)
+        return registries
+
+    def test_other_process(self, redis, tmpdir):
+        """其他进程可以查询、停止任务，并从断点继续"""
+
+        a, b = self.registries(tmpdir)
+        key = (1, 'keyspace')
+        job = a.start(key, KeyspaceAnalyzer(redis, count=1, rate=5))
+
+        assert b.status(key)['state'] in (PENDING, RUNNING)
+        assert b.start(key, KeyspaceAnalyzer(redis)) is None
+        assert b.cancel(key) is True
+        job.join(5)
+        assert job.state == CANCELLED
+
+        status = b.status(key)
+        assert status['state'] == CANCELLED
+        assert 0 < status['progress']['scanned'] < 30
+
+        analyzer = KeyspaceAnalyzer.restore(redis, b.checkpoint(key), count=10, rate=0, duty=1)
+        job = b.start(key, analyzer)
+        job.join(5)
+        assert a.status(key)['state'] == DONE
+        assert a.status(key)['result']['keys'] == 30
+        assert b.checkpoint(key) is None
+
+    def test_owner_stopped(self, tmpdir):
+        """运行任务的进程不再更新状态时任务失败"""
+
+        a, _ = self.registries(tmpdir)
+        with open(a._file((1, 'keyspace')), 'w') as f:
+            json.dump({'state': RUNNING, 'owner': 'worker-x', 'updated_at': 0}, f)
+        status = a.status((1, 'keyspace'))
+        assert status['state'] == FAILED
+        assert 'worker-x' in status['error']
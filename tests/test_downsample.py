@@ -0,0 +1,62 @@
+import math
+
+from rmon.metrics import downsample as module
+from rmon.metrics.downsample import downsample
+
+
+class TestDownsample:
+    """测试监控指标降采样
+    """
+
+    timestamps = [float(i) for i in range(1000)]
+    values = [math.sin(i / 50.0) for i in range(1000)]
+
+    def test_avg(self):
+        """分桶聚合返回 [时间戳, 平均值, 最小值, 最大值]
+        """
+        points = downsample(self.timestamps, self.values, 10)
+        assert len(points) == 10
+        for t, avg, low, high in points:
+            assert low <= avg <= high
+        assert points[0][0] == 0.0
+
+    def test_lttb(self):
+        """LTTB保留首尾两个点
+        """
+        points = downsample(self.timestamps, self.values, 50, method='lttb')
+        assert len(points) == 50
+        assert points[0] == [0.0, 0.0]
+        assert points[-1] == [999.0, self.values[-1]]
+
+    def test_lttb_few_points(self):
+        """points 小于3时LTTB仍然降采样，只保留首尾和一个中间点
+        """
+        for points in (1, 2):
+            result = downsample(self.timestamps, self.values, points, method='lttb')
+            assert len(result) == 3
+            assert result[0][0] == 0.0
+            assert result[-1][0] == 999.0
+
+    def test_range_and_nan(self):
+        """只返回时间范围内的非NaN采样点
+        """
+        values = list(self.values)
+        values[11] = float('nan')
+        points = downsample(self.timestamps, values, 100, start=10, end=12)
+        assert [p[0] for p in points] == [10.0, 12.0]
+
+    def test_pure_python(self):
+        """没有安装numpy时结果一致
+        """
+        expected = (downsample(self.timestamps, self.values, 20),
+                    downsample(self.timestamps, self.values, 20, method='lttb'))
+        np, module.np = module.np, None
+        try:
+            result = (downsample(self.timestamps, self.values, 20),
+                      downsample(self.timestamps, self.values, 20, method='lttb'))
+        finally:
+            module.np = np
+        for expected_points, points in zip(expected, result):
+            assert len(expected_points) == len(points)
+            for a, b in zip(expected_points, points):
+                assert all(abs(x - y) < 1e-9 for x, y in zip(a, b))
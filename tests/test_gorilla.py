@@ -0,0 +1,46 @@
+import math
+import struct
+
+from rmon.metrics.gorilla import encode, decode
+
+
+class TestGorilla:
+    """测试 Gorilla 压缩编码
+    """
+
+    def roundtrip(self, timestamps, values):
+        result = list(decode(encode(timestamps, values)))
+        assert len(result) == len(timestamps)
+        for (t, v), expected_t, expected_v in zip(result, timestamps, values):
+            assert abs(t - expected_t) < 1e-6
+            # 按位比较，NaN 也必须一致
+            assert struct.pack('<d', v) == struct.pack('<d', expected_v)
+
+    def test_empty(self):
+        """空序列
+        """
+        assert list(decode(encode([], []))) == []
+
+    def test_roundtrip(self):
+        """编码后解码得到原始数据
+        """
+        timestamps = [1500000000.0, 1500000001.0, 1500000002.0, 1500000002.5,
+                      1500000010.123, 1500100000.0, 1500000000.0]
+        values = [1.0, 1.0, 2.5, -7.25, float('nan'), 1e300, 0.0]
+        self.roundtrip(timestamps, values)
+
+    def test_compression(self):
+        """固定间隔、变化缓慢的序列至少压缩10倍
+        """
+        timestamps = [1500000000.0 + i for i in range(3600)]
+        values = [float(1024 * 1024 + (i // 60) * 8) for i in range(3600)]
+        self.roundtrip(timestamps, values)
+        assert len(encode(timestamps, values)) * 10 < len(timestamps) * 16
+
+    def test_streaming(self):
+        """解码为流式，可以提前停止
+        """
+        timestamps = [float(i) for i in range(1000)]
+        decoder = decode(encode(timestamps, [math.sqrt(i) for i in range(1000)]))
+        assert next(decoder) == (0.0, 0.0)
+        assert next(decoder) == (1.0, 1.0)
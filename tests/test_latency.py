@@ -0,0 +1,132 @@
+import json
+import time
+
+from flask import url_for
+
+from rmon.extensions import latency_prober
+from rmon.metrics.latency import LatencyProber, LatencySeries
+
+
+class TestLatencySeries:
+    """测试往返时间的分桶保存
+    """
+
+    def test_window(self):
+        series = LatencySeries(bucket=10, retention=60)
+        series.record(1000, [100, 200])
+        series.record(1035, [300])
+
+        assert series.histogram(10, now=1040).count == 1
+        assert series.histogram(60, now=1040).count == 3
+
+        # 超过保留时间的桶在新建桶时被删除
+        series.record(1075, [400])
+        assert series.histogram(60, now=1075).count == 2
+        assert len(series._buckets) == 2
+
+
+class TestLatencyProber:
+    """测试延迟探测器
+    """
+
+    def test_probe_once(self, server):
+        prober = LatencyProber()
+        prober.pipeline = 5
+        rtts = prober.probe_once(server)
+
+        assert len(rtts) == 5
+        # 管道中后面的回复不早于前面的回复
+        assert rtts == sorted(rtts)
+        assert prober.summary(server.id, 60)['count'] == 5
+
+    def test_background(self, app, server):
+        """后台通过长连接定时探测"""
+
+        prober = LatencyProber()
+        prober.app = app
+        prober.interval = 0.05
+        prober.pipeline = 2
+        prober.start()
+        try:
+            deadline = time.time() + 5
+            while (prober.histogram(server.id, 60) or LatencySeries().histogram(60)).count < 6:
+                assert time.time() < deadline
+                time.sleep(0.05)
+        finally:
+            prober.stop()
+        assert not prober.running
+
+    def test_survive_errors(self, app, server):
+        """同步服务器列表失败后继续探测，意外结束的探测任务被重新启动"""
+
+        prober = LatencyProber()
+        prober.app = app
+        prober.interval = 0.05
+        prober.pipeline = 2
+        calls = []
+
+        def servers():
+            calls.append(1)
+            if len(calls) == 1:
+                raise RuntimeError('database unavailable')
+            return [server]
+
+        polls = []
+        poll = prober._poll
+
+        async def flaky_poll(server):
+            polls.append(1)
+            if len(polls) == 1:
+                raise RuntimeError('unexpected')
+            await poll(server)
+
+        prober._servers = servers
+        prober._sync_interval = lambda: 0.05
+        prober._poll = flaky_poll
+        prober.start()
+        try:
+            deadline = time.time() + 5
+            while (prober.histogram(server.id, 60) or LatencySeries().histogram(60)).count < 2:
+                assert time.time() < deadline
+                assert prober.running
+                time.sleep(0.05)
+        finally:
+            prober.stop()
+        assert len(polls) >= 2
+
+    def test_error(self, server):
+        prober = LatencyProber()
+        prober.error(server.id, 'ConnectionRefusedError()')
+        summary = prober.summary(server.id, 60)
+        assert summary['count'] == 0
+        assert summary['p99'] is None
+        assert summary['errors'] == 1
+
+
+class TestServerLatency:
+    """测试往返延迟API
+    """
+
+    def test_get(self, server, client):
+        resp = client.get(url_for('api.server_latency', object_id=server.id, window=60))
+        assert resp.status_code == 200
+        data = json.loads(resp.data.decode('utf-8'))
+        assert data['window'] == 60
+        assert data['count'] == latency_prober.pipeline
+        assert data['min'] <= data['p50'] <= data['p99'] <= data['max']
+
+        resp = client.get(url_for('api.server_latency', object_id=server.id, window=0))
+        assert resp.status_code == 400
+
+    def test_fleet(self, server, client):
+        """所有服务器合并后的分位数"""
+
+        other = type(server)(name='redis_other', description='', host='127.0.0.1', port=6379)
+        other.save()
+
+        resp = client.get(url_for('api.server_list_latency'))
+        assert resp.status_code == 200
+        data = json.loads(resp.data.decode('utf-8'))
+        assert [item['id'] for item in data['servers']] == [server.id, other.id]
+        assert data['fleet']['count'] == 2 * latency_prober.pipeline
+        assert data['fleet']['max'] == max(item['latency']['max'] for item in data['servers'])
@@ -0,0 +1,484 @@
+import asyncio
+import math
+import multiprocessing
+import threading
+import time
+from collections import Counter
+
+import pytest
+
+from rmon.models import Server
+from rmon.metrics.series import ServerSeries, parse_info
+from rmon.metrics.collector import MetricsCollector
+from rmon.metrics.cache import MetricsCache
+from rmon.metrics.fanout import Fanout
+from rmon.metrics.derive import RateCalculator
+from rmon.metrics.engine import AsyncEngine, RespError, encode_command, read_reply
+from rmon.metrics.shard import HashRing, Shard
+from rmon.metrics.store import MetricStore
+
+
+class TestServerSeries:
+    """测试监控指标环形缓冲区
+    """
+
+    def test_parse_info(self):
+        """INFO结果展开为数值指标，字符串字段被忽略
+        """
+        info = {
+            'redis_version': '3.2.0',
+            'used_memory': 1024,
+            'loading': False,
+            'db0': {'keys': 10, 'expires': 1},
+        }
+        assert parse_info(info) == {
+            'used_memory': 1024.0,
+            'loading': 0.0,
+            'db0.keys': 10.0,
+            'db0.expires': 1.0,
+        }
+
+    def test_append_and_wrap(self):
+        """缓冲区写满后覆盖最早的数据
+        """
+        series = ServerSeries(3)
+        for i in range(5):
+            series.append(float(i), {'used_memory': i * 10.0})
+
+        assert len(series) == 3
+        assert list(series.timestamps()) == [2.0, 3.0, 4.0]
+        assert list(series.series('used_memory')) == [20.0, 30.0, 40.0]
+        assert series.latest() == {'used_memory': 40.0}
+
+    def test_missing_metric(self):
+        """后出现的指标在之前的位置以NaN填充
+        """
+        series = ServerSeries(4)
+        series.append(1.0, {'a': 1.0})
+        series.append(2.0, {'a': 2.0, 'b': 5.0})
+
+        values = series.series('b')
+        assert math.isnan(values[0])
+        assert values[1] == 5.0
+        assert series.series('c') is None
+
+
+class TestMetricsCollector:
+    """测试监控信息采集器
+    """
+
+    def test_record(self):
+        """保存采样后可以读取最近一次采样和历史记录
+        """
+        collector = MetricsCollector()
+        assert collector.latest(1) is None
+
+        collector.record(1, {'used_memory': 100}, timestamp=1.0)
+        collector.record(1, {'used_memory': 200}, timestamp=2.0)
+
+        sample = collector.latest(1)
+        assert sample.timestamp == 2.0
+        assert sample.info == {'used_memory': 200}
+        assert sample.derived == {}
+        assert list(collector.history(1).series('used_memory')) == [100.0, 200.0]
+
+        collector.forget(1)
+        assert collector.latest(1) is None
+        assert collector.history(1) is None
+
+    def test_maintain_deleted(self, app, server, tmpdir):
+        """采集进程删除已删除服务器的磁盘数据，仍然存在的服务器只关闭段文件"""
+
+        collector = MetricsCollector()
+        collector.app = app
+        collector.store = MetricStore()
+        collector.store.path = str(tmpdir)
+        deleted = server.id + 1
+        collector.record(server.id, {'used_memory': 1})
+        collector.record(deleted, {'used_memory': 1})
+        collector.store.flush()
+
+        collector.maintain([])
+        assert collector.latest(server.id) is None
+        assert collector.store.segments(server.id)
+        assert not tmpdir.join(str(deleted)).check()
+
+    def test_start_on_first_request(self):
+        """开启的后台采集在处理第一个请求前启动，只加载app的 flask 命令行不会启动"""
+
+        from rmon.app import create_app
+        from rmon.extensions import collector, slowlog_collector, latency_prober
+
+        app = create_app(METRICS_COLLECTOR_ENABLED=True, SLOWLOG_COLLECTOR_ENABLED=True,
+                         LATENCY_PROBE_ENABLED=True)
+        try:
+            assert collector._thread is None
+            assert not slowlog_collector.running
+            assert not latency_prober.running
+
+            app.test_client().get('/')
+            assert collector._thread.is_alive()
+            assert slowlog_collector.running
+            assert latency_prober.running
+        finally:
+            collector.stop()
+            slowlog_collector.stop()
+            latency_prober.stop()
+
+    def test_wait(self):
+        """保存新采样后唤醒等待的线程
+        """
+        collector = MetricsCollector()
+        version = collector.version
+
+        # 超时后返回原版本
+        assert collector.wait(version, timeout=0.01) == version
+
+        timer = threading.Timer(0.05, collector.record, args=(1, {'used_memory': 1}))
+        timer.start()
+        assert collector.wait(version, timeout=5) == version + 1
+        timer.join()
+
+
+class TestFanout:
+    """测试并发执行器
+    """
+
+    @staticmethod
+    def call(server):
+        if server.name == 'slow':
+            time.sleep(0.5)
+        return server.name
+
+    def test_timeout_per_server(self):
+        """超时时间从任务开始执行时计算，排在慢服务器后面的服务器不会被标记为超时
+        """
+        fanout = Fanout()
+        fanout.max_workers = 1
+        servers = [Server(name='slow', host='10.0.0.1'), Server(name='fast', host='10.0.0.2')]
+        try:
+            results = fanout.map(self.call, servers, timeout=0.2, queue_timeout=2)
+        finally:
+            fanout.shutdown()
+        assert results[0] == (False, 'redis server 10.0.0.1 timed out')
+        assert results[1] == (True, 'fast')
+
+    def test_queue_timeout(self):
+        """在队列中等待太久的任务被取消，不标记为服务器超时
+        """
+        fanout = Fanout()
+        fanout.max_workers = 1
+        servers = [Server(name='slow', host='10.0.0.1'), Server(name='fast', host='10.0.0.2')]
+        try:
+            results = fanout.map(self.call, servers, timeout=2, queue_timeout=0.1)
+        finally:
+            fanout.shutdown()
+        assert results[0] == (True, 'slow')
+        assert results[1][0] is False
+        assert 'not polled' in results[1][1]
+
+
+class TestMetricsCache:
+    """测试监控信息缓存
+    """
+
+    def test_hit_and_miss(self):
+        """缓存未过期时不再调用加载函数
+        """
+        cache = MetricsCache()
+        calls = []
+
+        def loader():
+            calls.append(1)
+            return len(calls)
+
+        assert cache.get((1, None), loader) == 1
+        assert cache.get((1, None), loader) == 1
+        assert len(calls) == 1
+
+        stats = cache.stats()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
+
+        cache.invalidate(1)
+        assert cache.get((1, None), loader) == 2
+
+    def test_stale_while_revalidate(self):
+        """缓存过期后先返回旧值，并在后台刷新
+        """
+        cache = MetricsCache()
+        cache.ttl = 0
+        values = iter([1, 2])
+
+        assert cache.get((1, None), lambda: next(values)) == 1
+        assert cache.get((1, None), lambda: next(values)) == 1
+        assert cache.stats()['stale'] == 1
+
+        # 等待后台刷新完成
+        for _ in range(100):
+            if cache._entries[(1, None)][0] == 2:
+                break
+            time.sleep(0.01)
+        assert cache._entries[(1, None)][0] == 2
+
+    def test_coalesced(self):
+        """并发请求只执行一次加载函数
+        """
+        cache = MetricsCache()
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def loader():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 'info'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get((1, None), loader)))
+                   for _ in range(5)]
+        threads[0].start()
+        started.wait()
+        for t in threads[1:]:
+            t.start()
+        while cache.stats()['coalesced'] < 4:
+            time.sleep(0.01)
+        release.set()
+        for t in threads:
+            t.join()
+
+        assert len(calls) == 1
+        assert results == ['info'] * 5
+        assert cache.stats()['coalesced'] == 4
+
+    def test_loader_error(self):
+        """加载失败时抛出异常，并且不缓存结果
+        """
+        cache = MetricsCache()
+
+        def loader():
+            raise ValueError('failed')
+
+        try:
+            cache.get((1, None), loader)
+        except ValueError as e:
+            assert str(e) == 'failed'
+        else:
+            assert False
+        assert cache.stats()['size'] == 0
+
+
+class TestRateCalculator:
+    """测试衍生指标计算
+    """
+
+    def info(self, commands, hits, misses, run_id='a', uptime=100):
+        return {
+            'run_id': run_id,
+            'uptime_in_seconds': uptime,
+            'total_commands_processed': commands,
+            'keyspace_hits': hits,
+            'keyspace_misses': misses,
+        }
+
+    def test_rates(self):
+        """根据两次采样的增量计算每秒速率和命中率
+        """
+        rates = RateCalculator()
+        derived = rates.update(1, 10.0, self.info(100, 30, 10))
+        assert derived == {'hit_ratio': 0.75}
+
+        derived = rates.update(1, 20.0, self.info(300, 60, 40, uptime=110))
+        assert derived['ops_per_sec'] == 20.0
+        assert derived['keyspace_hits_per_sec'] == 3.0
+        assert derived['interval_hit_ratio'] == 0.5
+        assert derived['hit_ratio'] == 0.6
+
+    def test_reset(self):
+        """服务器重启后不计算速率
+        """
+        rates = RateCalculator()
+        rates.update(1, 10.0, self.info(100, 30, 10))
+
+        # run_id 改变
+        derived = rates.update(1, 20.0, self.info(200, 40, 10, run_id='b'))
+        assert 'ops_per_sec' not in derived
+
+        # uptime_in_seconds 变小
+        derived = rates.update(1, 30.0, self.info(300, 50, 10, run_id='b', uptime=5))
+        assert 'ops_per_sec' not in derived
+
+        # 重启后的下一次采样恢复计算
+        derived = rates.update(1, 40.0, self.info(400, 50, 10, run_id='b', uptime=15))
+        assert derived['ops_per_sec'] == 10.0
+
+
+class TestAsyncEngine:
+    """测试asyncio采集引擎
+    """
+
+    def run(self, coroutine):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def test_resp(self):
+        """RESP指令编码和回复解析"""
+
+        assert encode_command('INFO', 'memory') == b'*2\r\n$4\r\nINFO\r\n$6\r\nmemory\r\n'
+
+        async def parse(data):
+            reader = asyncio.StreamReader()
+            reader.feed_data(data)
+            reader.feed_eof()
+            return await read_reply(reader)
+
+        assert self.run(parse(b'+OK\r\n')) == b'OK'
+        assert self.run(parse(b':42\r\n')) == 42
+        assert self.run(parse(b'$-1\r\n')) is None
+        assert self.run(parse(b'*2\r\n$3\r\nfoo\r\n:1\r\n')) == [b'foo', 1]
+        with pytest.raises(RespError):
+            self.run(parse(b'-ERR unknown command\r\n'))
+
+    def test_collect_once(self, server):
+        """并发采集服务器，无法访问的服务器返回异常"""
+
+        collector = MetricsCollector()
+        engine = AsyncEngine(collector, timeout=1)
+        unreachable = Server(id=server.id + 1, name='redis_down', host='127.0.0.1', port=1)
+
+        try:
+            sample, error = self.run(engine.collect_once([server, unreachable]))
+        finally:
+            engine.close()
+
+        assert sample.info['redis_version'] == server.get_metrics()['redis_version']
+        assert collector.latest(server.id) is sample
+        assert isinstance(error, OSError)
+        assert collector.latest(unreachable.id) is None
+
+    def test_record_in_executor(self, server):
+        """保存采样在单独的线程池中执行，保存变慢时事件循环仍然运行"""
+
+        collector = MetricsCollector()
+        engine = AsyncEngine(collector, timeout=1)
+        threads = []
+        record = collector.record
+
+        def slow_record(server_id, info):
+            threads.append(threading.current_thread())
+            time.sleep(0.2)
+            return record(server_id, info)
+
+        collector.record = slow_record
+
+        async def collect():
+            task = asyncio.ensure_future(engine.collect_once([server]))
+            ticks = 0
+            while not task.done():
+                ticks += 1
+                await asyncio.sleep(0.01)
+            return ticks, task.result()
+
+        try:
+            ticks, (sample,) = self.run(collect())
+        finally:
+            engine.close()
+        assert threads[0] is not threading.current_thread()
+        assert ticks >= 10
+        assert collector.latest(server.id) is sample
+
+    def test_survive_errors(self, server):
+        """采集周期和单个服务器的意外错误不会使采集停止"""
+
+        collector = MetricsCollector()
+        engine = AsyncEngine(collector, interval=0.05, timeout=1)
+        calls = []
+
+        def servers():
+            calls.append(1)
+            if len(calls) == 1:
+                raise RuntimeError('database unavailable')
+            return [server]
+
+        records = []
+
+        def record(server_id, info):
+            records.append(server_id)
+            if len(records) == 1:
+                raise ValueError('bad info')
+
+        engine._servers = servers
+        collector.maintain = lambda server_ids: None
+        collector.record = record
+        stop = threading.Event()
+        thread = threading.Thread(target=engine.run, args=(stop,))
+        thread.start()
+        try:
+            deadline = time.monotonic() + 5
+            while len(records) < 2 and time.monotonic() < deadline:
+                time.sleep(0.05)
+        finally:
+            stop.set()
+            thread.join()
+        assert len(calls) > 1
+        assert len(records) >= 2
+
+    def test_restart_done_task(self, server):
+        """意外结束的采集任务在下一次同步时重新启动"""
+
+        engine = AsyncEngine(MetricsCollector())
+
+        async def check():
+            engine._semaphore = asyncio.Semaphore(1)
+            done = asyncio.get_event_loop().create_future()
+            done.set_result(None)
+            key = (server.host, server.port, server.password)
+            engine._tasks = {server.id: (key, done)}
+            engine._sync([server])
+            task = engine._tasks[server.id][1]
+            assert task is not done
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        self.run(check())
+
+
+class TestHashRing:
+    """测试一致性哈希
+    """
+
+    def test_balance(self):
+        """服务器大致均匀地分配给各个节点"""
+
+        ring = HashRing(range(4))
+        counts = Counter(ring.get(i) for i in range(4000))
+        assert set(counts) == {0, 1, 2, 3}
+        assert min(counts.values()) > 600
+
+    def test_remove_node(self):
+        """删除节点时只有该节点的服务器被重新分配"""
+
+        ring = HashRing(range(4))
+        before = {i: ring.get(i) for i in range(1000)}
+        ring.remove(3)
+        for key, node in before.items():
+            if node != 3:
+                assert ring.get(key) == node
+            else:
+                assert ring.get(key) in (0, 1, 2)
+
+    def test_shard_resize(self, server):
+        """采集进程数量改变后重新分配服务器"""
+
+        size = multiprocessing.Value('i', 1)
+        collector = MetricsCollector()
+        collector.shard = Shard(0, size)
+        assert [s.id for s in collector.servers()] == [server.id]
+
+        size.value = 2
+        owner = HashRing(range(2)).get(server.id)
+        assert bool(collector.servers()) == (owner == 0)
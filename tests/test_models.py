@@ -1,5 +1,15 @@
-from rmon.models import Server
+from rmon.models import Server, User
 from rmon.common.rest import RestException
+from rmon.extensions import db, redis_pools, server_registry
+from rmon.common.registry import ServerRegistry
+from rmon.common.token_cache import TokenCache, UserPrincipal
+from rmon.common.errors import InvalidTokenError
+from calendar import timegm
+from flask import current_app
+import jwt
+import os
+import pytest
+import time
 
 
 class TestServer:
@@ -60,6 +70,14 @@ class TestServer:
         """
         assert len(server.get_metrics()) > 0
 
+    def test_get_metrics_with_sections(self, db, server):
+        """测试 Server.get_metrics 只获取指定section的监控信息
+        """
+        info = server.get_metrics(['memory', 'stats'])
+        assert 'used_memory' in info
+        assert 'total_commands_processed' in info
+        assert 'redis_version' not in info
+
     def test_get_metrics_failed(self, db):
         """测试 Server.get_metrics方法执行失败
 
@@ -74,3 +92,241 @@ class TestServer:
         except RestException as e:
             assert e.code == 400
             assert e.message == 'redis server %s can not connected' % server.host
+
+    def test_redis_pool_reused(self, db, server):
+        """测试 Server.redis 复用同一个连接池
+        """
+        assert server.redis.connection_pool is server.redis.connection_pool
+
+    def test_redis_pool_invalidated(self, db, server):
+        """测试服务器地址改变或者连接池失效后重新创建连接池
+        """
+        pool = server.redis.connection_pool
+
+        # 服务器地址改变后，原有连接池不再使用
+        server.port = 6380
+        assert server.redis.connection_pool is not pool
+
+        # 连接池失效后，重新创建连接池
+        pool = server.redis.connection_pool
+        redis_pools.invalidate(server.id)
+        assert server.redis.connection_pool is not pool
+
+    def test_unsaved_server_temporary(self, db):
+        """测试尚未保存的服务器使用临时连接，不创建共享连接池
+        """
+        server = Server(name='test', host='127.0.0.1', port=6379)
+        pools = len(redis_pools)
+        with pytest.raises(ValueError):
+            server.redis
+        assert server.ping()
+        assert len(server.get_metrics()) > 0
+        assert len(redis_pools) == pools
+
+    def test_redis_pool_sweep_skips_checked_out(self, db, server):
+        """测试回收空闲连接池时跳过有连接借出的连接池
+        """
+        redis_pools.idle_timeout = 10
+        try:
+            pool = server.redis.connection_pool
+            connection = pool.get_connection('PING')
+            pool.used -= 60
+            assert redis_pools._sweep(time.monotonic()) == []
+            assert server.redis.connection_pool is pool
+
+            pool.release(connection)
+            pool.used -= 60
+            assert redis_pools._sweep(time.monotonic()) == [pool]
+        finally:
+            redis_pools.idle_timeout = 300
+
+
+class TestTokenCache:
+    """测试token缓存
+    """
+
+    def test_get_and_expire(self):
+        """缓存在token过期时失效
+        """
+        cache = TokenCache()
+        principal = UserPrincipal(1, True)
+
+        cache.put('token', principal, time.time() + 60)
+        assert cache.get('token') == principal
+        assert cache.get('other') is None
+
+        cache.put('expired', principal, time.time() - 1)
+        assert cache.get('expired') is None
+
+    def test_lru(self):
+        """超过缓存数量时删除最久未使用的token
+        """
+        cache = TokenCache()
+        cache.max_size = 2
+        exp = time.time() + 60
+
+        cache.put('a', UserPrincipal(1, False), exp)
+        cache.put('b', UserPrincipal(2, False), exp)
+        cache.get('a')
+        cache.put('c', UserPrincipal(3, False), exp)
+
+        assert cache.get('b') is None
+        assert cache.get('a') is not None
+        assert cache.get('c') is not None
+
+    def test_invalidate_user(self):
+        """删除用户的所有token缓存
+        """
+        cache = TokenCache()
+        exp = time.time() + 60
+        cache.put('a', UserPrincipal(1, False), exp)
+        cache.put('b', UserPrincipal(1, False), exp)
+        cache.put('c', UserPrincipal(2, False), exp)
+
+        cache.invalidate_user(1)
+        assert len(cache) == 1
+        assert cache.get('c') is not None
+
+    def test_ttl(self):
+        """缓存时间不超过ttl"""
+        cache = TokenCache()
+        cache.ttl = 0
+        cache.put('a', UserPrincipal(1, False), time.time() + 60)
+        assert cache.get('a') is None
+
+    def test_invalidate_other_process(self, tmpdir):
+        """一个进程修改用户后，其他进程通过版本文件清空缓存"""
+        from rmon.common.version import VersionFile
+
+        path = str(tmpdir.join('version'))
+        caches = []
+        for _ in range(2):
+            cache = TokenCache()
+            cache.version_file = VersionFile(path)
+            cache._version = cache.version_file.read()
+            caches.append(cache)
+        exp = time.time() + 60
+        for cache in caches:
+            cache.put('a', UserPrincipal(1, True), exp)
+            cache.put('b', UserPrincipal(2, True), exp)
+
+        caches[0].invalidate_user(1)
+        assert caches[0].get('a') is None
+        assert caches[0].get('b') is not None
+        assert caches[1].get('a') is None
+        assert caches[1].get('b') is None
+
+
+class TestVerifyTokenCached:
+    """测试 User.verify_token_cached
+    """
+
+    @staticmethod
+    def token(user):
+        exp = timegm(time.gmtime()) + 3600
+        payload = {'uid': user.id, 'is_admin': user.is_admin, 'exp': exp,
+                   'refresh_exp': exp + 600}
+        return jwt.encode(payload, current_app.secret_key, algorithm='HS512').decode('utf-8')
+
+    def test_cached_until_user_changed(self, app, db):
+        """用户被修改或删除后缓存失效"""
+        app.secret_key = 'test'
+        user = User(name='admin_test', email='admin_test@rmon.com', is_admin=True)
+        user.password = '123456'
+        user.save()
+        token = self.token(user)
+
+        assert User.verify_token_cached(token) == UserPrincipal(user.id, True)
+        # 缓存命中时不查询数据库
+        User.query.filter_by(id=user.id).update({'is_admin': False})
+        db.session.commit()
+        assert User.verify_token_cached(token) == UserPrincipal(user.id, True)
+
+        user = User.query.get(user.id)
+        user.save()
+        assert User.verify_token_cached(token) == UserPrincipal(user.id, False)
+
+        user.delete()
+        with pytest.raises(InvalidTokenError):
+            User.verify_token_cached(token)
+
+    def test_invalid_token(self, app, db):
+        app.secret_key = 'test'
+        with pytest.raises(InvalidTokenError):
+            User.verify_token_cached('invalid')
+
+
+class TestServerRegistry:
+    """测试服务器进程内缓存
+    """
+
+    def test_write_through(self, server):
+        """保存和删除服务器时同步更新缓存"""
+
+        cached = server_registry.get(server.id)
+        assert cached.name == server.name
+        assert cached is not server
+
+        server.name = 'redis_renamed'
+        server.save()
+        assert server_registry.find('redis_renamed').id == server.id
+        assert server_registry.find('redis_test') is None
+
+        server.delete()
+        assert server_registry.get(cached.id) is None
+        assert server_registry.all() == []
+
+    def test_reload_on_version_change(self, server, tmpdir):
+        """版本文件中的计数器被其他进程修改后重新加载"""
+        from rmon.common.version import VersionFile
+
+        path = str(tmpdir.join('version'))
+        registry = ServerRegistry()
+        registry.version_file = VersionFile(path)
+        description = server.description
+        assert registry.get(server.id).description == description
+
+        # 模拟其他进程修改数据库，同一时刻的多次修改也会改变计数器
+        Server.query.filter_by(id=server.id).update({'description': 'changed'})
+        db.session.commit()
+        assert registry.get(server.id).description == description
+
+        VersionFile(path).bump()
+        assert registry.get(server.id).description == 'changed'
+
+        # 本进程的修改不需要重新加载
+        registry.put(Server.query.get(server.id))
+        version = registry._version
+        assert registry.get(server.id).description == 'changed'
+        assert registry._version == version
+
+    def test_concurrent_read_write(self, server):
+        """修改缓存时读取不会出错"""
+        import threading
+
+        registry = ServerRegistry()
+        registry.all()
+        stop = threading.Event()
+        errors = []
+
+        def read():
+            while not stop.is_set():
+                try:
+                    registry.all()
+                    registry.find(server.name)
+                except Exception as e:
+                    errors.append(e)
+                    return
+
+        readers = [threading.Thread(target=read) for _ in range(2)]
+        for reader in readers:
+            reader.start()
+        try:
+            for i in range(2000):
+                registry.put(Server(id=1000 + i, name='redis_%d' % i, host='127.0.0.1'))
+                registry.remove(1000 + i - 1)
+        finally:
+            stop.set()
+            for reader in readers:
+                reader.join()
+        assert errors == []
@@ -0,0 +1,198 @@
+import json
+import random
+import threading
+import time
+from collections import Counter
+
+import pytest
+from flask import url_for
+
+from rmon.analysis.jobs import DONE
+from rmon.analysis.monitor import MonitorSampler, parse_monitor_line
+from rmon.analysis.sketch import CountMinSketch, SpaceSaving
+from rmon.common.token_cache import UserPrincipal
+from rmon.extensions import analysis_jobs
+from rmon.models import User
+
+
+class TestSketch:
+    """测试流式频率统计
+    """
+
+    def test_count_min_sketch(self):
+        """估计值不小于真实值"""
+
+        sketch = CountMinSketch(width=64, depth=4)
+        for i in range(1000):
+            sketch.add('key:%d' % (i % 100))
+        sketch.add('hot', 500)
+
+        assert sketch.total == 1500
+        assert sketch.estimate('hot') >= 500
+        assert all(sketch.estimate('key:%d' % i) >= 10 for i in range(100))
+        assert CountMinSketch().estimate('missing') == 0
+
+    def test_space_saving(self):
+        """出现次数超过 总数/k 的元素一定保留，真实次数在 计数-误差 和 计数 之间"""
+
+        top = SpaceSaving(k=10)
+        for i in range(1000):
+            top.add('hot:%d' % (i % 3))
+            top.add('cold:%d' % i)
+
+        items = {item: (count, error) for item, count, error in top.items()}
+        assert len(items) == 10
+        for i in range(3):
+            count, error = items['hot:%d' % i]
+            assert count - error <= 333 + (i == 0) <= count
+        assert top.items(limit=1)[0][1] == max(count for count, _ in items.values())
+
+
+    def test_space_saving_invariants(self):
+        """计数之和等于总数，每个元素的真实次数在 计数-误差 和 计数 之间，分组按计数递增"""
+
+        rng = random.Random(1)
+        top = SpaceSaving(k=20)
+        truth = Counter()
+        for _ in range(5000):
+            item = 'key:%d' % int(rng.paretovariate(1.2))
+            count = rng.choice((1, 1, 1, 3))
+            truth[item] += count
+            top.add(item, count)
+
+        items = top.items()
+        assert len(items) == 20
+        assert sum(count for _, count, _ in items) == sum(truth.values())
+        for item, count, error in items:
+            assert count - error <= truth[item] <= count
+
+        counts = []
+        node = top._head
+        while node is not None:
+            assert node.items
+            counts.append(node.count)
+            node = node.next
+        assert counts == sorted(set(counts))
+
+
+class TestMonitorParser:
+    """测试 MONITOR 输出解析
+    """
+
+    def test_parse(self):
+        line = b'+1339518083.107412 [0 127.0.0.1:60866] "SET" "user:1" "a \\"b\\"\\x00\\n"'
+        timestamp, db, client, args = parse_monitor_line(line)
+        assert timestamp == 1339518083.107412
+        assert db == 0
+        assert client == '127.0.0.1:60866'
+        assert args == [b'SET', b'user:1', b'a "b"\x00\n']
+
+        assert parse_monitor_line(b'+1339518083.107412 [3 lua] "get" "x"')[1:] == (
+            3, 'lua', [b'get', b'x'])
+        assert parse_monitor_line(b'+OK') is None
+
+    def test_feed(self):
+        sampler = MonitorSampler(type('Server', (), {'host': None, 'port': None,
+                                                     'password': None}))
+        sampler.feed([b'+OK'] + [
+            b'+1.0 [0 127.0.0.1:1] "GET" "user:%d"' % (i % 2) for i in range(10)
+        ] + [b'+1.0 [0 127.0.0.1:1] "PING"'])
+
+        result = sampler.result()
+        assert sampler.lines == 11
+        assert [(item['command'], item['count']) for item in result['commands']] == [
+            ('GET', 10), ('PING', 1)]
+        assert {item['key']: item['count'] for item in result['keys']} == {
+            'user:0': 5, 'user:1': 5}
+        assert sampler.estimate(['user:0'])['user:0'] >= 5
+
+
+class TestMonitorSampler:
+    """测试 MONITOR 采样
+    """
+
+    def traffic(self, redis, stop):
+        while not stop.is_set():
+            redis.get('rmon_test:hot')
+            redis.get('rmon_test:cold')
+            redis.get('rmon_test:hot')
+
+    def test_run(self, server):
+        """采样时间用完后自动停止"""
+
+        stop = threading.Event()
+        thread = threading.Thread(target=self.traffic, args=(server.redis, stop))
+        thread.start()
+        try:
+            sampler = MonitorSampler(server, duration=0.5, top=5)
+            sampler.run(threading.Event())
+        finally:
+            stop.set()
+            thread.join()
+
+        assert sampler.stopped_by == 'duration'
+        assert sampler.lines > 0
+        keys = [item['key'] for item in sampler.result()['keys']]
+        assert keys[0] == 'rmon_test:hot'
+
+    def test_bytes_budget(self, server):
+        """读取的字节数用完后自动停止"""
+
+        stop = threading.Event()
+        thread = threading.Thread(target=self.traffic, args=(server.redis, stop))
+        thread.start()
+        try:
+            sampler = MonitorSampler(server, duration=10, max_bytes=2000)
+            started = time.time()
+            sampler.run(threading.Event())
+        finally:
+            stop.set()
+            thread.join()
+
+        assert sampler.stopped_by == 'bytes'
+        assert sampler.bytes == 2000
+        assert time.time() - started < 5
+
+
+class TestServerMonitor:
+    """测试 MONITOR 采样API
+    """
+
+    endpoint = 'api.server_monitor'
+
+    @pytest.fixture(autouse=True)
+    def admin(self, monkeypatch):
+        """跳过token认证"""
+        monkeypatch.setattr(User, 'verify_token_cached',
+                            staticmethod(lambda token: UserPrincipal(1, True)))
+
+    def request(self, client, method, server_id, **args):
+        return client.open(url_for(self.endpoint, object_id=server_id, **args), method=method,
+                           headers={'Authorization': 'jwt token'})
+
+    def test_sample(self, server, client):
+        resp = self.request(client, 'GET', server.id)
+        assert resp.status_code == 404
+
+        resp = self.request(client, 'POST', server.id, duration=1000)
+        assert resp.status_code == 400
+
+        resp = self.request(client, 'POST', server.id, duration=1)
+        assert resp.status_code == 202
+        resp = self.request(client, 'POST', server.id, duration=1)
+        assert resp.status_code == 400
+
+        # 收到 MONITOR 的回复后再执行指令
+        job = analysis_jobs.get((server.id, 'monitor'))
+        while not job.task.bytes:
+            time.sleep(0.01)
+        for _ in range(10):
+            server.redis.get('rmon_test:hot')
+        job.join(5)
+        assert job.state == DONE
+
+        resp = self.request(client, 'GET', server.id, keys='rmon_test:hot')
+        data = json.loads(resp.data.decode('utf-8'))
+        assert data['progress']['stopped_by'] == 'duration'
+        assert data['estimates']['rmon_test:hot'] >= 10
+        assert data['result']['keys'][0]['key'] == 'rmon_test:hot'
@@ -0,0 +1,142 @@
+import os
+import struct
+
+import pytest
+from redis import StrictRedis
+
+from rmon.analysis.rdb import RdbParser, RdbError, analyze_rdb, lzf_decompress
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def encode_string(value):
+    assert len(value) < 64
+    return bytes([len(value)]) + value
+
+
+class TestRdbParser:
+    """测试 RDB 文件离线分析
+    """
+
+    @pytest.fixture
+    def redis(self):
+        redis = StrictRedis(db=15)
+        redis.flushdb()
+        yield redis
+        redis.flushdb()
+
+    def build(self, tmpdir, redis, expires=None):
+        """通过 DUMP 指令获取每个键的序列化结果，组成 RDB 文件
+
+        DUMP 的结果为 类型(1字节) | 值 | RDB版本(2字节) | 校验和(8字节)
+        """
+        expires = expires or {}
+        data = [b'REDIS0009', b'\xfa', encode_string(b'ctime'), encode_string(b'1000'),
+                b'\xfe\x03']
+        for key in sorted(redis.keys()):
+            payload = redis.dump(key)
+            if key in expires:
+                data.append(b'\xfc' + struct.pack('<Q', expires[key]))
+            data.append(payload[:1] + encode_string(key) + payload[1:-10])
+        data.append(b'\xff' + b'\x00' * 8)
+        path = str(tmpdir.join('dump.rdb'))
+        with open(path, 'wb') as f:
+            f.write(b''.join(data))
+        return path
+
+    def test_encodings(self, tmpdir, redis):
+        """紧凑编码和普通编码的值都可以解析"""
+
+        redis.set('string:int', 12345)
+        redis.set('string:big', 'abc' * 1000)
+        redis.rpush('list:small', *range(10))
+        redis.rpush('list:big', *['v' * 100 for _ in range(1000)])
+        redis.sadd('set:int', *range(100))
+        redis.sadd('set:big', *['m%d' % i for i in range(1000)])
+        redis.zadd('zset:small', 1, 'a', 2.5, 'b')
+        redis.zadd('zset:big', **{'m%d' % i: i * 0.5 for i in range(1000)})
+        redis.hmset('hash:small', {'a': 1})
+        redis.hmset('hash:big', {'f%d' % i: 'v' * 100 for i in range(1000)})
+        types = {key: redis.type(key).decode('utf-8') for key in redis.keys()}
+        path = self.build(tmpdir, redis)
+
+        with RdbParser(path) as parser:
+            entries = list(parser.entries())
+        assert parser.version == 9
+        assert {entry.key: entry.type for entry in entries} == types
+        assert {entry.db for entry in entries} == {3}
+        assert os.path.getsize(path) - 9 > sum(entry.size for entry in entries)
+
+    def test_report(self, tmpdir, redis):
+        """生成与在线分析相同格式的结果，剩余过期时间相对于文件生成时间计算"""
+
+        redis.set('user:1:name', 'x' * 1000)
+        redis.set('user:2:name', 'y')
+        redis.set('counter', 1)
+        path = self.build(tmpdir, redis, expires={b'user:2:name': 1060 * 1000})
+
+        result = analyze_rdb(path, top=1)
+        assert result['keys'] == 3
+        assert result['expires'] == 1
+        assert result['types']['string']['keys'] == 3
+        assert result['prefixes'][0]['prefix'] == 'user'
+        assert result['prefixes'][0]['keys'] == 2
+        assert [item['key'] for item in result['largest']] == ['user:1:name']
+
+        with RdbParser(path) as parser:
+            ttl = {entry.key: entry.expire for entry in parser.entries()}
+        assert ttl[b'user:2:name'] == 1060 * 1000
+
+        assert analyze_rdb(path, db=0)['keys'] == 0
+
+    def test_compressed_key(self, tmpdir, redis):
+        """LZF 压缩的键名需要解压"""
+
+        # 字符串值的 DUMP 结果与压缩的键名编码相同
+        redis.set('value', 'abc' * 100)
+        key = redis.dump('value')[1:-10]
+        path = str(tmpdir.join('dump.rdb'))
+        with open(path, 'wb') as f:
+            f.write(b'REDIS0009\x00' + key + encode_string(b'v') + b'\xff')
+
+        with RdbParser(path) as parser:
+            entry, = parser.entries()
+        assert entry.key == b'abc' * 100
+
+    def test_window(self, tmpdir, redis):
+        """读取位置超出映射范围时重新映射"""
+
+        for i in range(1000):
+            redis.set('key:%d' % i, 'v' * 50)
+        path = self.build(tmpdir, redis)
+
+        with RdbParser(path, window_size=4096) as parser:
+            assert len(list(parser.entries())) == 1000
+
+    def test_empty_file(self):
+        """仓库中的 dump.rdb 没有任何键"""
+
+        result = analyze_rdb(os.path.join(ROOT, 'dump.rdb'))
+        assert result['version'] == 6
+        assert result['keys'] == 0
+
+    def test_invalid_file(self, tmpdir, redis):
+        path = str(tmpdir.join('invalid.rdb'))
+        with open(path, 'wb') as f:
+            f.write(b'not a rdb file')
+        with pytest.raises(RdbError):
+            analyze_rdb(path)
+
+        redis.set('key', 'v' * 100)
+        path = self.build(tmpdir, redis)
+        with open(path, 'rb+') as f:
+            f.truncate(os.path.getsize(path) - 20)
+        with pytest.raises(RdbError):
+            analyze_rdb(path)
+
+    def test_lzf_decompress(self):
+        # 2个字面量字节，然后从前1个字节开始复制38个字节
+        assert lzf_decompress(b'\x01aa\xe0\x1b\x00\x01aa', 40) == b'a' * 40
+        with pytest.raises(RdbError):
+            lzf_decompress(b'\x01aa', 40)
@@ -0,0 +1,170 @@
+import json
+
+import pytest
+from flask import url_for
+
+from rmon.analysis.slowlog import (SlowlogAggregator, SlowlogEntry, key_pattern, signature,
+                                   OTHER)
+from rmon.extensions import slowlog_collector
+from rmon.metrics.histogram import LogHistogram
+
+
+class TestLogHistogram:
+    """测试可合并的对数分桶直方图
+    """
+
+    def test_quantiles(self):
+        histogram = LogHistogram()
+        for value in range(1, 1001):
+            histogram.add(value)
+
+        p50, p99, p999 = histogram.quantiles(0.5, 0.99, 0.999)
+        assert p50 == pytest.approx(500, rel=0.05)
+        assert p99 == pytest.approx(990, rel=0.05)
+        assert p999 <= histogram.max == 1000
+        assert histogram.mean == 500.5
+        assert LogHistogram().quantile(0.5) is None
+
+    def test_merge(self):
+        """合并后的结果与整体计算的一致"""
+
+        a, b, total = LogHistogram(), LogHistogram(), LogHistogram()
+        for value in range(1, 500):
+            a.add(value)
+            total.add(value)
+        for value in range(500, 2000, 3):
+            b.add(value)
+            total.add(value)
+
+        merged = LogHistogram.from_dict(json.loads(json.dumps(a.to_dict()))).merge(b)
+        assert merged.counts == total.counts
+        assert merged.quantiles(0.5, 0.99) == total.quantiles(0.5, 0.99)
+        assert (merged.count, merged.min, merged.max) == (total.count, 1, total.max)
+
+
+class TestSignature:
+    """测试慢查询指令签名
+    """
+
+    def test_key_pattern(self):
+        assert key_pattern('user:1000:name') == 'user:*:name'
+        assert key_pattern('session:9f86d081884c7d65') == 'session:*'
+        assert key_pattern('cache/3f2504e0-4f89-11d3-9a0c-0305e82c3301') == 'cache/*'
+        assert key_pattern('queue:v2') == 'queue:v*'
+        assert key_pattern('config') == 'config'
+
+    def test_signature(self):
+        assert signature([b'HGETALL', b'user:1', b'extra']) == 'HGETALL user:*'
+        assert signature([b'get', b'order:42']) == 'GET order:*'
+        assert signature([b'KEYS', b'user:*']) == 'KEYS'
+        assert signature([b'CONFIG', b'get', b'maxmemory']) == 'CONFIG GET'
+        assert signature([b'MEMORY', b'USAGE', b'user:7']) == 'MEMORY USAGE user:*'
+        assert signature([b'EVAL', b'return 1', b'1', b'lock:5']) == 'EVAL lock:*'
+        assert signature([b'EVALSHA', b'e0e1f9fabfc9d4800c877a703b823ac0578ff8db', b'0']) == \
+            'EVALSHA e0e1f9fabfc9'
+
+
+class TestSlowlogAggregator:
+    """测试慢查询按签名汇总
+    """
+
+    def entries(self, *items):
+        return [SlowlogEntry(*item) for item in items]
+
+    def test_dedup(self):
+        """只保留上一次之后的新日志，服务器重启后日志id重新开始"""
+
+        aggregator = SlowlogAggregator()
+        first = self.entries((2, 1000, 10, [b'GET', b'a:1']), (1, 1000, 20, [b'GET', b'a:2']))
+        assert aggregator.new_entries(first) == first
+        aggregator.add(first, now=1000)
+        assert aggregator.last_id == 2
+
+        second = self.entries((3, 1001, 30, [b'GET', b'a:3'])) + first
+        assert aggregator.new_entries(second) == second[:1]
+        assert aggregator.new_entries(first) == []
+
+        restarted = self.entries((0, 1002, 40, [b'GET', b'a:4']))
+        assert aggregator.new_entries(restarted) == restarted
+
+    def test_top(self):
+        """按时间窗口合并桶并排序"""
+
+        aggregator = SlowlogAggregator(bucket=60, retention=3600)
+        aggregator.add(self.entries(
+            (4, 1000, 5000, [b'HGETALL', b'user:1']),
+            (3, 990, 100, [b'GET', b'a:1']),
+            (2, 900, 100, [b'GET', b'a:2']),
+            (1, 100, 100, [b'GET', b'a:3']),
+        ), now=1000)
+
+        rows = aggregator.top(3600, now=1000)
+        assert [row['signature'] for row in rows] == ['HGETALL user:*', 'GET a:*']
+        assert rows[1]['count'] == 3
+        assert rows[1]['total'] == 300
+        assert rows[0]['example'] == 'HGETALL user:1'
+        assert rows[0]['last_seen'] == 1000
+
+        # 时间窗口按桶计算，只包含 960 开始的桶
+        rows = aggregator.top(30, sort='count', now=1000)
+        assert {row['signature']: row['count'] for row in rows} == {
+            'HGETALL user:*': 1, 'GET a:*': 1}
+
+        # 超过保留时间的桶被删除
+        aggregator.expire(5000)
+        assert aggregator.top(3600, now=5000) == []
+        assert aggregator._examples == {}
+
+    def test_max_signatures(self):
+        aggregator = SlowlogAggregator(max_signatures=2)
+        aggregator.add(self.entries(
+            (3, 1000, 10, [b'GET', b'a']),
+            (2, 1000, 10, [b'GET', b'b']),
+            (1, 1000, 10, [b'GET', b'c']),
+        ), now=1000)
+        assert {row['signature'] for row in aggregator.top(60, now=1000)} == {
+            'GET a', 'GET b', OTHER}
+
+
+class TestServerSlowlog:
+    """测试慢查询汇总API
+    """
+
+    endpoint = 'api.server_slowlog'
+
+    @pytest.fixture
+    def slowlog(self, server):
+        redis = server.redis
+        threshold = redis.config_get('slowlog-log-slower-than')['slowlog-log-slower-than']
+        redis.config_set('slowlog-log-slower-than', 0)
+        redis.execute_command('SLOWLOG', 'RESET')
+        yield redis
+        redis.config_set('slowlog-log-slower-than', threshold)
+
+    def test_get(self, server, client, slowlog):
+        """请求时获取新的慢查询日志"""
+
+        for i in range(5):
+            slowlog.get('rmon_test:%d' % i)
+
+        resp = client.get(url_for(self.endpoint, object_id=server.id, sort='count'))
+        assert resp.status_code == 200
+        data = json.loads(resp.data.decode('utf-8'))
+        assert data['window'] == 3600
+        rows = {row['signature']: row for row in data['signatures']}
+        assert rows['GET rmon_test:*']['count'] == 5
+        last_id = data['last_id']
+
+        # 没有新日志时不重复计入
+        slowlog_collector.poll(server)
+        assert slowlog_collector.aggregator(server.id).last_id > last_id
+        data = slowlog_collector.top(server.id, 3600)
+        rows = {row['signature']: row for row in data['signatures']}
+        assert rows['GET rmon_test:*']['count'] == 5
+
+    def test_invalid_args(self, server, client):
+        resp = client.get(url_for(self.endpoint, object_id=server.id, sort='name'))
+        assert resp.status_code == 400
+
+        resp = client.get(url_for(self.endpoint, object_id=server.id, window=0))
+        assert resp.status_code == 400
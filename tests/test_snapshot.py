@@ -0,0 +1,103 @@
+import json
+import multiprocessing
+import time
+
+from rmon.common.encoder import ResponseEncoder
+from rmon.metrics.collector import MetricsCollector
+from rmon.metrics.snapshot import MetricsSnapshot, SEQUENCE, HEADER_SIZE, decompress, is_compressed
+
+
+class TestMetricsSnapshot:
+    """测试多进程共享的监控信息快照
+    """
+
+    def snapshot(self, tmpdir):
+        snapshot = MetricsSnapshot()
+        snapshot.path = str(tmpdir.join('snapshot'))
+        snapshot.slots = 16
+        snapshot.slot_size = 256
+        snapshot.open()
+        return snapshot
+
+    def test_write_and_read(self, tmpdir):
+        """写入后读取，覆盖写入后读取到新数据"""
+
+        snapshot = self.snapshot(tmpdir)
+        assert snapshot.read(1) is None
+
+        assert snapshot.write(1, 1000.0, b'{"used_memory": 1}')
+        assert snapshot.write(1, 1001.0, b'{"used_memory": 2}')
+        assert snapshot.read(1) == (1001.0, b'{"used_memory": 2}')
+        assert snapshot.read(2) is None
+
+        # 超过最长时间的快照已过期
+        assert snapshot.read(1, max_age=10) is None
+
+        snapshot.remove(1)
+        assert snapshot.read(1) is None
+
+    def test_out_of_range(self, tmpdir):
+        """服务器id超出槽数量或数据超过槽大小时不写入"""
+
+        snapshot = self.snapshot(tmpdir)
+        assert not snapshot.write(17, 1000.0, b'{}')
+        assert not snapshot.write(1, 1000.0, b'x' * 256)
+        assert snapshot.read(17) is None
+
+    def test_writing(self, tmpdir):
+        """序号为奇数时说明正在写入，读取失败"""
+
+        snapshot = self.snapshot(tmpdir)
+        snapshot.write(1, 1000.0, b'{}')
+        SEQUENCE.pack_into(snapshot._mmap, HEADER_SIZE, 3)
+        assert snapshot.read(1) is None
+
+        # 写入的进程中途退出后可以继续写入
+        snapshot.write(1, 1001.0, b'{}')
+        assert snapshot.read(1) == (1001.0, b'{}')
+
+    def test_other_process(self, tmpdir):
+        """读取其他进程写入的快照"""
+
+        snapshot = self.snapshot(tmpdir)
+
+        def write():
+            writer = self.snapshot(tmpdir)
+            writer.write(3, time.time(), b'{"ok": true}')
+
+        process = multiprocessing.Process(target=write)
+        process.start()
+        process.join()
+
+        assert snapshot.read(3, max_age=10)[1] == b'{"ok": true}'
+
+    def test_collector_publish(self, tmpdir):
+        """采集器保存采样时写入快照，数据与监控信息API的响应一致"""
+
+        collector = MetricsCollector()
+        collector.snapshot = self.snapshot(tmpdir)
+        collector.encoder = ResponseEncoder()
+        collector.record(1, {'used_memory': 1, 'keyspace_hits': 3, 'keyspace_misses': 1}, 1000.0)
+
+        timestamp, data = collector.snapshot.read(1)
+        assert timestamp == 1000.0
+        assert json.loads(data.decode('utf-8')) == {
+            'used_memory': 1, 'keyspace_hits': 3, 'keyspace_misses': 1,
+            'derived': {'hit_ratio': 0.75}}
+
+        collector.forget(1)
+        assert collector.snapshot.read(1) is None
+
+    def test_collector_compress(self, tmpdir):
+        """不小于压缩阈值的响应压缩后写入快照"""
+
+        collector = MetricsCollector()
+        collector.snapshot = self.snapshot(tmpdir)
+        collector.encoder = ResponseEncoder()
+        collector.compress_min_size = 64
+        info = {'key_%d' % i: 'value' for i in range(20)}
+        collector.record(1, info, 1000.0)
+
+        _, data = collector.snapshot.read(1)
+        assert is_compressed(data)
+        assert json.loads(decompress(data).decode('utf-8')) == info
@@ -0,0 +1,130 @@
+import os
+import math
+
+from rmon.metrics.store import MetricStore
+
+
+class TestMetricStore:
+    """测试监控指标磁盘存储
+    """
+
+    def store(self, tmpdir):
+        store = MetricStore()
+        store.path = str(tmpdir)
+        store.segment_duration = 100
+        store.retention = 150
+        return store
+
+    def test_append_and_query(self, tmpdir):
+        """批量写入后按时间范围读取
+        """
+        store = self.store(tmpdir)
+        for i in range(300):
+            store.append(1, 1000.0 + i, {'used_memory': float(i)})
+            if i % 50 == 0:
+                store.flush()
+        store.flush()
+
+        # 按段时长切分为多个段文件
+        assert len(store.segments(1)) == 3
+
+        timestamps, values = store.query(1, 'used_memory', 1090, 1110)
+        assert timestamps == [1000.0 + i for i in range(90, 111)]
+        assert values == [float(i) for i in range(90, 111)]
+
+        timestamps, values = store.query(1, 'used_memory')
+        assert len(values) == 300
+
+    def test_overlapping_writers(self, tmpdir):
+        """两个进程写入同一服务器时不截断对方的段文件，查询结果按时间排序
+        """
+        first, second = self.store(tmpdir), self.store(tmpdir)
+        for i in range(0, 60, 2):
+            first.append(1, 1000.0 + i, {'used_memory': float(i)})
+        for i in range(1, 60, 2):
+            second.append(1, 1000.0 + i, {'used_memory': float(i)})
+        first.flush()
+        second.flush()
+
+        # 同一秒创建的段文件顺延一秒
+        assert first.segments(1) == [1000, 1001]
+
+        timestamps, values = first.query(1, 'used_memory', 1030)
+        assert timestamps == [1000.0 + i for i in range(30, 60)]
+        assert values == [float(i) for i in range(30, 60)]
+
+        # 先写入的段文件被压缩后仍然可以读取
+        self.store(tmpdir).compact()
+        assert os.path.exists(os.path.join(str(tmpdir), '1', '1000.gor'))
+        timestamps, _ = first.query(1, 'used_memory', 1030)
+        assert timestamps == [1000.0 + i for i in range(30, 60)]
+
+    def test_new_metric(self, tmpdir):
+        """出现新指标时创建新的段文件，缺失的指标为NaN
+        """
+        store = self.store(tmpdir)
+        store.append(1, 1000.0, {'a': 1.0})
+        store.flush()
+        store.append(1, 1001.0, {'a': 2.0, 'b': 3.0})
+        store.append(1, 1002.0, {'b': 4.0})
+        store.flush()
+
+        assert len(store.segments(1)) == 2
+        assert store.query(1, 'b') == ([1001.0, 1002.0], [3.0, 4.0])
+        timestamps, values = store.query(1, 'a')
+        assert values[:2] == [1.0, 2.0]
+        assert math.isnan(values[2])
+
+    def test_flush_due(self, tmpdir):
+        """只写入缓冲时间超过 flush_interval 的缓冲区，尚未写入的采样也可以查询
+        """
+        store = self.store(tmpdir)
+        store.flush_interval = 60
+        store.append(1, 1000.0, {'a': 1.0})
+        store.append(2, 1050.0, {'a': 2.0})
+
+        store.flush_due(now=1030)
+        assert store.segments(1) == []
+        assert store.query(1, 'a') == ([1000.0], [1.0])
+
+        store.flush_due(now=1070)
+        assert store.segments(1) == [1000]
+        assert store.segments(2) == []
+        store.append(1, 1001.0, {'a': 3.0})
+        assert store.query(1, 'a') == ([1000.0, 1001.0], [1.0, 3.0])
+
+    def test_purge(self, tmpdir):
+        """删除超过保留时间的段文件
+        """
+        store = self.store(tmpdir)
+        for i in range(300):
+            store.append(1, 1000.0 + i, {'a': float(i)})
+            store.flush()
+
+        store.purge(now=1400)
+        assert store.segments(1) == [1200]
+        # 段文件已被其他进程删除时忽略
+        store._index[1] = [1000, 1200, 1300]
+        store.purge(now=1500)
+
+        store.forget(1)
+        assert store.segments(1) == []
+
+    def test_compact(self, tmpdir):
+        """压缩后的段文件读取结果不变
+        """
+        store = self.store(tmpdir)
+        for i in range(300):
+            store.append(1, 1000.0 + i, {'a': float(i // 10), 'b': 0.5})
+        store.flush()
+        for i in range(300, 350):
+            store.append(1, 1000.0 + i, {'a': float(i // 10), 'b': 0.5})
+        store.flush()
+
+        expected = store.query(1, 'a', 1100, 1320)
+        store.compact()
+
+        files = sorted(os.listdir(os.path.join(store.path, '1')))
+        assert files == ['1000.gor', '1300.seg']
+        assert store.query(1, 'a', 1100, 1320) == expected
+        assert store.query(1, 'b')[1] == [0.5] * 350
@@ -1,7 +1,43 @@
+import gzip
 import json
+import time
+from datetime import datetime
+
+import pytest
 from flask import url_for
 
-from rmon.models import Server
+from rmon.common.encoder import get_dumps, ENCODERS
+
+from rmon.models import Server, User
+from rmon.common.token_cache import UserPrincipal
+from rmon.models.server import ServerSchema
+from rmon.extensions import collector, metric_store, metrics_snapshot, redis_pools
+from rmon.views.server import ServerMetricsStream, ServerDetail, ServerBulk
+
+
+class TestRestView:
+    """测试RestView视图基类"""
+
+    def test_handler_compiled_once(self):
+        """每个HTTP方法的装饰器只包装一次"""
+
+        handler = ServerDetail.handler('get')
+        assert handler is ServerDetail.handler('get')
+        assert handler is not ServerDetail.get
+        assert ServerDetail.handler('post') is None
+
+    @pytest.mark.parametrize('name', ENCODERS)
+    def test_encoder(self, name):
+        """各个序列化库的结果一致，日期时间使用ISO格式"""
+
+        try:
+            _, dumps = get_dumps(name)
+        except ValueError:
+            pytest.skip('%s not installed' % name)
+
+        data = {'name': '服务器', 'created_at': datetime(2017, 5, 1, 12, 30), 'value': 1.5}
+        assert json.loads(dumps(data).decode('utf-8')) == {
+            'name': '服务器', 'created_at': '2017-05-01T12:30:00', 'value': 1.5}
 
 
 class TestServerList:
@@ -31,6 +67,71 @@ class TestServerList:
         assert 'updated_at' in h
         assert 'created_at' in h
 
+    def test_get_servers_paginated(self, db, client):
+        """按id分页并按名称前缀和地址过滤"""
+
+        for i in range(5):
+            Server(name='redis-%d' % i, host='127.0.0.%d' % (i % 2 + 1)).save()
+
+        resp = client.get(url_for(self.endpoint, limit=2))
+        assert [s['name'] for s in resp.json] == ['redis-0', 'redis-1']
+        after_id = resp.headers['X-Next-After-Id']
+
+        resp = client.get(url_for(self.endpoint, limit=2, after_id=after_id))
+        assert [s['name'] for s in resp.json] == ['redis-2', 'redis-3']
+
+        resp = client.get(url_for(self.endpoint, host='127.0.0.1', name='redis'))
+        assert [s['name'] for s in resp.json] == ['redis-0', 'redis-2', 'redis-4']
+        assert 'X-Next-After-Id' not in resp.headers
+
+        resp = client.get(url_for(self.endpoint, limit=0))
+        assert resp.status_code == 400
+
+    def test_get_servers_name_prefix_literal(self, db, client):
+        """名称前缀中的 % 和 _ 不是通配符，并且区分大小写"""
+
+        for name in ('redis_a', 'redisXa', 'Redis_b', 'redis%c'):
+            Server(name=name, host='127.0.0.1').save()
+
+        resp = client.get(url_for(self.endpoint, name='redis_'))
+        assert [s['name'] for s in resp.json] == ['redis_a']
+        resp = client.get(url_for(self.endpoint, name='redis%'))
+        assert [s['name'] for s in resp.json] == ['redis%c']
+
+    def test_get_servers_same_as_schema(self, server, client):
+        """只查询列的序列化结果与 ServerSchema 一致"""
+
+        resp = client.get(url_for(self.endpoint))
+        assert resp.json == ServerSchema().dump([server], many=True).data
+
+    def test_get_servers_not_modified(self, server, client):
+        """服务器列表没有变化时返回304，变化后返回新的列表"""
+
+        resp = client.get(url_for(self.endpoint))
+        etag = resp.headers['ETag']
+
+        resp = client.get(url_for(self.endpoint), headers={'If-None-Match': etag})
+        assert resp.status_code == 304
+        assert resp.data == b''
+
+        server.description = 'updated'
+        server.save()
+        resp = client.get(url_for(self.endpoint), headers={'If-None-Match': etag})
+        assert resp.status_code == 200
+        assert resp.json[0]['description'] == 'updated'
+        assert resp.headers['ETag'] != etag
+
+    def test_get_servers_gzip(self, server, client, app):
+        """响应体较大且客户端支持时使用gzip压缩"""
+
+        app.config['JSON_COMPRESS_MIN_SIZE'] = 1
+        resp = client.get(url_for(self.endpoint), headers={'Accept-Encoding': 'gzip'})
+
+        assert resp.headers['Content-Encoding'] == 'gzip'
+        assert 'Accept-Encoding' in resp.headers['Vary']
+        servers = json.loads(gzip.decompress(resp.data).decode('utf-8'))
+        assert servers[0]['name'] == server.name
+
     def test_create_server_success(self, db, client):
         """测试创建Redis服务器成功
         """
@@ -272,6 +373,106 @@ class TestServerDetail:
         assert Server.query.count() == 0
 
 
+class TestServerBulk:
+    """测试批量操作Redis服务器API"""
+
+    endpoint = 'api.server_bulk'
+
+    @pytest.fixture(autouse=True)
+    def admin(self, monkeypatch):
+        """跳过token认证"""
+        monkeypatch.setattr(User, 'verify_token_cached',
+                            staticmethod(lambda token: UserPrincipal(1, True)))
+
+    def request(self, client, method, data):
+        return client.open(url_for(self.endpoint), method=method, data=json.dumps(data),
+                           content_type='application/json',
+                           headers={'Authorization': 'jwt token'})
+
+    def test_create(self, server, client):
+        """批量创建服务器，返回每个服务器的结果"""
+
+        resp = self.request(client, 'POST', [
+            {'name': 'redis_a', 'host': '127.0.0.1'},
+            {'name': server.name, 'host': '127.0.0.1'},
+            {'name': 'redis_b', 'host': '127.0.0.1', 'port': 1025},
+            {'name': 'redis_a', 'host': '127.0.0.1'},
+            {'name': 'redis_c'},
+        ])
+
+        assert resp.status_code == 200
+        results = resp.json
+        assert results[0]['ok'] is True
+        assert results[1] == {'ok': False, 'message': 'Redis server alredy exist'}
+        assert results[2]['ok'] is False
+        assert results[3] == {'ok': False, 'message': 'Redis server alredy exist'}
+        assert results[4]['ok'] is False
+        assert sorted(s.name for s in Server.query) == ['redis_a', server.name]
+
+    def test_update(self, server, client):
+        """批量更新服务器，失败的服务器保持不变"""
+
+        other = Server(name='redis_other', host='127.0.0.1')
+        other.save()
+
+        resp = self.request(client, 'PUT', [
+            {'id': server.id, 'description': 'updated'},
+            {'id': other.id, 'name': server.name},
+            {'id': 100, 'description': 'missing'},
+        ])
+
+        assert resp.json == [
+            {'ok': True, 'id': server.id},
+            {'ok': False, 'message': 'Redis server alredy exist'},
+            {'ok': False, 'message': 'object not exist'},
+        ]
+        assert Server.query.get(server.id).description == 'updated'
+        assert Server.query.get(other.id).name == 'redis_other'
+
+    def test_invalid_ids(self, server, client):
+        """列表、字典、布尔值等不是合法的服务器id"""
+
+        resp = self.request(client, 'PUT', [
+            {'id': [server.id], 'description': 'list'},
+            {'id': {'id': server.id}, 'description': 'dict'},
+            {'id': True, 'description': 'bool'},
+        ])
+        assert resp.status_code == 200
+        assert resp.json == [{'ok': False, 'message': 'invalid server id'}] * 3
+
+        resp = self.request(client, 'DELETE', [True])
+        assert resp.status_code == 400
+        assert Server.query.count() == 1
+
+    def test_commit_failed(self, db, client, monkeypatch):
+        """违反数据库约束时返回400"""
+
+        monkeypatch.setattr(ServerBulk, 'check_names', lambda self, servers, results: None)
+        resp = self.request(client, 'POST', [
+            {'name': 'redis_a', 'host': '127.0.0.1'},
+            {'name': 'redis_a', 'host': '127.0.0.1'},
+        ])
+        assert resp.status_code == 400
+        assert Server.query.count() == 0
+
+    def test_ping_temporary(self, db, client):
+        """检查新服务器时不创建共享连接池"""
+
+        pools = len(redis_pools)
+        resp = self.request(client, 'POST', [{'name': 'redis_a', 'host': '127.0.0.1'}])
+        assert resp.json[0]['ok'] is True
+        assert len(redis_pools) == pools
+
+    def test_delete(self, server, client):
+        """批量删除服务器"""
+
+        resp = self.request(client, 'DELETE', [server.id, 100])
+
+        assert resp.json == [{'ok': True, 'id': server.id},
+                             {'ok': False, 'message': 'object not exist'}]
+        assert Server.query.count() == 0
+
+
 class TestServerMetrics:
     """测试获取服务器INFO  API"""
 
@@ -294,6 +495,101 @@ class TestServerMetrics:
         # 数据库中仍为原记录
         assert Server.query.first() == server
 
+    def test_get_server_info_from_snapshot(self, server, client, tmpdir):
+        """直接返回其他进程写入共享快照的监控信息"""
+
+        metrics_snapshot.path = str(tmpdir.join('snapshot'))
+        metrics_snapshot.open()
+        try:
+            metrics_snapshot.write(server.id, time.time(), b'{"used_memory":1}')
+            resp = client.get(url_for(self.endpoint, object_id=server.id))
+        finally:
+            metrics_snapshot.close()
+
+        assert resp.status_code == 200
+        assert resp.json == {'used_memory': 1}
+
+    def test_get_server_info_from_compressed_snapshot(self, server, client, tmpdir):
+        """共享快照中已经压缩的响应直接返回，客户端不支持gzip时解压"""
+
+        metrics_snapshot.path = str(tmpdir.join('snapshot'))
+        metrics_snapshot.open()
+        url = url_for(self.endpoint, object_id=server.id)
+        try:
+            metrics_snapshot.write(server.id, time.time(), gzip.compress(b'{"used_memory":1}\n'))
+            compressed = client.get(url, headers={'Accept-Encoding': 'gzip'})
+            plain = client.get(url)
+        finally:
+            metrics_snapshot.close()
+
+        assert compressed.headers['Content-Encoding'] == 'gzip'
+        assert json.loads(gzip.decompress(compressed.data).decode('utf-8')) == {'used_memory': 1}
+        assert 'Content-Encoding' not in plain.headers
+        assert plain.json == {'used_memory': 1}
+
+    def test_get_server_info_fallback_read_only(self, app, server, client, tmpdir):
+        """采集器没有启动时，直接访问Redis服务器的结果只缓存，不写入共享快照和磁盘存储"""
+
+        metrics_snapshot.path = str(tmpdir.join('snapshot'))
+        metrics_snapshot.open()
+        metric_store.path = str(tmpdir.join('store'))
+        try:
+            collector.init_app(app)
+            resp = client.get(url_for(self.endpoint, object_id=server.id))
+            assert resp.status_code == 200
+            assert 'redis_version' in resp.json
+            assert metrics_snapshot.read(server.id) is None
+            assert metric_store.segments(server.id) == []
+            assert collector.latest(server.id) is None
+        finally:
+            metrics_snapshot.close()
+            metric_store.path = None
+
+    def test_get_server_info_not_modified(self, server, client):
+        """采样没有变化时返回304"""
+
+        url = url_for(self.endpoint, object_id=server.id)
+        etag = client.get(url).headers['ETag']
+
+        resp = client.get(url, headers={'If-None-Match': etag})
+        assert resp.status_code == 304
+
+        collector.record(server.id, server.get_metrics())
+        resp = client.get(url, headers={'If-None-Match': etag})
+        assert resp.status_code == 200
+
+    def test_get_server_info_with_section_and_fields(self, server, client):
+        """只获取指定section的指定字段"""
+
+        resp = client.get(url_for(self.endpoint, object_id=server.id,
+                                  section='memory', fields='used_memory,redis_version'))
+
+        assert resp.status_code == 200
+        # redis_version 属于 server section，因此不会返回
+        assert list(resp.json.keys()) == ['used_memory']
+
+    def test_get_server_info_with_section_derived(self, server, client):
+        """指定section时根据最近一次完整采样计算衍生指标"""
+
+        info = server.get_metrics()
+        collector.record(server.id, info, timestamp=time.time() - 1)
+
+        resp = client.get(url_for(self.endpoint, object_id=server.id, section='stats'))
+        assert resp.status_code == 200
+        assert 'redis_version' not in resp.json
+        derived = resp.json['derived']
+        assert derived['ops_per_sec'] > 0
+        assert 'hit_ratio' in derived or info['keyspace_hits'] + info['keyspace_misses'] == 0
+
+    def test_get_server_info_failed_with_invalid_section(self, server, client):
+        """无效的section导致获取INFO失败"""
+
+        resp = client.get(url_for(self.endpoint, object_id=server.id, section='unknown'))
+
+        assert resp.status_code == 400
+        assert resp.json == {'ok': False,
+                             'message': 'invalid info section unknown'}
+
     def test_get_server_info_failed_with_server_not_exist(self, db, client):
         """获取不存在的服务器INFO失败"""
 
@@ -312,3 +608,87 @@ class TestServerMetrics:
 
         # 数据库中没有记录
         assert Server.query.count() == 0
+
+
+class TestServerListMetrics:
+    """测试并发获取所有服务器监控信息API"""
+
+    endpoint = 'api.server_list_metrics'
+
+    def test_get_metrics_partial(self, server, client):
+        """无法访问的服务器被标记为失败，不影响其他服务器"""
+
+        # 没有Redis服务器监听在6399端口上
+        unreachable = Server(name='unreachable', host='127.0.0.1', port=6399)
+        unreachable.save()
+
+        resp = client.get(url_for(self.endpoint))
+        assert resp.status_code == 200
+
+        data = resp.json
+        assert len(data) == 2
+        assert data[0]['id'] == server.id
+        assert data[0]['ok'] == True
+        assert len(data[0]['metrics']) > 0
+        assert data[1]['id'] == unreachable.id
+        assert data[1]['ok'] == False
+        assert data[1]['message'] is not None
+
+    def test_get_metrics_filter_by_ids(self, server, client):
+        """通过 ids 参数过滤服务器"""
+
+        resp = client.get(url_for(self.endpoint, ids='%d' % (server.id + 1)))
+        assert resp.status_code == 200
+        assert resp.json == []
+
+
+class TestServerMetricsHistory:
+    """测试服务器监控指标历史API"""
+
+    endpoint = 'api.server_metrics_history'
+
+    def test_get_history(self, server, client):
+        """获取降采样后的指标历史"""
+
+        for i in range(100):
+            collector.record(server.id, {'used_memory': i}, timestamp=float(i))
+
+        resp = client.get(url_for(self.endpoint, object_id=server.id,
+                                  metric='used_memory', points=10, **{'from': 50}))
+        collector.forget(server.id)
+
+        assert resp.status_code == 200
+        assert resp.json['metric'] == 'used_memory'
+        points = resp.json['points']
+        assert len(points) == 10
+        assert points[0][0] == 50.0
+
+    def test_get_history_failed_with_metric_not_exist(self, server, client):
+        """指标不存在时返回404"""
+
+        resp = client.get(url_for(self.endpoint, object_id=server.id, metric='unknown'))
+
+        assert resp.status_code == 404
+        assert resp.json == {'ok': False, 'message': 'metric unknown not exist'}
+
+
+class TestServerMetricsStream:
+    """测试服务器监控信息实时推送API"""
+
+    def test_events(self, server):
+        """第一个事件包含所有字段，之后只推送变化的字段"""
+
+        collector.record(server.id, {'used_memory': 1, 'connected_clients': 1})
+        events = ServerMetricsStream.events([server], None, 0, 15)
+
+        chunk = next(events).decode('utf-8')
+        assert chunk.startswith('event: metrics\n')
+        data = json.loads(chunk.split('data: ', 1)[1])
+        assert data['id'] == server.id
+        assert data['metrics'] == {'used_memory': 1, 'connected_clients': 1}
+
+        collector.record(server.id, {'used_memory': 2, 'connected_clients': 1})
+        data = json.loads(next(events).decode('utf-8').split('data: ', 1)[1])
+        assert data['metrics'] == {'used_memory': 2}
+
+        events.close()